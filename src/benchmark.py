@@ -0,0 +1,661 @@
+import copy
+import json
+import os
+import subprocess
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from options import BenchmarkOptions
+from runtime import setup_runtime
+
+# best wall time of fn over opts.repeat runs
+def best_time(fn, repeat):
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return min(times)
+
+# a DRIT training model on the benchmark device
+def _make_model(opts):
+  from model import DRIT
+  device = setup_runtime(opts)
+  model = DRIT(opts)
+  model.setdevice(device)
+  model.initialize()
+  return model, device
+
+# random input batches of both domains
+def _make_batch(opts, device):
+  images_a = torch.randn(opts.batch_size, opts.input_dim_a, opts.crop_size, opts.crop_size, device=device)
+  images_b = torch.randn(opts.batch_size, opts.input_dim_b, opts.crop_size, opts.crop_size, device=device)
+  return images_a, images_b
+
+# pack hook for saved_tensors_hooks and the dict it fills with the bytes of the tensors saved for
+# backward outside checkpointed blocks, counted once per storage
+def _saved_bytes_hook():
+  saved = {}
+  def pack(x):
+    storage = x.untyped_storage()
+    saved[storage.data_ptr()] = storage.nbytes()
+    return x
+  return saved, pack
+
+# largest differences the parity checks accept, fp32 unless the name says otherwise
+TOLERANCES = {
+  'loss': 1e-5,
+  'grad': 1e-5,
+  'param': 1e-5,
+  'output': 1e-4,
+  'bf16 output': 0.1,
+  'bf16 loss': 0.05,
+}
+
+# fail the benchmark once a parity difference exceeds its tolerance, NaN included
+def check_diff(name, diff, kind):
+  if not diff <= TOLERANCES[kind]:
+    raise RuntimeError('%s %.3g exceeds the tolerance %.3g' % (name, diff, TOLERANCES[kind]))
+
+####################################################################
+#------------------------------ Decode ------------------------------
+####################################################################
+def bench_decode(opts, bench_dir):
+  from dataset import load_resized
+
+  # smooth synthetic photos, so that the JPEGs have realistic sizes
+  print('\n--- writing %d %dx%d JPEGs ---' % (opts.num_images, opts.source_width, opts.source_height))
+  images = []
+  for idx in range(opts.num_images):
+    small = (np.random.rand(opts.source_height // 16, opts.source_width // 16, 3) * 255).astype(np.uint8)
+    img = Image.fromarray(small).resize((opts.source_width, opts.source_height), Image.BILINEAR)
+    images.append(os.path.join(bench_dir, '%d.jpg' % idx))
+    img.save(images[-1], quality=90)
+
+  print('\n--- decode + resize to %d ---' % opts.resize_size)
+  for name, draft in [('full decode', False), ('draft decode', True)]:
+    elapsed = best_time(lambda: [load_resized(x, opts.resize_size, draft) for x in images], opts.repeat)
+    print('%s: %.1f images/sec' % (name, opts.num_images / elapsed))
+
+####################################################################
+#------------------------ Discriminator loss ------------------------
+####################################################################
+def legacy_backward_D(netD, real, fake):
+  # separate real/fake passes with sigmoid + binary_cross_entropy against materialized targets
+  pred_fake = netD.forward(fake.detach())
+  pred_real = netD.forward(real)
+  loss_D = 0
+  for out_a, out_b in zip(pred_fake, pred_real):
+    out_fake = torch.sigmoid(out_a)
+    out_real = torch.sigmoid(out_b)
+    ad_fake_loss = nn.functional.binary_cross_entropy(out_fake, torch.zeros_like(out_fake))
+    ad_true_loss = nn.functional.binary_cross_entropy(out_real, torch.ones_like(out_real))
+    loss_D += ad_true_loss + ad_fake_loss
+  loss_D.backward()
+  return loss_D
+
+def bench_dloss(opts, bench_dir):
+  model, device = _make_model(opts)
+  half_size = opts.batch_size // 2
+  real = torch.randn(half_size, opts.input_dim_a, opts.crop_size, opts.crop_size, device=device)
+  fake = torch.randn(half_size, opts.input_dim_a, opts.crop_size, opts.crop_size, device=device)
+
+  # parity of the loss and the discriminator gradients
+  results = {}
+  for name, fn in [('legacy', lambda: legacy_backward_D(model.disA, real, fake)), ('fused', lambda: model.backward_D(model.disA, real, fake))]:
+    model.disA.zero_grad()
+    loss = fn()
+    results[name] = (loss.item(), [p.grad.clone() for p in model.disA.parameters()])
+  grad_diff = max((a - b).abs().max().item() for a, b in zip(results['legacy'][1], results['fused'][1]))
+  print('\nloss legacy %.6f, fused %.6f, max grad diff %.3g' % (results['legacy'][0], results['fused'][0], grad_diff))
+  check_diff('loss diff', abs(results['legacy'][0] - results['fused'][0]), 'loss')
+  check_diff('grad diff', grad_diff, 'grad')
+
+  print('\n--- discriminator update (batch %d) ---' % opts.batch_size)
+  for name, fn in [('legacy', lambda: legacy_backward_D(model.disA, real, fake)), ('fused', lambda: model.backward_D(model.disA, real, fake))]:
+    fn()
+    elapsed = best_time(lambda: [fn() for _ in range(5)], opts.repeat) / 5
+    print('%s: %.2f ms/step' % (name, elapsed * 1000))
+
+def bench_dstack(opts, bench_dir):
+  opts.stack_dis = True
+  model, device = _make_model(opts)
+  half_size = opts.batch_size // 2
+  images = {}
+  for name in ['real_A_encoded', 'real_A_random', 'fake_A_encoded', 'fake_A_random', 'fake_A_random2']:
+    images[name] = torch.randn(half_size, opts.input_dim_a, opts.crop_size, opts.crop_size, device=device)
+  for name in ['real_B_encoded', 'real_B_random', 'fake_B_encoded', 'fake_B_random', 'fake_B_random2']:
+    images[name] = torch.randn(half_size, opts.input_dim_b, opts.crop_size, opts.crop_size, device=device)
+  names = ['disA', 'disA2', 'disB', 'disB2']
+  print('\nstacks: %s' % ', '.join(['(%s)' % ', '.join(stack_names) for stack_names, _ in model.dis_stacks]))
+
+  def separate():
+    fakes_A2 = [model.fake_A_random] if opts.no_ms else [model.fake_A_random, model.fake_A_random2]
+    fakes_B2 = [model.fake_B_random] if opts.no_ms else [model.fake_B_random, model.fake_B_random2]
+    model.backward_D(model.disA, model.real_A_encoded, model.fake_A_encoded)
+    model.backward_D(model.disA2, model.real_A_random, *fakes_A2)
+    model.backward_D(model.disB, model.real_B_encoded, model.fake_B_encoded)
+    model.backward_D(model.disB2, model.real_B_random, *fakes_B2)
+
+  # parity of the discriminator gradients, from the same spectral norm state. It runs in float64: in
+  # float32 the grouped and the separate convolutions round differently, which now and then moves an
+  # activation next to zero across the kink of a LeakyReLU
+  grads = {}
+  states = [copy.deepcopy(getattr(model, net).state_dict()) for net in names]
+  for name, x in images.items():
+    setattr(model, name, x.double())
+  for name, fn in [('separate', separate), ('stacked', model.backward_D_stacked)]:
+    for net, state in zip(names, states):
+      getattr(model, net).load_state_dict(state)
+      getattr(model, net).double().zero_grad()
+    fn()
+    grads[name] = [p.grad.clone() for net in names for p in getattr(model, net).parameters()]
+  grad_diff = max((a - b).abs().max().item() for a, b in zip(grads['separate'], grads['stacked']))
+  print('max grad diff %.3g' % grad_diff)
+  check_diff('grad diff', grad_diff, 'grad')
+  for net, state in zip(names, states):
+    getattr(model, net).float().load_state_dict(state)
+  for name, x in images.items():
+    setattr(model, name, x)
+
+  print('\n--- discriminator forward/backward (batch %d) ---' % opts.batch_size)
+  for name, fn in [('separate', separate), ('stacked', model.backward_D_stacked)]:
+    fn()
+    elapsed = best_time(lambda: [fn() for _ in range(5)], opts.repeat) / 5
+    print('%s: %.2f ms/step' % (name, elapsed * 1000))
+
+####################################################################
+#------------------------- Coalesced calls --------------------------
+####################################################################
+def bench_coalesce(opts, bench_dir):
+  model, device = _make_model(opts)
+  # eval mode, so that the noise of the content encoder does not affect the parity check
+  model.eval()
+  half_size = opts.batch_size // 2
+  images_a = torch.randn(half_size, opts.input_dim_a, opts.crop_size, opts.crop_size, device=device)
+  images_b = torch.randn(half_size, opts.input_dim_b, opts.crop_size, opts.crop_size, device=device)
+  fakes_a = torch.randn(2 * half_size, opts.input_dim_a, opts.crop_size, opts.crop_size, device=device)
+  fakes_b = torch.randn(2 * half_size, opts.input_dim_b, opts.crop_size, opts.crop_size, device=device)
+  with torch.no_grad():
+    z_content_a, z_content_b = model.enc_c.forward(images_a, images_b)
+  z_attr = torch.randn(half_size, model.nz, device=device)
+
+  # the legacy forward ran the shared trunks once per domain and the attribute encoder once per fake set
+  calls = [
+      ('content encoder',
+       lambda: (model.enc_c.forward_a(images_a), model.enc_c.forward_b(images_b)),
+       lambda: model.enc_c.forward(images_a, images_b)),
+      ('generator',
+       lambda: (model.gen.forward_a(z_content_b, z_attr), model.gen.forward_b(z_content_a, z_attr)),
+       lambda: model.gen.forward(z_content_b, z_attr, z_content_a, z_attr)),
+      ('attribute encoder',
+       lambda: [torch.cat(x, 0) for x in zip(model.enc_a.forward(fakes_a[0:half_size], fakes_b[0:half_size]), model.enc_a.forward(fakes_a[half_size:], fakes_b[half_size:]))],
+       lambda: model.enc_a.forward(fakes_a, fakes_b))]
+
+  print('\n--- forward (batch %d) ---' % opts.batch_size)
+  for name, separate, coalesced in calls:
+    with torch.no_grad():
+      out_diff = max((a - b).abs().max().item() for a, b in zip(separate(), coalesced()))
+      times = [best_time(lambda: [fn() for _ in range(5)], opts.repeat) / 5 for fn in (separate, coalesced)]
+    print('%s: separate %.2f ms, coalesced %.2f ms, max output diff %.3g' % (name, times[0] * 1000, times[1] * 1000, out_diff))
+    check_diff('%s output diff' % name, out_diff, 'output')
+
+####################################################################
+#------------------------ Folded attribute z ------------------------
+####################################################################
+def bench_fold(opts, bench_dir):
+  import networks
+  model, device = _make_model(opts)
+  model.eval()
+  images = torch.randn(opts.batch_size, opts.input_dim_a, opts.crop_size, opts.crop_size, device=device)
+  with torch.no_grad():
+    z_content = model.enc_c.forward_a(images)
+  z_attr = torch.randn(opts.batch_size, model.nz, device=device)
+
+  # parity of the outputs and of the generator gradients, with the same weights in both modes
+  results = {}
+  for fold_z in [False, True]:
+    networks.set_fold_z(model.gen, fold_z)
+    model.gen.zero_grad()
+    output = model.gen.forward_b(z_content, z_attr)
+    output.mean().backward()
+    results[fold_z] = (output.detach(), [p.grad.clone() for p in model.gen.parameters() if p.grad is not None])
+  out_diff = (results[False][0] - results[True][0]).abs().max().item()
+  grad_diff = max((a - b).abs().max().item() for a, b in zip(results[False][1], results[True][1]))
+  print('\nmax output diff %.3g, max grad diff %.3g' % (out_diff, grad_diff))
+  check_diff('output diff', out_diff, 'output')
+  check_diff('grad diff', grad_diff, 'grad')
+
+  print('\n--- generator forward (batch %d) ---' % opts.batch_size)
+  for name, fold_z in [('concatenated z', False), ('folded z', True)]:
+    networks.set_fold_z(model.gen, fold_z)
+    with torch.no_grad():
+      elapsed = best_time(lambda: [model.gen.forward_b(z_content, z_attr) for _ in range(5)], opts.repeat) / 5
+    print('%s: %.2f ms/step' % (name, elapsed * 1000))
+
+####################################################################
+#------------------------- Generator update -------------------------
+####################################################################
+def legacy_update_EG(model):
+  # both loss groups differentiated through one retained graph at the same parameters,
+  # followed by the (G, Ec, Ea) and (G, Ec) optimizer steps
+  params_EG = list(model.enc_c.parameters()) + list(model.enc_a.parameters()) + list(model.gen.parameters())
+  params_G = list(model.enc_c.parameters()) + list(model.gen.parameters())
+  grads_EG = torch.autograd.grad(model.loss_EG(), params_EG, retain_graph=True, allow_unused=True)
+  grads_G = torch.autograd.grad(model.loss_G_alone(), params_G, allow_unused=True)
+  for names, params, grads in [(['enc_c', 'enc_a', 'gen'], params_EG, grads_EG), (['enc_c', 'gen'], params_G, grads_G)]:
+    model.opt.zero_grad(names=names)
+    for p, grad in zip(params, grads):
+      if grad is not None:
+        p.grad.copy_(grad)
+    model.opt.step(names=names)
+
+def bench_eg(opts, bench_dir):
+  model, device = _make_model(opts)
+  images_a, images_b = _make_batch(opts, device)
+  nets = ['enc_c', 'enc_a', 'gen']
+
+  def run(update, seed=0):
+    torch.manual_seed(seed)
+    model.input_A = images_a
+    model.input_B = images_b
+    model.forward()
+    update()
+    # the forward outputs hold the parts of the graph that no backward went through
+    for name, value in list(vars(model).items()):
+      if isinstance(value, torch.Tensor) and value.grad_fn is not None:
+        delattr(model, name)
+
+  # parity of the parameters after a few generator updates from the same forward passes, with both
+  # updates run from the same weights and optimizer state
+  state = copy.deepcopy(model.state_dict())
+  opt_state = dict((name, model.opt.group_state_dict(name)) for name in nets)
+  params = {}
+  for name, update in [('split graphs', model.update_EG), ('retained graph', lambda: legacy_update_EG(model))]:
+    model.load_state_dict(state)
+    for net in nets:
+      model.opt.load_group_state_dict(net, opt_state[net])
+    for seed in range(2):
+      run(update, seed)
+    params[name] = [p.detach().clone() for net in nets for p in getattr(model, net).parameters()]
+  param_diff = max((a - b).abs().max().item() for a, b in zip(params['split graphs'], params['retained graph']))
+  print('\nmax parameter diff after 2 updates %.3g' % param_diff)
+  check_diff('parameter diff', param_diff, 'param')
+  del params
+
+  print('\n--- forward + generator update (batch %d) ---' % opts.batch_size)
+  for name, update in [('retained graph', lambda: legacy_update_EG(model)), ('split graphs', model.update_EG)]:
+    if device.type == 'cuda':
+      torch.cuda.reset_peak_memory_stats(device)
+    elapsed = best_time(lambda: run(update), opts.repeat)
+    if device.type == 'cuda':
+      print('%s: %.2f ms/step, peak memory %.1f MB' % (name, elapsed * 1000, torch.cuda.max_memory_allocated(device) / 2.0**20))
+    else:
+      print('%s: %.2f ms/step' % (name, elapsed * 1000))
+
+####################################################################
+#-------------------------- Checkpointing ---------------------------
+####################################################################
+def bench_checkpoint(opts, bench_dir):
+  import networks
+  model, device = _make_model(opts)
+  images_a, images_b = _make_batch(opts, device)
+  state = copy.deepcopy(model.state_dict())
+  saved, pack = _saved_bytes_hook()
+  kinds_list = ['', 'ins', 'mis', 'dec', 'ins,mis', 'ins,mis,dec']
+  nets = [model.enc_c, model.enc_a, model.gen]
+
+  def step(seed=0):
+    torch.manual_seed(seed)
+    saved.clear()
+    model.input_A = images_a
+    model.input_B = images_b
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+      model.forward()
+    model.update_EG()
+
+  # parity of the generator losses and gradients with the plain run, from the same weights and seed.
+  # The recomputed blocks have to see the same inputs, z and random noise as the stored ones
+  results = {}
+  for kinds in kinds_list:
+    for net in nets:
+      networks.set_checkpoint(net, kinds)
+    model.load_state_dict(state)
+    step(0)
+    results[kinds] = ([model.G_loss, model.l1_recon_z_loss_a, model.l1_recon_z_loss_b], [p.grad.clone() for net in nets for p in net.parameters() if p.grad is not None])
+  print('\n--- parity with the plain run ---')
+  for kinds in kinds_list[1:]:
+    loss_diff = max(abs(a - b) / max(abs(a), 1e-8) for a, b in zip(results[''][0], results[kinds][0]))
+    grad_diff = max((a - b).abs().max().item() for a, b in zip(results[''][1], results[kinds][1]))
+    print('%s: max relative loss diff %.3g, max grad diff %.3g' % (kinds, loss_diff, grad_diff))
+    check_diff('%s relative loss diff' % kinds, loss_diff, 'loss')
+    check_diff('%s grad diff' % kinds, grad_diff, 'grad')
+
+  print('\n--- forward + generator update (batch %d, crop %d) ---' % (opts.batch_size, opts.crop_size))
+  print('%-12s %12s %14s %16s' % ('checkpoint', 'ms/step', 'saved MB', 'peak memory MB'))
+  for kinds in kinds_list:
+    for net in nets:
+      networks.set_checkpoint(net, kinds)
+    step()
+    if device.type == 'cuda':
+      torch.cuda.reset_peak_memory_stats(device)
+    elapsed = best_time(step, opts.repeat)
+    peak = '%16.1f' % (torch.cuda.max_memory_allocated(device) / 2.0**20) if device.type == 'cuda' else '%16s' % '-'
+    print('%-12s %12.2f %14.1f %s' % (kinds or 'none', elapsed * 1000, sum(saved.values()) / 2.0**20, peak))
+
+####################################################################
+#----------------------------- Precision ----------------------------
+####################################################################
+def bench_precision(opts, bench_dir):
+  model, device = _make_model(opts)
+  images_a, images_b = _make_batch(opts, device)
+  z_attr = torch.randn(opts.batch_size, 1, model.nz, device=device)
+  state = copy.deepcopy(model.state_dict())
+  saved, pack = _saved_bytes_hook()
+
+  def step(seed):
+    torch.manual_seed(seed)
+    saved.clear()
+    model.input_A = images_a
+    model.input_B = images_b
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x), model.autocast():
+      model.forward()
+    model.update_EG()
+
+  # test outputs and generator losses on a fixed seed, from the same weights
+  results = {}
+  for precision in ['fp32', 'bf16']:
+    model.precision = precision
+    model.load_state_dict(state)
+    model.eval()
+    with torch.no_grad():
+      output = model.test_forward_attr(images_a, z_attr)
+    model.train()
+    step(0)
+    results[precision] = (output, model.G_loss, model.l1_recon_z_loss_a)
+  out_diff = (results['fp32'][0] - results['bf16'][0]).abs().max().item()
+  print('\ntest output max diff %.3g' % out_diff)
+  print('G loss fp32 %.6f, bf16 %.6f' % (results['fp32'][1], results['bf16'][1]))
+  print('latent regression loss fp32 %.6f, bf16 %.6f' % (results['fp32'][2], results['bf16'][2]))
+  check_diff('bf16 test output diff', out_diff, 'bf16 output')
+  for name, idx in [('G loss', 1), ('latent regression loss', 2)]:
+    ref = float(results['fp32'][idx])
+    check_diff('bf16 %s relative diff' % name, abs(float(results['bf16'][idx]) - ref) / max(abs(ref), 1e-8), 'bf16 loss')
+
+  print('\n--- forward + generator update (batch %d, crop %d) ---' % (opts.batch_size, opts.crop_size))
+  for precision in ['fp32', 'bf16']:
+    model.precision = precision
+    step(0)
+    elapsed = best_time(lambda: step(0), opts.repeat)
+    print('%s: %.2f ms/step, saved activations %.1f MB' % (precision, elapsed * 1000, sum(saved.values()) / 2.0**20))
+
+####################################################################
+#---------------------------- Optimizer -----------------------------
+####################################################################
+def bench_optim(opts, bench_dir):
+  model, device = _make_model(opts)
+  names = list(model.opt.groups)
+  nets = [getattr(model, name) for name in names]
+
+  # reference: one torch.optim.Adam per network, stepped one after another
+  ref_nets = [copy.deepcopy(net) for net in nets]
+  ref_opts = [torch.optim.Adam(net.parameters(), lr=model.opt.groups[name]['lr'], betas=(0.5, 0.999), weight_decay=0.0001) for name, net in zip(names, ref_nets)]
+  def fill_grads(nets_grads, seed):
+    gen = torch.Generator().manual_seed(seed)
+    for net in nets_grads:
+      for p in net.parameters():
+        p.grad.copy_(torch.randn(p.size(), generator=gen).to(device))
+  def ref_step():
+    for name, net, opt in zip(names, ref_nets, ref_opts):
+      if model.opt.groups[name]['max_grad_norm'] is not None:
+        nn.utils.clip_grad_norm_(net.parameters(), model.opt.groups[name]['max_grad_norm'])
+      opt.step()
+  def flat_step():
+    model.opt.step(names=names)
+
+  # parity after a few steps on identical gradients
+  for net in ref_nets:
+    for p in net.parameters():
+      p.grad = torch.zeros_like(p)
+  model.opt.zero_grad(names=names)
+  for seed in range(3):
+    fill_grads(ref_nets, seed)
+    fill_grads(nets, seed)
+    ref_step()
+    flat_step()
+  param_diff = max((a - b).abs().max().item() for net, ref_net in zip(nets, ref_nets) for a, b in zip(net.parameters(), ref_net.parameters()))
+  print('\nmax parameter diff after 3 steps %.3g' % param_diff)
+  check_diff('parameter diff', param_diff, 'param')
+
+  # checkpoint state in the torch.optim.Adam layout loads back into torch.optim.Adam
+  for name, opt in zip(names, ref_opts):
+    opt.load_state_dict(model.opt.group_state_dict(name))
+
+  print('\n--- optimizer step, %d parameter tensors in %d networks ---' % (sum(len(list(net.parameters())) for net in nets), len(nets)))
+  for name, fn in [('per network Adam', ref_step), ('flat multi-tensor Adam', flat_step)]:
+    fn()
+    elapsed = best_time(lambda: [fn() for _ in range(5)], opts.repeat) / 5
+    print('%s: %.2f ms/step' % (name, elapsed * 1000))
+
+####################################################################
+#----------------------------- Loading ------------------------------
+####################################################################
+# loads a model in a fresh process, prints the wall time and the peak RSS in kB. The peak is read
+# from /proc, as ru_maxrss carries the peak of the benchmark process over into the child
+LOAD_CHILD = """
+import sys, time, json, argparse
+start = time.perf_counter()
+import torch
+opts = argparse.Namespace(**json.loads(sys.argv[3]))
+if sys.argv[1] == 'train':
+  from model import DRIT
+  model = DRIT(opts)
+  model.resume(sys.argv[2], train=False)
+else:
+  from model import DRITInference
+  model = DRITInference(opts)
+  model.resume(sys.argv[2])
+model.eval()
+with open('/proc/self/status') as f:
+  rss = [line.split()[1] for line in f if line.startswith('VmHWM:')][0]
+print(time.perf_counter() - start, rss)
+"""
+
+def bench_load(opts, bench_dir):
+  from model import DRIT, DRITInference, load_checkpoint, export_checkpoint
+  device = setup_runtime(opts)
+  model = DRIT(opts)
+  model.initialize()
+  model.eval()
+  checkpoint = os.path.join(bench_dir, 'train.pth')
+  model.save(checkpoint, 0, 0)
+  exports = {}
+  for name, dtype in [('fp32', torch.float32), ('bf16', torch.bfloat16)]:
+    exports[name] = os.path.join(bench_dir, 'export_%s.pth' % name)
+    torch.save(export_checkpoint(load_checkpoint(checkpoint), dtype), exports[name])
+
+  # parity of the exported models with the training model
+  model.setdevice(device)
+  image = torch.randn(opts.batch_size, opts.input_dim_a, opts.crop_size, opts.crop_size, device=device)
+  z = torch.randn(opts.batch_size, 1, model.nz, device=device)
+  with torch.no_grad():
+    ref = model.test_forward_attr(image, z)
+    for name in ['fp32', 'bf16']:
+      inference = DRITInference(opts)
+      inference.resume(exports[name])
+      inference.setdevice(device)
+      inference.eval()
+      out_diff = (inference.test_forward_attr(image, z) - ref).abs().max().item()
+      print('%s export: test output max diff %.3g' % (name, out_diff))
+      check_diff('%s export output diff' % name, out_diff, 'output' if name == 'fp32' else 'bf16 output')
+
+  # cold start in fresh processes
+  print('\n--- cold start ---')
+  child_opts = json.dumps(dict((key, getattr(opts, key)) for key in ['input_dim_a', 'input_dim_b', 'concat', 'no_ms', 'dis_scale', 'dis_norm', 'dis_spectral_norm', 'stack_dis', 'fold_z', 'precision', 'checkpoint']))
+  src_dir = os.path.dirname(os.path.abspath(__file__))
+  for name, kind, filename in [('DRIT + training checkpoint', 'train', checkpoint), ('DRITInference + training checkpoint', 'inference', checkpoint),
+                               ('DRITInference + fp32 export', 'inference', exports['fp32']), ('DRITInference + bf16 export', 'inference', exports['bf16'])]:
+    runs = []
+    for _ in range(opts.repeat):
+      out = subprocess.check_output([sys.executable, '-c', LOAD_CHILD, kind, filename, child_opts], cwd=src_dir)
+      runs.append([float(x) for x in out.split()[-2:]])
+    elapsed, rss = min(runs)
+    print('%s (%.1f MB): %.0f ms, peak RSS %.0f MB' % (name, os.path.getsize(filename) / 2.0**20, elapsed * 1000, rss / 1024.0))
+
+####################################################################
+#----------------------------- Registry -----------------------------
+####################################################################
+def bench_registry(opts, bench_dir):
+  import argparse
+  import threading
+  from model import DRIT, load_checkpoint, export_checkpoint
+  from registry import ModelRegistry, model_bytes
+  device = setup_runtime(opts)
+
+  # distinct inference exports, a memory budget that fits a third of them
+  num_models, num_threads, num_gets = 12, 4, 50
+  model = DRIT(opts)
+  configs = {}
+  for idx in range(num_models):
+    model.initialize()
+    configs['model%d' % idx] = argparse.Namespace(**dict(vars(opts), resume=os.path.join(bench_dir, 'model%d.pth' % idx)))
+    model.save(os.path.join(bench_dir, 'train.pth'), 0, 0)
+    torch.save(export_checkpoint(load_checkpoint(os.path.join(bench_dir, 'train.pth'))), configs['model%d' % idx].resume)
+  budget = model_bytes(nn.ModuleList([model.enc_c, model.enc_a, model.gen])) * num_models // 3
+  registry = ModelRegistry(configs, device, budget)
+
+  # zipf-like popularity, every get is followed by a forward pass on the shared model
+  names = sorted(configs)
+  weights = [1.0 / (rank + 1) for rank in range(num_models)]
+  image = torch.randn(1, opts.input_dim_a, opts.crop_size, opts.crop_size, device=device)
+  def worker(seed):
+    rng = np.random.RandomState(seed)
+    for name in rng.choice(names, num_gets, p=np.array(weights) / sum(weights)):
+      with torch.no_grad():
+        registry.get(name).test_forward(image)
+  print('\n--- %d models, budget %.1f MB, %d threads x %d requests ---' % (num_models, budget / 2.0**20, num_threads, num_gets))
+  start = time.perf_counter()
+  threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(num_threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - start
+  stats = registry.stats()
+  print('hits %d, loads %d, evictions %d, resident %d models (%.1f MB)' % (stats['hits'], stats['loads'], stats['evictions'], len(stats['resident']), stats['resident_mb']))
+  print('%.2f ms/request, %.2f ms/load' % (elapsed * 1000 / (num_threads * num_gets), stats['load_time_s'] * 1000 / max(stats['loads'], 1)))
+
+####################################################################
+#------------------------------- ONNX -------------------------------
+####################################################################
+def bench_onnx(opts, bench_dir):
+  import argparse
+  from model import DRIT, DRITInference, load_checkpoint, export_checkpoint
+  from onnx_model import export_onnx, DRITOnnx
+  setup_runtime(opts)
+
+  # an fp32 CPU model without --fold_z and its ONNX export
+  model_opts = argparse.Namespace(**dict(vars(opts), fold_z=False, precision='fp32'))
+  train_model = DRIT(model_opts)
+  train_model.initialize()
+  train_model.save(os.path.join(bench_dir, 'train.pth'), 0, 0)
+  torch.save(export_checkpoint(load_checkpoint(os.path.join(bench_dir, 'train.pth'))), os.path.join(bench_dir, 'model.pth'))
+  model = DRITInference(model_opts)
+  model.resume(os.path.join(bench_dir, 'model.pth'))
+  model.eval()
+  export_onnx(model, os.path.join(bench_dir, 'onnx'), opts.input_dim_a, opts.input_dim_b, opts.crop_size)
+  onnx_model = DRITOnnx(os.path.join(bench_dir, 'onnx'), torch.get_num_threads())
+
+  # parity on fixed attribute codes, at other batch and image sizes than traced
+  print('\n--- parity ---')
+  for batch_size, size in [(1, opts.crop_size), (opts.batch_size, opts.crop_size + 32)]:
+    for a2b in [True, False]:
+      image = torch.randn(batch_size, opts.input_dim_a if a2b else opts.input_dim_b, size, size)
+      reference = torch.randn(batch_size, opts.input_dim_b if a2b else opts.input_dim_a, size, size)
+      z_attr = torch.randn(batch_size, 2, model.nz)
+      with torch.no_grad():
+        out_diff = (model.test_forward_attr(image, z_attr, a2b=a2b) - onnx_model.test_forward_attr(image, z_attr, a2b=a2b)).abs().max().item()
+        attr_diff = max((x - y).abs().max().item() for x, y in zip(model.encode_attr(reference, a2b=a2b), onnx_model.encode_attr(reference, a2b=a2b)) if x is not None)
+      print('batch %d, %dx%d, %s: output max diff %.3g, attribute max diff %.3g' % (batch_size, size, size, 'a2b' if a2b else 'b2a', out_diff, attr_diff))
+      check_diff('onnx output diff', out_diff, 'output')
+      check_diff('onnx attribute diff', attr_diff, 'output')
+
+  print('\n--- test_forward throughput (batch %d, crop %d, %d threads) ---' % (opts.batch_size, opts.crop_size, torch.get_num_threads()))
+  image = torch.randn(opts.batch_size, opts.input_dim_a, opts.crop_size, opts.crop_size)
+  for name, backend in [('eager', model), ('onnxruntime', onnx_model)]:
+    with torch.no_grad():
+      backend.test_forward(image)
+      elapsed = best_time(lambda: [backend.test_forward(image) for _ in range(5)], opts.repeat) / 5
+    print('%s: %.2f ms/batch, %.1f images/sec' % (name, elapsed * 1000, opts.batch_size / elapsed))
+
+####################################################################
+#------------------------------ Imports -----------------------------
+####################################################################
+# modules that must not be imported by importing the given module. The entry points import
+# their project modules inside main(), once the options parse, so that --help and bad options
+# return early and a script only loads the modules it uses
+IMPORT_BANS = {
+  'train': ['dataset', 'model', 'saver', 'torchvision', 'tensorboardX', 'tensorflow'],
+  'test': ['dataset', 'model', 'saver', 'torchvision', 'tensorboardX', 'tensorflow'],
+  'test_transfer': ['dataset', 'model', 'saver', 'torchvision', 'tensorboardX', 'tensorflow'],
+  'build_attr_bank': ['dataset', 'model', 'saver', 'torchvision', 'tensorboardX', 'tensorflow'],
+  'export_model': ['model', 'saver', 'torchvision', 'tensorboardX', 'tensorflow'],
+  'prepare_dataset': ['dataset', 'torch', 'torchvision', 'tensorboardX', 'tensorflow'],
+  'server': ['model', 'torchvision', 'tensorboardX', 'tensorflow'],
+  'loadgen': ['torch', 'torchvision', 'tensorboardX', 'tensorflow'],
+  'latency': ['torch', 'torchvision', 'tensorboardX', 'tensorflow'],
+  'saver': ['torchvision', 'tensorboardX', 'tensorflow'],
+  'dataset': ['torchvision', 'tensorboardX', 'tensorflow'],
+  'model': ['torchvision', 'tensorboardX', 'tensorflow'],
+  'registry': ['torchvision', 'tensorboardX', 'tensorflow'],
+  'onnx_model': ['onnx', 'onnxruntime', 'torchvision', 'tensorboardX', 'tensorflow'],
+}
+
+def bench_imports(opts, bench_dir):
+  # python -X importtime of every module in a fresh process, failing if a banned module is imported
+  src_dir = os.path.dirname(os.path.abspath(__file__))
+  failures = []
+  print('\n--- import time (cumulative) ---')
+  for module, bans in IMPORT_BANS.items():
+    runs = []
+    for _ in range(opts.repeat):
+      out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], cwd=src_dir, stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+      imported = {}
+      for line in out.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+          continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imported[name.strip()] = int(cumulative)
+      runs.append(imported)
+    elapsed = min(imported[module] for imported in runs) / 1000.0
+    banned = sorted(name for name in runs[0] if name.split('.')[0] in bans)
+    print('%s: %.0f ms%s' % (module, elapsed, ', imports %s' % ', '.join(banned) if banned else ''))
+    if banned:
+      failures.append(module)
+  if failures:
+    raise RuntimeError('heavy modules imported by %s' % ', '.join(failures))
+
+benchmarks = {'decode': bench_decode, 'dloss': bench_dloss, 'dstack': bench_dstack, 'optim': bench_optim, 'eg': bench_eg, 'coalesce': bench_coalesce, 'fold': bench_fold, 'checkpoint': bench_checkpoint, 'precision': bench_precision, 'load': bench_load, 'imports': bench_imports, 'registry': bench_registry, 'onnx': bench_onnx}
+
+def main():
+  parser = BenchmarkOptions()
+  opts = parser.parse()
+
+  bench_dir = opts.bench_dir if opts.bench_dir is not None else tempfile.mkdtemp(prefix='drit_bench_')
+  if not os.path.exists(bench_dir):
+    os.makedirs(bench_dir)
+  try:
+    benchmarks[opts.mode](opts, bench_dir)
+  finally:
+    if opts.bench_dir is None:
+      shutil.rmtree(bench_dir)
+
+  return
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,58 @@
+import torch
+import numpy as np
+from options import TestOptions
+import os
+
+def main():
+  # parse options
+  parser = TestOptions()
+  opts = parser.parse()
+
+  from dataset import dataset_single
+  from model import DRITInference
+  from runtime import setup_runtime
+
+  device = setup_runtime(opts)
+  if opts.attr_bank is None:
+    raise ValueError('specify the output file with --attr_bank')
+
+  # data loader for the reference (target) domain
+  print('\n--- load dataset ---')
+  if opts.a2b:
+    dataset = dataset_single(opts, 'B', opts.input_dim_b)
+  else:
+    dataset = dataset_single(opts, 'A', opts.input_dim_a)
+  loader = torch.utils.data.DataLoader(dataset, batch_size=opts.batch_size, num_workers=opts.nThreads)
+
+  # model
+  print('\n--- load model ---')
+  model = DRITInference(opts)
+  model.resume(opts.resume)
+  model.setdevice(device)
+  model.eval()
+
+  # encode every reference image once
+  print('\n--- encoding attributes ---')
+  mus, logvars = [], []
+  for idx, img in enumerate(loader):
+    print('{}/{}'.format(idx, len(loader)))
+    with torch.no_grad():
+      mu, logvar = model.encode_attr(img.to(device), a2b=opts.a2b)
+    mus.append(mu.cpu())
+    if logvar is not None:
+      logvars.append(logvar.cpu())
+
+  # mu/logvar for the concat model, z for the feature-wise transform model
+  bank = {'a2b': np.array(opts.a2b, dtype=np.int8), 'names': np.array([os.path.basename(x) for x in dataset.img])}
+  if logvars:
+    bank['mu'] = torch.cat(mus, 0).numpy()
+    bank['logvar'] = torch.cat(logvars, 0).numpy()
+  else:
+    bank['z'] = torch.cat(mus, 0).numpy()
+  np.savez(opts.attr_bank, **bank)
+  print('saved %d attribute codes to %s' % (len(dataset), opts.attr_bank))
+
+  return
+
+if __name__ == '__main__':
+  main()
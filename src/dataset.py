@@ -1,51 +1,321 @@
 import os
+import io
+import hashlib
+import math
+import tarfile
+import torch
+import torch.distributed as dist
 import torch.utils.data as data
+import numpy as np
 from PIL import Image
-from torchvision.transforms import Compose, Resize, RandomCrop, CenterCrop, RandomHorizontalFlip, ToTensor, Normalize
 import random
+from multiprocessing import Pool
+
+####################################################################
+#-------------------------- Dataset index ---------------------------
+####################################################################
+# short key of a dataroot for the names of the files derived from it
+def root_key(dataroot):
+  return hashlib.sha1(os.path.abspath(dataroot).encode('utf-8')).hexdigest()[:12]
+
+# one index per set of a dataroot, so that datasets sharing an index_dir never read each other's lists
+def index_file(index_dir, dataroot, setname):
+  return os.path.join(index_dir, '%s_%s.index.tsv' % (setname, root_key(dataroot)))
+
+# fully decode an image once, returning (width, height, mode, error)
+def scan_image(img_name):
+  try:
+    img = Image.open(img_name)
+    width, height, mode = img.size[0], img.size[1], img.mode
+    img.convert('RGB').load()
+    return width, height, mode, ''
+  except Exception as e:
+    return 0, 0, '', ('%s: %s' % (type(e).__name__, e)).replace('\t', ' ').replace('\n', ' ')
+
+def read_index(filename):
+  entries = {}
+  if os.path.exists(filename):
+    with open(filename) as f:
+      for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) == 7:
+          entries[fields[0]] = fields
+  return entries
+
+# list a set with size, mtime and decoded dimensions; unchanged files keep their previous scan result
+def build_index(dataroot, setname, index_dir, n_threads=8):
+  filename = index_file(index_dir, dataroot, setname)
+  previous = read_index(filename)
+  entries, jobs = [], []
+  for name in sorted(os.listdir(os.path.join(dataroot, setname))):
+    stat = os.stat(os.path.join(dataroot, setname, name))
+    entry = previous.get(name)
+    if entry is not None and entry[1] == str(stat.st_size) and entry[2] == str(stat.st_mtime_ns):
+      entries.append(entry)
+    else:
+      entries.append([name, str(stat.st_size), str(stat.st_mtime_ns)])
+      jobs.append(len(entries) - 1)
+  if jobs:
+    pool = Pool(max(1, n_threads))
+    results = pool.map(scan_image, [os.path.join(dataroot, setname, entries[idx][0]) for idx in jobs], chunksize=16)
+    pool.close()
+    pool.join()
+    for idx, (width, height, mode, error) in zip(jobs, results):
+      entries[idx] += [str(width), str(height), mode, error]
+  if not os.path.exists(index_dir):
+    os.makedirs(index_dir)
+  tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+  with open(tmp_filename, 'w') as f:
+    for entry in entries:
+      f.write('\t'.join(entry) + '\n')
+  os.replace(tmp_filename, filename)
+  bad = [entry for entry in entries if entry[6]]
+  for entry in bad:
+    print('%s: skipping %s (%s)' % (setname, entry[0], entry[6]))
+  print('%s: indexed %d images (%d scanned, %d unreadable) in %s' % (setname, len(entries), len(jobs), len(bad), filename))
+
+# names of the readable images of a set. The index is (incrementally) rebuilt if there is none yet, if
+# files were added to or removed from the folder since it was written, or on rebuild
+def load_index(dataroot, setname, index_dir, n_threads=8, rebuild=False):
+  filename = index_file(index_dir, dataroot, setname)
+  if rebuild or not os.path.exists(filename) or os.stat(os.path.join(dataroot, setname)).st_mtime_ns > os.stat(filename).st_mtime_ns:
+    build_index(dataroot, setname, index_dir, n_threads)
+  with open(filename) as f:
+    entries = [line.rstrip('\n').split('\t') for line in f]
+  return [entry[0] for entry in entries if len(entry) == 7 and not entry[6]]
+
+####################################################################
+#------------------------ Decoded image cache -----------------------
+####################################################################
+# one cache per set of a dataroot, resize size and decode mode, so that datasets sharing a cache_dir never collide
+def cache_files(cache_dir, dataroot, setname, resize_size, draft=True):
+  name = os.path.join(cache_dir, '%s_%s_%d%s' % (setname, root_key(dataroot), resize_size, '_draft' if draft else ''))
+  return name + '.npy', name + '.txt'
+
+# decode an image as RGB; JPEGs are decoded at the smallest DCT scale that is still >= draft_size
+def open_image(img_name, draft_size=None):
+  img = Image.open(img_name)
+  if draft_size is not None:
+    img.draft('RGB', (draft_size, draft_size))
+  return img.convert('RGB')
+
+def load_resized(img_name, resize_size, draft=True):
+  img = open_image(img_name, resize_size if draft else None)
+  img = img.resize((resize_size, resize_size), Image.BICUBIC)
+  return np.asarray(img)
+
+def _load_resized(args):
+  return load_resized(*args)
+
+# decode every image of a set once and store it as a uint8 array file of N x H x W x 3. The list of
+# names is written last, once the array is in place
+def build_cache(dataroot, setname, resize_size, cache_dir, n_threads=8, draft=True):
+  images = sorted(os.listdir(os.path.join(dataroot, setname)))
+  array_file, names_file = cache_files(cache_dir, dataroot, setname, resize_size, draft)
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  tmp_file = '%s.%d.tmp' % (array_file, os.getpid())
+  array = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(len(images), resize_size, resize_size, 3))
+  jobs = [(os.path.join(dataroot, setname, x), resize_size, draft) for x in images]
+  pool = Pool(max(1, n_threads))
+  for idx, img in enumerate(pool.imap(_load_resized, jobs, chunksize=16)):
+    array[idx] = img
+    if (idx + 1) % 1000 == 0:
+      print('%s: %d/%d' % (setname, idx + 1, len(images)))
+  pool.close()
+  pool.join()
+  array.flush()
+  del array
+  os.replace(tmp_file, array_file)
+  tmp_file = '%s.%d.tmp' % (names_file, os.getpid())
+  with open(tmp_file, 'w') as f:
+    f.write('\n'.join(images) + '\n')
+  os.replace(tmp_file, names_file)
+  print('%s: cached %d images in %s' % (setname, len(images), array_file))
+
+# the cache array and image names of a set. The cache is rebuilt if files were added to or removed
+# from the folder since it was written
+def load_cache_index(dataroot, setname, resize_size, cache_dir, n_threads=8, draft=True):
+  array_file, names_file = cache_files(cache_dir, dataroot, setname, resize_size, draft)
+  if not os.path.exists(array_file) or not os.path.exists(names_file):
+    raise IOError('no image cache for %s at size %d in %s, build it with prepare_dataset.py' % (setname, resize_size, cache_dir))
+  if os.stat(os.path.join(dataroot, setname)).st_mtime_ns > os.stat(names_file).st_mtime_ns:
+    print('%s: the image cache is older than the folder, rebuilding it' % setname)
+    build_cache(dataroot, setname, resize_size, cache_dir, n_threads, draft)
+  with open(names_file) as f:
+    images = [x for x in f.read().split('\n') if x]
+  return array_file, images
+
+# resize, crop, flip and normalize a PIL image. torchvision is only imported once a dataset is built
+def image_transform(resize_size, crop_size, random_crop, flip):
+  from torchvision.transforms import Compose, Resize, RandomCrop, CenterCrop, RandomHorizontalFlip, ToTensor, Normalize
+  transforms = [Resize((resize_size, resize_size), Image.BICUBIC)]
+  if random_crop:
+    transforms.append(RandomCrop(crop_size))
+  else:
+    transforms.append(CenterCrop(crop_size))
+  if flip:
+    transforms.append(RandomHorizontalFlip())
+  transforms.append(ToTensor())
+  transforms.append(Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]))
+  return Compose(transforms)
+
+# decode an image file or file object and transform it into a C x H x W tensor of input_dim channels
+def load_image(img_file, transforms, draft_size, input_dim):
+  img = open_image(img_file, draft_size)
+  img = transforms(img)
+  if input_dim == 1:
+    img = img[0, ...] * 0.299 + img[1, ...] * 0.587 + img[2, ...] * 0.114
+    img = img.unsqueeze(0)
+  return img
+
+# crop/flip a cached H x W x 3 uint8 image and normalize it like ToTensor + Normalize
+def cached_to_tensor(img, crop_size, random_crop, flip, input_dim):
+  h, w = img.shape[0], img.shape[1]
+  if random_crop:
+    y, x = random.randint(0, h - crop_size), random.randint(0, w - crop_size)
+  else:
+    y, x = int(round((h - crop_size) / 2.)), int(round((w - crop_size) / 2.))
+  img = img[y:y + crop_size, x:x + crop_size]
+  if flip and random.random() < 0.5:
+    img = img[:, ::-1]
+  img = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1).float().div_(127.5).sub_(1)
+  if input_dim == 1:
+    img = img[0, ...] * 0.299 + img[1, ...] * 0.587 + img[2, ...] * 0.114
+    img = img.unsqueeze(0)
+  return img
+
+####################################################################
+#--------------------------- Tar shards ----------------------------
+####################################################################
+def shard_index_file(shard_dir, setname):
+  return os.path.join(shard_dir, '%s-shards.txt' % setname)
+
+# pack the images of a set into sequential tar shards of shard_size images each
+def build_shards(dataroot, setname, shard_dir, shard_size=1000):
+  images = sorted(os.listdir(os.path.join(dataroot, setname)))
+  if not os.path.exists(shard_dir):
+    os.makedirs(shard_dir)
+  index = []
+  for n, start in enumerate(range(0, len(images), shard_size)):
+    shard = '%s-%05d.tar' % (setname, n)
+    tmp_file = os.path.join(shard_dir, shard + '.tmp')
+    with tarfile.open(tmp_file, 'w') as tar:
+      for name in images[start:start + shard_size]:
+        tar.add(os.path.join(dataroot, setname, name), arcname=name)
+    os.replace(tmp_file, os.path.join(shard_dir, shard))
+    index.append('%s %d' % (shard, len(images[start:start + shard_size])))
+  with open(shard_index_file(shard_dir, setname), 'w') as f:
+    f.write('\n'.join(index) + '\n')
+  print('%s: wrote %d images to %d shards in %s' % (setname, len(images), len(index), shard_dir))
+
+def load_shard_index(shard_dir, setname):
+  shards_file = shard_index_file(shard_dir, setname)
+  if not os.path.exists(shards_file):
+    raise IOError('no shard index for %s in %s, build it with prepare_dataset.py' % (setname, shard_dir))
+  shards, size = [], 0
+  with open(shards_file) as f:
+    for line in f:
+      if line.strip():
+        name, count = line.split()
+        shards.append(os.path.join(shard_dir, name))
+        size += int(count)
+  return shards, size
+
+# sequentially read the files stored in a tar shard
+def read_shard(shard):
+  with tarfile.open(shard, 'r|*') as tar:
+    for member in tar:
+      if member.isfile():
+        yield tar.extractfile(member).read()
+
+# crop/flip/normalize a collated N x H x W x 3 uint8 batch in one vectorized op
+def batch_to_tensor(imgs, crop_size, random_crop, flip, input_dim):
+  n, h, w = imgs.size(0), imgs.size(1), imgs.size(2)
+  device = imgs.device
+  if random_crop:
+    y = torch.randint(0, h - crop_size + 1, (n, 1), device=device)
+    x = torch.randint(0, w - crop_size + 1, (n, 1), device=device)
+  else:
+    y = torch.full((n, 1), int(round((h - crop_size) / 2.)), dtype=torch.long, device=device)
+    x = torch.full((n, 1), int(round((w - crop_size) / 2.)), dtype=torch.long, device=device)
+  offsets = torch.arange(crop_size, device=device)
+  rows = y + offsets
+  cols = x + offsets
+  if flip:
+    flipped = torch.rand(n, 1, device=device) < 0.5
+    cols = torch.where(flipped, cols.flip(1), cols)
+  index = torch.arange(n, device=device).view(n, 1, 1)
+  imgs = imgs[index, rows.view(n, crop_size, 1), cols.view(n, 1, crop_size)]
+  imgs = imgs.permute(0, 3, 1, 2).contiguous().float().div_(127.5).sub_(1)
+  if input_dim == 1:
+    imgs = imgs[:, 0:1] * 0.299 + imgs[:, 1:2] * 0.587 + imgs[:, 2:3] * 0.114
+  return imgs
+
+####################################################################
+#----------------------------- Datasets -----------------------------
+####################################################################
 
 class dataset_single(data.Dataset):
   def __init__(self, opts, setname, input_dim):
     self.dataroot = opts.dataroot
-    images = os.listdir(os.path.join(self.dataroot, opts.phase + setname))
+    self.cache_file = None
+    if opts.cache_dir is not None:
+      self.cache_file, images = load_cache_index(self.dataroot, opts.phase + setname, opts.resize_size, opts.cache_dir, opts.nThreads, not opts.no_draft)
+    elif opts.index_dir is not None:
+      images = load_index(self.dataroot, opts.phase + setname, opts.index_dir, opts.nThreads, opts.rebuild_index)
+    else:
+      images = os.listdir(os.path.join(self.dataroot, opts.phase + setname))
     self.img = [os.path.join(self.dataroot, opts.phase + setname, x) for x in images]
     self.size = len(self.img)
     self.input_dim = input_dim
+    self.crop_size = opts.crop_size
+    self.cache = None
+    self.draft_size = None if opts.no_draft else opts.resize_size
 
     # setup image transformation
-    transforms = [Resize((opts.resize_size, opts.resize_size), Image.BICUBIC)]
-    transforms.append(CenterCrop(opts.crop_size))
-    transforms.append(ToTensor())
-    transforms.append(Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]))
-    self.transforms = Compose(transforms)
+    self.transforms = image_transform(opts.resize_size, opts.crop_size, False, False)
     print('%s: %d images'%(setname, self.size))
     return
 
   def __getitem__(self, index):
-    data = self.load_img(self.img[index], self.input_dim)
+    if self.cache_file is not None:
+      # opened lazily so that every worker maps the file instead of pickling it
+      if self.cache is None:
+        self.cache = np.load(self.cache_file, mmap_mode='r')
+      return cached_to_tensor(self.cache[index], self.crop_size, False, False, self.input_dim)
+    data = load_image(self.img[index], self.transforms, self.draft_size, self.input_dim)
     return data
 
-  def load_img(self, img_name, input_dim):
-    img = Image.open(img_name).convert('RGB')
-    img = self.transforms(img)
-    if input_dim == 1:
-      img = img[0, ...] * 0.299 + img[1, ...] * 0.587 + img[2, ...] * 0.114
-      img = img.unsqueeze(0)
-    return img
-
   def __len__(self):
     return self.size
 
-class dataset_unpair(data.Dataset):
+class unpair_batch_transform():
+  # finish the transformation of uint8 batches produced with batch_transform, shared by the unpaired datasets
+  def transform_batch(self, images_a, images_b):
+    images_a = batch_to_tensor(images_a, self.crop_size, self.random_crop, self.flip, self.input_dim_A)
+    images_b = batch_to_tensor(images_b, self.crop_size, self.random_crop, self.flip, self.input_dim_B)
+    return images_a, images_b
+
+class dataset_unpair(unpair_batch_transform, data.Dataset):
   def __init__(self, opts):
     self.dataroot = opts.dataroot
 
+    self.cache_file_A, self.cache_file_B = None, None
+    if opts.cache_dir is not None:
+      self.cache_file_A, images_A = load_cache_index(self.dataroot, opts.phase + 'A', opts.resize_size, opts.cache_dir, opts.nThreads, not opts.no_draft)
+      self.cache_file_B, images_B = load_cache_index(self.dataroot, opts.phase + 'B', opts.resize_size, opts.cache_dir, opts.nThreads, not opts.no_draft)
+    elif opts.index_dir is not None:
+      images_A = load_index(self.dataroot, opts.phase + 'A', opts.index_dir, opts.nThreads, opts.rebuild_index)
+      images_B = load_index(self.dataroot, opts.phase + 'B', opts.index_dir, opts.nThreads, opts.rebuild_index)
+    else:
+      images_A = os.listdir(os.path.join(self.dataroot, opts.phase + 'A'))
+      images_B = os.listdir(os.path.join(self.dataroot, opts.phase + 'B'))
+
     # A
-    images_A = os.listdir(os.path.join(self.dataroot, opts.phase + 'A'))
     self.A = [os.path.join(self.dataroot, opts.phase + 'A', x) for x in images_A]
 
     # B
-    images_B = os.listdir(os.path.join(self.dataroot, opts.phase + 'B'))
     self.B = [os.path.join(self.dataroot, opts.phase + 'B', x) for x in images_B]
 
     self.A_size = len(self.A)
@@ -53,37 +323,133 @@ class dataset_unpair(data.Dataset):
     self.dataset_size = max(self.A_size, self.B_size)
     self.input_dim_A = opts.input_dim_a
     self.input_dim_B = opts.input_dim_b
+    self.crop_size = opts.crop_size
+    self.random_crop = opts.phase == 'train'
+    self.flip = not opts.no_flip
+    self.cache_A, self.cache_B = None, None
+    self.batch_transform = opts.batch_transform
+    self.resize_size = opts.resize_size
+    self.draft_size = None if opts.no_draft else opts.resize_size
 
     # setup image transformation
-    transforms = [Resize((opts.resize_size, opts.resize_size), Image.BICUBIC)]
-    if opts.phase == 'train':
-      transforms.append(RandomCrop(opts.crop_size))
-    else:
-      transforms.append(CenterCrop(opts.crop_size))
-    if not opts.no_flip:
-      transforms.append(RandomHorizontalFlip())
-    transforms.append(ToTensor())
-    transforms.append(Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]))
-    self.transforms = Compose(transforms)
+    self.transforms = image_transform(opts.resize_size, opts.crop_size, opts.phase == 'train', not opts.no_flip)
     print('A: %d, B: %d images'%(self.A_size, self.B_size))
     return
 
   def __getitem__(self, index):
     if self.dataset_size == self.A_size:
-      data_A = self.load_img(self.A[index], self.input_dim_A)
-      data_B = self.load_img(self.B[random.randint(0, self.B_size - 1)], self.input_dim_B)
+      index_A, index_B = index, random.randint(0, self.B_size - 1)
     else:
-      data_A = self.load_img(self.A[random.randint(0, self.A_size - 1)], self.input_dim_A)
-      data_B = self.load_img(self.B[index], self.input_dim_B)
+      index_A, index_B = random.randint(0, self.A_size - 1), index
+    if self.cache_file_A is not None:
+      # opened lazily so that every worker maps the files instead of pickling them
+      if self.cache_A is None:
+        self.cache_A = np.load(self.cache_file_A, mmap_mode='r')
+        self.cache_B = np.load(self.cache_file_B, mmap_mode='r')
+      if self.batch_transform:
+        return torch.from_numpy(np.array(self.cache_A[index_A])), torch.from_numpy(np.array(self.cache_B[index_B]))
+      data_A = cached_to_tensor(self.cache_A[index_A], self.crop_size, self.random_crop, self.flip, self.input_dim_A)
+      data_B = cached_to_tensor(self.cache_B[index_B], self.crop_size, self.random_crop, self.flip, self.input_dim_B)
+      return data_A, data_B
+    if self.batch_transform:
+      data_A = load_resized(self.A[index_A], self.resize_size, self.draft_size is not None)
+      data_B = load_resized(self.B[index_B], self.resize_size, self.draft_size is not None)
+      return torch.from_numpy(data_A.copy()), torch.from_numpy(data_B.copy())
+    data_A = load_image(self.A[index_A], self.transforms, self.draft_size, self.input_dim_A)
+    data_B = load_image(self.B[index_B], self.transforms, self.draft_size, self.input_dim_B)
     return data_A, data_B
 
-  def load_img(self, img_name, input_dim):
-    img = Image.open(img_name).convert('RGB')
-    img = self.transforms(img)
-    if input_dim == 1:
-      img = img[0, ...] * 0.299 + img[1, ...] * 0.587 + img[2, ...] * 0.114
-      img = img.unsqueeze(0)
-    return img
-
   def __len__(self):
     return self.dataset_size
+
+class dataset_unpair_shards(unpair_batch_transform, data.IterableDataset):
+  def __init__(self, opts):
+    self.shards_A, self.A_size = load_shard_index(opts.shard_dir, opts.phase + 'A')
+    self.shards_B, self.B_size = load_shard_index(opts.shard_dir, opts.phase + 'B')
+    self.dataset_size = max(self.A_size, self.B_size)
+    self.input_dim_A = opts.input_dim_a
+    self.input_dim_B = opts.input_dim_b
+    self.crop_size = opts.crop_size
+    self.random_crop = opts.phase == 'train'
+    self.flip = not opts.no_flip
+    self.batch_transform = opts.batch_transform
+    self.resize_size = opts.resize_size
+    self.draft_size = None if opts.no_draft else opts.resize_size
+    self.shuffle_buffer = opts.shuffle_buffer
+    self.epoch = 0
+
+    # shards are split across ranks as well as loader workers
+    self.rank, self.world_size = 0, 1
+    if dist.is_available() and dist.is_initialized():
+      self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+
+    # setup image transformation
+    self.transforms = image_transform(opts.resize_size, opts.crop_size, opts.phase == 'train', not opts.no_flip)
+    print('A: %d images in %d shards, B: %d images in %d shards'%(self.A_size, len(self.shards_A), self.B_size, len(self.shards_B)))
+    return
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  # endless stream of (pass, sample) for one reader out of n_streams
+  def stream(self, shards, size, stream_id, n_streams, input_dim, rng):
+    n_pass = 0
+    while True:
+      # every reader shuffles the shard order identically so the split stays disjoint
+      order = list(shards)
+      random.Random(self.epoch * 1000 + n_pass).shuffle(order)
+      # whole shards go to the readers when they divide evenly, otherwise every reader reads all shards
+      # and keeps every n_streams-th sample, so that no reader is left with a single small shard
+      if len(order) % n_streams == 0:
+        order, step = order[stream_id::n_streams], 1
+      elif size >= n_streams:
+        step = n_streams
+      else:
+        # fewer images than readers, every reader goes through all of them
+        step = 1
+      buffer = []
+      count, kept = 0, 0
+      for shard in order:
+        for sample in read_shard(shard):
+          count += 1
+          if step > 1 and (count - 1) % step != stream_id:
+            continue
+          kept += 1
+          if len(buffer) < self.shuffle_buffer:
+            buffer.append(sample)
+            continue
+          idx = rng.randint(0, len(buffer) - 1)
+          buffer[idx], sample = sample, buffer[idx]
+          yield n_pass, self.load_img(sample, input_dim)
+      if kept == 0:
+        raise IOError('reader %d of %d got no images from %s' % (stream_id, n_streams, ', '.join(order)))
+      rng.shuffle(buffer)
+      for sample in buffer:
+        yield n_pass, self.load_img(sample, input_dim)
+      n_pass += 1
+
+  def __iter__(self):
+    worker = data.get_worker_info()
+    worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+    stream_id = self.rank * num_workers + worker_id
+    n_streams = self.world_size * num_workers
+    rng = random.Random((self.epoch * n_streams + stream_id) * 7919 + random.randint(0, 1 << 30))
+    stream_A = self.stream(self.shards_A, self.A_size, stream_id, n_streams, self.input_dim_A, rng)
+    stream_B = self.stream(self.shards_B, self.B_size, stream_id, n_streams, self.input_dim_B, rng)
+    # pair A and B until both domains have been read once, cycling the smaller one
+    for (pass_A, data_A), (pass_B, data_B) in zip(stream_A, stream_B):
+      if pass_A > 0 and pass_B > 0:
+        break
+      yield data_A, data_B
+
+  def load_img(self, img_bytes, input_dim):
+    if self.batch_transform:
+      return torch.from_numpy(load_resized(io.BytesIO(img_bytes), self.resize_size, self.draft_size is not None).copy())
+    return load_image(io.BytesIO(img_bytes), self.transforms, self.draft_size, input_dim)
+
+  # pairs per rank: the larger share of the two domains, as a reader stops once both have been read
+  # once. A domain with fewer images than ranks is read whole by every rank. Whole shards of unequal
+  # sizes and the split between loader workers make it an estimate
+  def __len__(self):
+    shares = [size if size < self.world_size else int(math.ceil(size / float(self.world_size))) for size in (self.A_size, self.B_size)]
+    return max(shares)
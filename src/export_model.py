@@ -0,0 +1,33 @@
+import os
+import argparse
+import torch
+from options import ExportOptions
+
+def main():
+  # parse options
+  parser = ExportOptions()
+  opts = parser.parse()
+
+  from model import DRITInference, load_checkpoint, checkpoint_concat, export_checkpoint
+  from saver import save_atomic
+
+  # the training checkpoint is memory-mapped, only the encoders and the generator are read
+  print('\n--- export model ---')
+  checkpoint = load_checkpoint(opts.resume)
+  if opts.format == 'onnx':
+    from onnx_model import export_onnx
+    model_opts = argparse.Namespace(input_dim_a=opts.input_dim_a, input_dim_b=opts.input_dim_b, concat=checkpoint_concat(checkpoint), fold_z=False, precision='fp32')
+    model = DRITInference(model_opts)
+    model.resume_state(checkpoint)
+    model.eval()
+    export_onnx(model, opts.output, opts.input_dim_a, opts.input_dim_b, opts.crop_size, opts.opset)
+    print('%s -> %s' % (opts.resume, opts.output))
+    return
+  dtype = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}[opts.dtype]
+  export = export_checkpoint(checkpoint, dtype)
+  save_atomic(export, opts.output)
+  print('%s (%.1f MB) -> %s (%.1f MB)' % (opts.resume, os.path.getsize(opts.resume) / 2.0**20, opts.output, os.path.getsize(opts.output) / 2.0**20))
+  return
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,11 @@
+import statistics
+
+# latency summary in ms of a list of seconds, shared by the server stats and the load generator
+def summarize(values):
+  if not values:
+    return {}
+  if len(values) == 1:
+    cuts = values * 99
+  else:
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+  return {'mean': 1000 * sum(values) / len(values), 'p50': 1000 * cuts[49], 'p95': 1000 * cuts[94], 'p99': 1000 * cuts[98]}
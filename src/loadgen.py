@@ -0,0 +1,93 @@
+import io
+import os
+import json
+import time
+import base64
+import threading
+import urllib.request
+import urllib.error
+from PIL import Image
+from options import LoadgenOptions
+from latency import summarize
+
+# smooth synthetic photo as a base64 JPEG
+def synthetic_image(size):
+  small = Image.frombytes('RGB', (max(size // 16, 1), max(size // 16, 1)), os.urandom(3 * max(size // 16, 1)**2))
+  buf = io.BytesIO()
+  small.resize((size, size), Image.BILINEAR).save(buf, format='JPEG', quality=90)
+  return base64.b64encode(buf.getvalue()).decode('ascii')
+
+def percentiles(values):
+  summary = summarize(values)
+  return 'p50 %.1f ms, p95 %.1f ms, p99 %.1f ms' % (summary['p50'], summary['p95'], summary['p99'])
+
+def main():
+  # parse options
+  parser = LoadgenOptions()
+  opts = parser.parse()
+
+  # request payloads
+  if opts.images is not None:
+    images = []
+    for name in sorted(os.listdir(opts.images)):
+      with open(os.path.join(opts.images, name), 'rb') as f:
+        images.append(base64.b64encode(f.read()).decode('ascii'))
+  else:
+    images = [synthetic_image(opts.image_size) for _ in range(16)]
+  url = '%s/%s' % (opts.url.rstrip('/'), opts.endpoint)
+  models = opts.model.split(',') if opts.model is not None else []
+
+  # every client sends its next request once the previous one returned
+  lock = threading.Lock()
+  sent = [0]
+  results = []
+  def client():
+    while True:
+      with lock:
+        idx = sent[0]
+        if idx >= opts.requests:
+          return
+        sent[0] += 1
+      body = {'image': images[idx % len(images)], 'a2b': opts.a2b}
+      if models:
+        body['model'] = models[idx % len(models)]
+      if opts.endpoint == 'transfer':
+        body['reference'] = images[(idx + 1) % len(images)]
+      request = urllib.request.Request(url, json.dumps(body).encode('utf-8'), {'Content-Type': 'application/json'})
+      start = time.perf_counter()
+      try:
+        with urllib.request.urlopen(request, timeout=opts.timeout) as response:
+          reply = json.loads(response.read())
+        status = response.status
+      except urllib.error.HTTPError as e:
+        reply, status = {}, e.code
+      except (urllib.error.URLError, OSError):
+        reply, status = {}, None
+      with lock:
+        results.append((status, time.perf_counter() - start, reply))
+
+  print('\n--- %d requests to %s, %d clients ---' % (opts.requests, url, opts.concurrency))
+  start = time.perf_counter()
+  clients = [threading.Thread(target=client) for _ in range(opts.concurrency)]
+  for thread in clients:
+    thread.start()
+  for thread in clients:
+    thread.join()
+  elapsed = time.perf_counter() - start
+
+  ok = [(latency, reply) for status, latency, reply in results if status == 200]
+  rejected = sum(1 for status, _, _ in results if status == 503)
+  print('%d ok, %d rejected (503), %d failed in %.2f s, %.1f requests/sec' % (len(ok), rejected, len(results) - len(ok) - rejected, elapsed, len(ok) / elapsed))
+  if ok:
+    print('client latency: %s' % percentiles([latency for latency, _ in ok]))
+    print('server latency: %s' % percentiles([reply['latency_ms'] / 1000.0 for _, reply in ok]))
+    print('queue wait: %s' % percentiles([reply['queue_ms'] / 1000.0 for _, reply in ok]))
+    print('mean batch size: %.2f' % (sum(reply['batch_size'] for _, reply in ok) / float(len(ok))))
+
+  # server side totals
+  with urllib.request.urlopen('%s/stats' % opts.url.rstrip('/'), timeout=opts.timeout) as response:
+    print('server stats: %s' % json.dumps(json.loads(response.read())))
+  return
+
+if __name__ == '__main__':
+  main()
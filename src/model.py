@@ -1,16 +1,172 @@
+import contextlib
 import networks
 import torch
 import torch.nn as nn
 
-class DRIT(nn.Module):
+def load_checkpoint(filename):
+  # memory-mapped on the CPU, checkpoints in the legacy (non-zip) format are read in full
+  try:
+    return torch.load(filename, map_location='cpu', mmap=True)
+  except RuntimeError:
+    return torch.load(filename, map_location='cpu')
+
+# whether a checkpoint holds the --concat 1 attribute encoder
+def checkpoint_concat(checkpoint):
+  if checkpoint.get('format') == 'drit_inference':
+    return checkpoint['concat']
+  return any(key.startswith('fc_A') for key in checkpoint['enc_a'])
+
+def export_checkpoint(checkpoint, dtype=torch.float32):
+  # inference export of a training checkpoint or snapshot: the encoders and the generator only, with
+  # their floating point tensors stored in dtype
+  export = {'format': 'drit_inference', 'concat': checkpoint_concat(checkpoint)}
+  for name in ['enc_c', 'enc_a', 'gen']:
+    export[name] = dict((key, value.to(dtype) if value.is_floating_point() else value) for key, value in checkpoint[name].items())
+  return export
+
+
+class AttrSampling():
+  # the attribute code handling of the test API, shared by DRITInference and DRITOnnx, which provide
+  # get_z_random
+  def tile_attr(self, z_content, z_attr):
+    # pairs every content code with each attribute code of its image in z_attr (batch x num x nz),
+    # flattened to batch * num samples for the generator
+    batch_size, num = z_attr.size(0), z_attr.size(1)
+    content_size = z_content.size()[1:]
+    z_content = z_content.unsqueeze(1).expand(batch_size, num, *content_size).reshape(batch_size * num, *content_size)
+    return z_content, z_attr.reshape(batch_size * num, z_attr.size(2))
+
+  def sample_attr(self, mu, logvar=None):
+    if logvar is None:
+      return mu
+    std = logvar.mul(0.5).exp()
+    eps = self.get_z_random(std.size(0), std.size(1), 'gauss')
+    return eps.mul(std).add_(mu)
+
+class DRITInference(AttrSampling, nn.Module):
+  # the encoders and the generator only, for translating with trained weights. Without weights to
+  # initialize, the networks are built on the meta device and take over the loaded tensors in resume,
+  # which has to be called before setdevice
+  def __init__(self, opts, meta=True):
+    super(DRITInference, self).__init__()
+    self.nz = 8
+    self.concat = opts.concat
+    self.precision = opts.precision
+    self.device = torch.device('cpu')
+
+    with torch.device('meta') if meta else contextlib.nullcontext():
+      # encoders
+      self.enc_c = networks.E_content(opts.input_dim_a, opts.input_dim_b)
+      if self.concat:
+        self.enc_a = networks.E_attr_concat(opts.input_dim_a, opts.input_dim_b, self.nz, \
+            norm_layer=None, nl_layer=networks.get_non_linearity(layer_type='lrelu'))
+      else:
+        self.enc_a = networks.E_attr(opts.input_dim_a, opts.input_dim_b, self.nz)
+
+      # generator
+      if self.concat:
+        self.gen = networks.G_concat(opts.input_dim_a, opts.input_dim_b, nz=self.nz, fold_z=opts.fold_z)
+      else:
+        self.gen = networks.G(opts.input_dim_a, opts.input_dim_b, nz=self.nz, fold_z=opts.fold_z)
+
+  def setdevice(self, device):
+    self.device = torch.device(device)
+    self.enc_c.to(self.device)
+    self.enc_a.to(self.device)
+    self.gen.to(self.device)
+
+  def autocast(self):
+    # bf16 autocast for --precision bf16, norms and losses are computed in float32 regardless
+    return torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.precision == 'bf16')
+
+  def get_z_random(self, batchSize, nz, random_type='gauss'):
+    z = torch.randn(batchSize, nz, device=self.device)
+    return z
+
+  def test_forward(self, image, a2b=True):
+    # the test methods keep their intermediates local, so that threads can share one model
+    z_random = self.get_z_random(image.size(0), self.nz, 'gauss')
+    with self.autocast():
+      if a2b:
+        z_content = self.enc_c.forward_a(image)
+        output = self.gen.forward_b(z_content, z_random)
+      else:
+        z_content = self.enc_c.forward_b(image)
+        output = self.gen.forward_a(z_content, z_random)
+    return output.float()
+
+  def test_forward_multi(self, image, num, a2b=True):
+    z_random = self.get_z_random(image.size(0) * num, self.nz, 'gauss')
+    return self.test_forward_attr(image, z_random.view(image.size(0), num, self.nz), a2b=a2b)
+
+  def test_forward_attr(self, image, z_attr, a2b=True):
+    # encode the content once and decode it with every attribute code in z_attr (batch x num x nz)
+    with self.autocast():
+      if a2b:
+        z_content = self.enc_c.forward_a(image)
+      else:
+        z_content = self.enc_c.forward_b(image)
+      z_content, z_attr_flat = self.tile_attr(z_content, z_attr)
+      if a2b:
+        output = self.gen.forward_b(z_content, z_attr_flat)
+      else:
+        output = self.gen.forward_a(z_content, z_attr_flat)
+    return output.float().view(*z_attr.size()[:2], *output.size()[1:])
+
+  def encode_attr(self, image, a2b=True):
+    # attribute code statistics of reference images from the target domain
+    with self.autocast():
+      if self.concat:
+        if a2b:
+          mu, logvar = self.enc_a.forward_b(image)
+        else:
+          mu, logvar = self.enc_a.forward_a(image)
+        return mu.float(), logvar.float()
+      if a2b:
+        z_attr = self.enc_a.forward_b(image)
+      else:
+        z_attr = self.enc_a.forward_a(image)
+    return z_attr.float(), None
+
+  def test_forward_transfer(self, image_a, image_b, a2b=True):
+    with self.autocast():
+      z_content_a, z_content_b = self.enc_c.forward(image_a, image_b)
+      if self.concat:
+        mu_a, logvar_a, mu_b, logvar_b = self.enc_a.forward(image_a, image_b)
+        std_a = logvar_a.mul(0.5).exp_()
+        eps = self.get_z_random(std_a.size(0), std_a.size(1), 'gauss')
+        z_attr_a = eps.mul(std_a).add_(mu_a)
+        std_b = logvar_b.mul(0.5).exp_()
+        eps = self.get_z_random(std_b.size(0), std_b.size(1), 'gauss')
+        z_attr_b = eps.mul(std_b).add_(mu_b)
+      else:
+        z_attr_a, z_attr_b = self.enc_a.forward(image_a, image_b)
+      if a2b:
+        output = self.gen.forward_b(z_content_a, z_attr_b)
+      else:
+        output = self.gen.forward_a(z_content_b, z_attr_a)
+    return output.float()
+
+  def resume(self, model_dir):
+    # reads an inference export or a training checkpoint. Both are memory-mapped where possible, so
+    # the discriminator and optimizer state of a training checkpoint is never read from disk
+    self.resume_state(load_checkpoint(model_dir))
+
+  def resume_state(self, checkpoint):
+    # takes over the encoders and the generator of an already loaded export or training checkpoint
+    if checkpoint.get('format') == 'drit_inference' and checkpoint['concat'] != bool(self.concat):
+      raise ValueError('the checkpoint was exported with concat %d' % checkpoint['concat'])
+    for name in ['enc_c', 'enc_a', 'gen']:
+      state = dict((key, value.float() if value.is_floating_point() else value) for key, value in checkpoint[name].items())
+      getattr(self, name).load_state_dict(state, assign=True)
+
+class DRIT(DRITInference):
   def __init__(self, opts):
-    super(DRIT, self).__init__()
+    super(DRIT, self).__init__(opts, meta=False)
 
     # parameters
     lr = 0.0001
     lr_dcontent = lr / 2.5
-    self.nz = 8
-    self.concat = opts.concat
     self.no_ms = opts.no_ms
 
     # discriminators
@@ -26,29 +182,30 @@ class DRIT(nn.Module):
       self.disB2 = networks.Dis(opts.input_dim_b, norm=opts.dis_norm, sn=opts.dis_spectral_norm)
     self.disContent = networks.Dis_content()
 
-    # encoders
-    self.enc_c = networks.E_content(opts.input_dim_a, opts.input_dim_b)
-    if self.concat:
-      self.enc_a = networks.E_attr_concat(opts.input_dim_a, opts.input_dim_b, self.nz, \
-          norm_layer=None, nl_layer=networks.get_non_linearity(layer_type='lrelu'))
-    else:
-      self.enc_a = networks.E_attr(opts.input_dim_a, opts.input_dim_b, self.nz)
-
-    # generator
-    if self.concat:
-      self.gen = networks.G_concat(opts.input_dim_a, opts.input_dim_b, nz=self.nz)
-    else:
-      self.gen = networks.G(opts.input_dim_a, opts.input_dim_b, nz=self.nz)
-
-    # optimizers
-    self.disA_opt = torch.optim.Adam(self.disA.parameters(), lr=lr, betas=(0.5, 0.999), weight_decay=0.0001)
-    self.disB_opt = torch.optim.Adam(self.disB.parameters(), lr=lr, betas=(0.5, 0.999), weight_decay=0.0001)
-    self.disA2_opt = torch.optim.Adam(self.disA2.parameters(), lr=lr, betas=(0.5, 0.999), weight_decay=0.0001)
-    self.disB2_opt = torch.optim.Adam(self.disB2.parameters(), lr=lr, betas=(0.5, 0.999), weight_decay=0.0001)
-    self.disContent_opt = torch.optim.Adam(self.disContent.parameters(), lr=lr_dcontent, betas=(0.5, 0.999), weight_decay=0.0001)
-    self.enc_c_opt = torch.optim.Adam(self.enc_c.parameters(), lr=lr, betas=(0.5, 0.999), weight_decay=0.0001)
-    self.enc_a_opt = torch.optim.Adam(self.enc_a.parameters(), lr=lr, betas=(0.5, 0.999), weight_decay=0.0001)
-    self.gen_opt = torch.optim.Adam(self.gen.parameters(), lr=lr, betas=(0.5, 0.999), weight_decay=0.0001)
+    # discriminators fed equally sized batches of equal depth can run stacked as one network
+    self.dis_stacks = []
+    if opts.stack_dis:
+      n_fake2 = 1 if self.no_ms else 2
+      buckets = {}
+      for name, input_dim, n_fake in [('disA', opts.input_dim_a, 1), ('disB', opts.input_dim_b, 1), ('disA2', opts.input_dim_a, n_fake2), ('disB2', opts.input_dim_b, n_fake2)]:
+        buckets.setdefault((input_dim, n_fake), []).append(name)
+      for names in sorted(buckets.values()):
+        self.dis_stacks.append((names, networks.StackedDis([getattr(self, name) for name in names])))
+
+    # activation checkpointing of the encoder and generator blocks
+    for net in [self.enc_c, self.enc_a, self.gen]:
+      networks.set_checkpoint(net, opts.checkpoint)
+
+    # optimizers, one parameter group per network
+    self.opt = networks.FlatAdam([
+        {'name': 'disA', 'params': self.disA.parameters()},
+        {'name': 'disB', 'params': self.disB.parameters()},
+        {'name': 'disA2', 'params': self.disA2.parameters()},
+        {'name': 'disB2', 'params': self.disB2.parameters()},
+        {'name': 'disContent', 'params': self.disContent.parameters(), 'lr': lr_dcontent, 'max_grad_norm': 5},
+        {'name': 'enc_c', 'params': self.enc_c.parameters()},
+        {'name': 'enc_a', 'params': self.enc_a.parameters()},
+        {'name': 'gen', 'params': self.gen.parameters()}], lr=lr, betas=(0.5, 0.999), weight_decay=0.0001)
 
     # Setup the loss function for training
     self.criterionL1 = torch.nn.L1Loss()
@@ -64,61 +221,19 @@ class DRIT(nn.Module):
     self.enc_a.apply(networks.gaussian_weights_init)
 
   def set_scheduler(self, opts, last_ep=0):
-    self.disA_sch = networks.get_scheduler(self.disA_opt, opts, last_ep)
-    self.disB_sch = networks.get_scheduler(self.disB_opt, opts, last_ep)
-    self.disA2_sch = networks.get_scheduler(self.disA2_opt, opts, last_ep)
-    self.disB2_sch = networks.get_scheduler(self.disB2_opt, opts, last_ep)
-    self.disContent_sch = networks.get_scheduler(self.disContent_opt, opts, last_ep)
-    self.enc_c_sch = networks.get_scheduler(self.enc_c_opt, opts, last_ep)
-    self.enc_a_sch = networks.get_scheduler(self.enc_a_opt, opts, last_ep)
-    self.gen_sch = networks.get_scheduler(self.gen_opt, opts, last_ep)
-
-  def setgpu(self, gpu):
-    self.gpu = gpu
-    self.disA.cuda(self.gpu)
-    self.disB.cuda(self.gpu)
-    self.disA2.cuda(self.gpu)
-    self.disB2.cuda(self.gpu)
-    self.disContent.cuda(self.gpu)
-    self.enc_c.cuda(self.gpu)
-    self.enc_a.cuda(self.gpu)
-    self.gen.cuda(self.gpu)
-
-  def get_z_random(self, batchSize, nz, random_type='gauss'):
-    z = torch.randn(batchSize, nz).cuda(self.gpu)
-    return z
+    self.sch = networks.get_scheduler(self.opt, opts, last_ep)
 
-  def test_forward(self, image, a2b=True):
-    self.z_random = self.get_z_random(image.size(0), self.nz, 'gauss')
-    if a2b:
-        self.z_content = self.enc_c.forward_a(image)
-        output = self.gen.forward_b(self.z_content, self.z_random)
-    else:
-        self.z_content = self.enc_c.forward_b(image)
-        output = self.gen.forward_a(self.z_content, self.z_random)
-    return output
-
-  def test_forward_transfer(self, image_a, image_b, a2b=True):
-    self.z_content_a, self.z_content_b = self.enc_c.forward(image_a, image_b)
-    if self.concat:
-      self.mu_a, self.logvar_a, self.mu_b, self.logvar_b = self.enc_a.forward(image_a, image_b)
-      std_a = self.logvar_a.mul(0.5).exp_()
-      eps = self.get_z_random(std_a.size(0), std_a.size(1), 'gauss')
-      self.z_attr_a = eps.mul(std_a).add_(self.mu_a)
-      std_b = self.logvar_b.mul(0.5).exp_()
-      eps = self.get_z_random(std_b.size(0), std_b.size(1), 'gauss')
-      self.z_attr_b = eps.mul(std_b).add_(self.mu_b)
-    else:
-      self.z_attr_a, self.z_attr_b = self.enc_a.forward(image_a, image_b)
-    if a2b:
-      output = self.gen.forward_b(self.z_content_a, self.z_attr_b)
-    else:
-      output = self.gen.forward_a(self.z_content_b, self.z_attr_a)
-    return output
+  def setdevice(self, device):
+    super(DRIT, self).setdevice(device)
+    self.disA.to(self.device)
+    self.disB.to(self.device)
+    self.disA2.to(self.device)
+    self.disB2.to(self.device)
+    self.disContent.to(self.device)
 
   def forward(self):
-    # input images
-    half_size = 1
+    # input images, the first half is encoded and the second half is random
+    half_size = self.input_A.size(0) // 2
     real_A = self.input_A
     real_B = self.input_B
     self.real_A_encoded = real_A[0:half_size]
@@ -146,14 +261,13 @@ class DRIT(nn.Module):
     if not self.no_ms:
       self.z_random2 = self.get_z_random(self.real_A_encoded.size(0), self.nz, 'gauss')
 
-    # first cross translation
+    # first cross translation, both domains in one generator call
     if not self.no_ms:
       input_content_forA = torch.cat((self.z_content_b, self.z_content_a, self.z_content_b, self.z_content_b),0)
       input_content_forB = torch.cat((self.z_content_a, self.z_content_b, self.z_content_a, self.z_content_a),0)
       input_attr_forA = torch.cat((self.z_attr_a, self.z_attr_a, self.z_random, self.z_random2),0)
       input_attr_forB = torch.cat((self.z_attr_b, self.z_attr_b, self.z_random, self.z_random2),0)
-      output_fakeA = self.gen.forward_a(input_content_forA, input_attr_forA)
-      output_fakeB = self.gen.forward_b(input_content_forB, input_attr_forB)
+      output_fakeA, output_fakeB = self.gen.forward(input_content_forA, input_attr_forA, input_content_forB, input_attr_forB)
       self.fake_A_encoded, self.fake_AA_encoded, self.fake_A_random, self.fake_A_random2 = torch.split(output_fakeA, self.z_content_a.size(0), dim=0)
       self.fake_B_encoded, self.fake_BB_encoded, self.fake_B_random, self.fake_B_random2 = torch.split(output_fakeB, self.z_content_a.size(0), dim=0)
     else:
@@ -161,17 +275,25 @@ class DRIT(nn.Module):
       input_content_forB = torch.cat((self.z_content_a, self.z_content_b, self.z_content_a),0)
       input_attr_forA = torch.cat((self.z_attr_a, self.z_attr_a, self.z_random),0)
       input_attr_forB = torch.cat((self.z_attr_b, self.z_attr_b, self.z_random),0)
-      output_fakeA = self.gen.forward_a(input_content_forA, input_attr_forA)
-      output_fakeB = self.gen.forward_b(input_content_forB, input_attr_forB)
+      output_fakeA, output_fakeB = self.gen.forward(input_content_forA, input_attr_forA, input_content_forB, input_attr_forB)
       self.fake_A_encoded, self.fake_AA_encoded, self.fake_A_random = torch.split(output_fakeA, self.z_content_a.size(0), dim=0)
       self.fake_B_encoded, self.fake_BB_encoded, self.fake_B_random = torch.split(output_fakeB, self.z_content_a.size(0), dim=0)
 
     # get reconstructed encoded z_c
     self.z_content_recon_b, self.z_content_recon_a = self.enc_c.forward(self.fake_A_encoded, self.fake_B_encoded)
 
-    # get reconstructed encoded z_a
+    # get reconstructed encoded z_a, and the attributes of the random fakes for latent regression, in one call.
+    # The input is sliced from the generator output rather than built from fake_*_random, which keeps the
+    # random fakes a cut of the graph for backward_G_alone
+    n = self.z_content_a.size(0)
+    fake_A = torch.cat((output_fakeA[0:n], output_fakeA[2*n:3*n]),0)
+    fake_B = torch.cat((output_fakeB[0:n], output_fakeB[2*n:3*n]),0)
     if self.concat:
-      self.mu_recon_a, self.logvar_recon_a, self.mu_recon_b, self.logvar_recon_b = self.enc_a.forward(self.fake_A_encoded, self.fake_B_encoded)
+      mu_a, logvar_a, mu_b, logvar_b = self.enc_a.forward(fake_A, fake_B)
+      self.mu_recon_a, self.mu2_a = torch.split(mu_a, self.z_content_a.size(0), dim=0)
+      self.mu_recon_b, self.mu2_b = torch.split(mu_b, self.z_content_a.size(0), dim=0)
+      self.logvar_recon_a = logvar_a[0:self.z_content_a.size(0)]
+      self.logvar_recon_b = logvar_b[0:self.z_content_a.size(0)]
       std_a = self.logvar_recon_a.mul(0.5).exp_()
       eps_a = self.get_z_random(std_a.size(0), std_a.size(1), 'gauss')
       self.z_attr_recon_a = eps_a.mul(std_a).add_(self.mu_recon_a)
@@ -179,26 +301,21 @@ class DRIT(nn.Module):
       eps_b = self.get_z_random(std_b.size(0), std_b.size(1), 'gauss')
       self.z_attr_recon_b = eps_b.mul(std_b).add_(self.mu_recon_b)
     else:
-      self.z_attr_recon_a, self.z_attr_recon_b = self.enc_a.forward(self.fake_A_encoded, self.fake_B_encoded)
+      z_attr_a, z_attr_b = self.enc_a.forward(fake_A, fake_B)
+      self.z_attr_recon_a, self.z_attr_random_a = torch.split(z_attr_a, self.z_content_a.size(0), dim=0)
+      self.z_attr_recon_b, self.z_attr_random_b = torch.split(z_attr_b, self.z_content_a.size(0), dim=0)
 
     # second cross translation
-    self.fake_A_recon = self.gen.forward_a(self.z_content_recon_a, self.z_attr_recon_a)
-    self.fake_B_recon = self.gen.forward_b(self.z_content_recon_b, self.z_attr_recon_b)
+    self.fake_A_recon, self.fake_B_recon = self.gen.forward(self.z_content_recon_a, self.z_attr_recon_a, self.z_content_recon_b, self.z_attr_recon_b)
 
     # for display
     self.image_display = torch.cat((self.real_A_encoded[0:1].detach().cpu(), self.fake_B_encoded[0:1].detach().cpu(), \
                                     self.fake_B_random[0:1].detach().cpu(), self.fake_AA_encoded[0:1].detach().cpu(), self.fake_A_recon[0:1].detach().cpu(), \
                                     self.real_B_encoded[0:1].detach().cpu(), self.fake_A_encoded[0:1].detach().cpu(), \
-                                    self.fake_A_random[0:1].detach().cpu(), self.fake_BB_encoded[0:1].detach().cpu(), self.fake_B_recon[0:1].detach().cpu()), dim=0)
-
-    # for latent regression
-    if self.concat:
-      self.mu2_a, _, self.mu2_b, _ = self.enc_a.forward(self.fake_A_random, self.fake_B_random)
-    else:
-      self.z_attr_random_a, self.z_attr_random_b = self.enc_a.forward(self.fake_A_random, self.fake_B_random)
+                                    self.fake_A_random[0:1].detach().cpu(), self.fake_BB_encoded[0:1].detach().cpu(), self.fake_B_recon[0:1].detach().cpu()), dim=0).float()
 
   def forward_content(self):
-    half_size = 1
+    half_size = self.input_A.size(0) // 2
     self.real_A_encoded = self.input_A[0:half_size]
     self.real_B_encoded = self.input_B[0:half_size]
     # get encoded z_c
@@ -207,102 +324,146 @@ class DRIT(nn.Module):
   def update_D_content(self, image_a, image_b):
     self.input_A = image_a
     self.input_B = image_b
-    self.forward_content()
-    self.disContent_opt.zero_grad()
+    self.opt.zero_grad(names=['disContent'])
+    # autocast covers the forward passes and losses, the backward passes run outside of it
+    with self.autocast():
+      self.forward_content()
     loss_D_Content = self.backward_contentD(self.z_content_a, self.z_content_b)
     self.disContent_loss = loss_D_Content.item()
-    nn.utils.clip_grad_norm_(self.disContent.parameters(), 5)
-    self.disContent_opt.step()
+    self.opt.step(names=['disContent'])
 
   def update_D(self, image_a, image_b):
     self.input_A = image_a
     self.input_B = image_b
-    self.forward()
 
-    # update disA
-    self.disA_opt.zero_grad()
+    # the discriminators are independent, so all of them are updated in one optimizer step
+    names = ['disA', 'disA2', 'disB', 'disB2', 'disContent']
+    self.opt.zero_grad(names=names)
+    with self.autocast():
+      self.forward()
+    if self.dis_stacks:
+      losses = self.backward_D_stacked()
+      for name in losses:
+        setattr(self, name + '_loss', losses[name].item())
+    else:
+      self.backward_D_separate()
+    loss_D_Content = self.backward_contentD(self.z_content_a, self.z_content_b)
+    self.disContent_loss = loss_D_Content.item()
+    self.opt.step(names=names)
+
+  def backward_D_separate(self):
+    # disA
     loss_D1_A = self.backward_D(self.disA, self.real_A_encoded, self.fake_A_encoded)
     self.disA_loss = loss_D1_A.item()
-    self.disA_opt.step()
 
-    # update disA2
-    self.disA2_opt.zero_grad()
-    loss_D2_A = self.backward_D(self.disA2, self.real_A_random, self.fake_A_random)
-    self.disA2_loss = loss_D2_A.item()
+    # disA2
     if not self.no_ms:
-      loss_D2_A2 = self.backward_D(self.disA2, self.real_A_random, self.fake_A_random2)
-      self.disA2_loss += loss_D2_A2.item()
-    self.disA2_opt.step()
+      loss_D2_A = self.backward_D(self.disA2, self.real_A_random, self.fake_A_random, self.fake_A_random2)
+    else:
+      loss_D2_A = self.backward_D(self.disA2, self.real_A_random, self.fake_A_random)
+    self.disA2_loss = loss_D2_A.item()
 
-    # update disB
-    self.disB_opt.zero_grad()
+    # disB
     loss_D1_B = self.backward_D(self.disB, self.real_B_encoded, self.fake_B_encoded)
     self.disB_loss = loss_D1_B.item()
-    self.disB_opt.step()
 
-    # update disB2
-    self.disB2_opt.zero_grad()
-    loss_D2_B = self.backward_D(self.disB2, self.real_B_random, self.fake_B_random)
-    self.disB2_loss = loss_D2_B.item()
+    # disB2
     if not self.no_ms:
-      loss_D2_B2 = self.backward_D(self.disB2, self.real_B_random, self.fake_B_random2)
-      self.disB2_loss += loss_D2_B2.item()
-    self.disB2_opt.step()
+      loss_D2_B = self.backward_D(self.disB2, self.real_B_random, self.fake_B_random, self.fake_B_random2)
+    else:
+      loss_D2_B = self.backward_D(self.disB2, self.real_B_random, self.fake_B_random)
+    self.disB2_loss = loss_D2_B.item()
 
-    # update disContent
-    self.disContent_opt.zero_grad()
-    loss_D_Content = self.backward_contentD(self.z_content_a, self.z_content_b)
-    self.disContent_loss = loss_D_Content.item()
-    nn.utils.clip_grad_norm_(self.disContent.parameters(), 5)
-    self.disContent_opt.step()
+  def backward_D(self, netD, real, *fakes):
+    # real and fake images go through the discriminator in a single pass
+    inputs = [fake.detach() for fake in fakes] + [real]
+    with self.autocast():
+      pred = netD.forward(torch.cat(inputs, 0))
+      loss_D = self._D_loss(pred, [x.size(0) for x in inputs])
+    loss_D.backward()
+    return loss_D
 
-  def backward_D(self, netD, real, fake):
-    pred_fake = netD.forward(fake.detach())
-    pred_real = netD.forward(real)
+  def backward_D_stacked(self):
+    # every stack of discriminators runs in one pass and all of them share one backward
+    fakes_A2 = [self.fake_A_random] if self.no_ms else [self.fake_A_random, self.fake_A_random2]
+    fakes_B2 = [self.fake_B_random] if self.no_ms else [self.fake_B_random, self.fake_B_random2]
+    dis_inputs = {'disA': [self.fake_A_encoded, self.real_A_encoded], 'disB': [self.fake_B_encoded, self.real_B_encoded], \
+                  'disA2': fakes_A2 + [self.real_A_random], 'disB2': fakes_B2 + [self.real_B_random]}
+    losses = {}
+    with self.autocast():
+      for names, stack in self.dis_stacks:
+        inputs = [[x.detach() for x in dis_inputs[name]] for name in names]
+        preds = stack.forward([torch.cat(x, 0) for x in inputs])
+        for name, x, pred in zip(names, inputs, preds):
+          losses[name] = self._D_loss(pred, [y.size(0) for y in x])
+    sum(losses.values()).backward()
+    return losses
+
+  def _D_loss(self, pred, sizes):
+    # pred holds the fake batches followed by the real batch, split by sizes
     loss_D = 0
-    for it, (out_a, out_b) in enumerate(zip(pred_fake, pred_real)):
-      out_fake = nn.functional.sigmoid(out_a)
-      out_real = nn.functional.sigmoid(out_b)
-      all0 = torch.zeros_like(out_fake).cuda(self.gpu)
-      all1 = torch.ones_like(out_real).cuda(self.gpu)
-      ad_fake_loss = nn.functional.binary_cross_entropy(out_fake, all0)
-      ad_true_loss = nn.functional.binary_cross_entropy(out_real, all1)
-      loss_D += ad_true_loss + ad_fake_loss
-    loss_D.backward()
+    for out in pred:
+      outs = torch.split(out, [out.size(0) // sum(sizes) * n for n in sizes], dim=0)
+      for out_fake in outs[:-1]:
+        ad_fake_loss = self._bce_logits(out_fake, 0)
+        ad_true_loss = self._bce_logits(outs[-1], 1)
+        loss_D += ad_true_loss + ad_fake_loss
     return loss_D
 
   def backward_contentD(self, imageA, imageB):
-    pred_fake = self.disContent.forward(imageA.detach())
-    pred_real = self.disContent.forward(imageB.detach())
-    for it, (out_a, out_b) in enumerate(zip(pred_fake, pred_real)):
-      out_fake = nn.functional.sigmoid(out_a)
-      out_real = nn.functional.sigmoid(out_b)
-      all1 = torch.ones((out_real.size(0))).cuda(self.gpu)
-      all0 = torch.zeros((out_fake.size(0))).cuda(self.gpu)
-      ad_true_loss = nn.functional.binary_cross_entropy(out_real, all1)
-      ad_fake_loss = nn.functional.binary_cross_entropy(out_fake, all0)
-    loss_D = ad_true_loss + ad_fake_loss
+    with self.autocast():
+      pred = self.disContent.forward(torch.cat((imageA.detach(), imageB.detach()), 0))
+      for out in pred:
+        out_fake, out_real = torch.split(out, [imageA.size(0), imageB.size(0)], dim=0)
+        ad_true_loss = self._bce_logits(out_real, 1)
+        ad_fake_loss = self._bce_logits(out_fake, 0)
+      loss_D = ad_true_loss + ad_fake_loss
     loss_D.backward()
     return loss_D
 
   def update_EG(self):
-    # update G, Ec, Ea
-    self.enc_c_opt.zero_grad()
-    self.enc_a_opt.zero_grad()
-    self.gen_opt.zero_grad()
+    # both loss groups are differentiated at the same forward pass. The G-only losses go first and
+    # only retain the part of the graph shared with the main loss, the main backward then frees it
+    self.opt.zero_grad(names=['enc_c', 'enc_a', 'gen'])
+    grads_alone = self.backward_G_alone()
     self.backward_EG()
-    self.enc_c_opt.step()
-    self.enc_a_opt.step()
-    self.gen_opt.step()
+
+    # update G, Ec, Ea
+    self.opt.step(names=['enc_c', 'enc_a', 'gen'])
 
     # update G, Ec
-    self.enc_c_opt.zero_grad()
-    self.gen_opt.zero_grad()
-    self.backward_G_alone()
-    self.enc_c_opt.step()
-    self.gen_opt.step()
+    self.opt.zero_grad(names=['enc_c', 'gen'])
+    for p, grad in zip(list(self.enc_c.parameters()) + list(self.gen.parameters()), grads_alone):
+      if grad is not None:
+        p.grad.copy_(grad)
+    self.opt.step(names=['enc_c', 'gen'])
 
   def backward_EG(self):
+    with self.autocast():
+      loss_G = self.loss_EG()
+    loss_G.backward(inputs=list(self.enc_c.parameters()) + list(self.enc_a.parameters()) + list(self.gen.parameters()))
+
+  def backward_G_alone(self):
+    # gradients of the G-only losses for Ec and G, without accumulating them into .grad. The random
+    # fakes and their attribute codes come out of generator and encoder calls shared with the main
+    # loss, so the losses are first differentiated up to them, which frees the graph only they use,
+    # and the shared part is retained for backward_EG
+    with self.autocast():
+      loss_z_L1 = self.loss_G_alone()
+    outputs = [self.fake_A_random, self.fake_B_random]
+    if not self.no_ms:
+      outputs += [self.fake_A_random2, self.fake_B_random2]
+    if self.concat:
+      outputs += [self.mu2_a, self.mu2_b]
+    else:
+      outputs += [self.z_attr_random_a, self.z_attr_random_b]
+    grads_outputs = torch.autograd.grad(loss_z_L1, outputs, allow_unused=True)
+    outputs = [(z, grad) for z, grad in zip(outputs, grads_outputs) if grad is not None]
+    params = list(self.enc_c.parameters()) + list(self.gen.parameters())
+    grads = torch.autograd.grad([z for z, _ in outputs], params, [grad for _, grad in outputs], retain_graph=True, allow_unused=True)
+    return list(grads)
+
+  def loss_EG(self):
     # content Ladv for generator
     loss_G_GAN_Acontent = self.backward_G_GAN_content(self.z_content_a)
     loss_G_GAN_Bcontent = self.backward_G_GAN_content(self.z_content_b)
@@ -313,10 +474,13 @@ class DRIT(nn.Module):
 
     # KL loss - z_a
     if self.concat:
-      kl_element_a = self.mu_a.pow(2).add_(self.logvar_a.exp()).mul_(-1).add_(1).add_(self.logvar_a)
-      loss_kl_za_a = torch.sum(kl_element_a).mul_(-0.5) * 0.01
-      kl_element_b = self.mu_b.pow(2).add_(self.logvar_b.exp()).mul_(-1).add_(1).add_(self.logvar_b)
-      loss_kl_za_b = torch.sum(kl_element_b).mul_(-0.5) * 0.01
+      mu_a, logvar_a, mu_b, logvar_b = self.mu_a.float(), self.logvar_a.float(), self.mu_b.float(), self.logvar_b.float()
+      # summed over the code, averaged over the samples like the other terms. The weight is unchanged
+      # for the original batch size of 2, whose encoded half is a single sample
+      kl_element_a = mu_a.pow(2).add_(logvar_a.exp()).mul_(-1).add_(1).add_(logvar_a)
+      loss_kl_za_a = torch.sum(kl_element_a).mul_(-0.5 / mu_a.size(0)) * 0.01
+      kl_element_b = mu_b.pow(2).add_(logvar_b.exp()).mul_(-1).add_(1).add_(logvar_b)
+      loss_kl_za_b = torch.sum(kl_element_b).mul_(-0.5 / mu_b.size(0)) * 0.01
     else:
       loss_kl_za_a = self._l2_regularize(self.z_attr_a) * 0.01
       loss_kl_za_b = self._l2_regularize(self.z_attr_b) * 0.01
@@ -326,10 +490,10 @@ class DRIT(nn.Module):
     loss_kl_zc_b = self._l2_regularize(self.z_content_b) * 0.01
 
     # cross cycle consistency loss
-    loss_G_L1_A = self.criterionL1(self.fake_A_recon, self.real_A_encoded) * 10
-    loss_G_L1_B = self.criterionL1(self.fake_B_recon, self.real_B_encoded) * 10
-    loss_G_L1_AA = self.criterionL1(self.fake_AA_encoded, self.real_A_encoded) * 10
-    loss_G_L1_BB = self.criterionL1(self.fake_BB_encoded, self.real_B_encoded) * 10
+    loss_G_L1_A = self.criterionL1(self.fake_A_recon.float(), self.real_A_encoded) * 10
+    loss_G_L1_B = self.criterionL1(self.fake_B_recon.float(), self.real_B_encoded) * 10
+    loss_G_L1_AA = self.criterionL1(self.fake_AA_encoded.float(), self.real_A_encoded) * 10
+    loss_G_L1_BB = self.criterionL1(self.fake_BB_encoded.float(), self.real_B_encoded) * 10
 
     loss_G = loss_G_GAN_A + loss_G_GAN_B + \
              loss_G_GAN_Acontent + loss_G_GAN_Bcontent + \
@@ -338,8 +502,6 @@ class DRIT(nn.Module):
              loss_kl_zc_a + loss_kl_zc_b + \
              loss_kl_za_a + loss_kl_za_b
 
-    loss_G.backward(retain_graph=True)
-
     self.gan_loss_a = loss_G_GAN_A.item()
     self.gan_loss_b = loss_G_GAN_B.item()
     self.gan_loss_acontent = loss_G_GAN_Acontent.item()
@@ -353,25 +515,22 @@ class DRIT(nn.Module):
     self.l1_recon_AA_loss = loss_G_L1_AA.item()
     self.l1_recon_BB_loss = loss_G_L1_BB.item()
     self.G_loss = loss_G.item()
+    return loss_G
 
   def backward_G_GAN_content(self, data):
     outs = self.disContent.forward(data)
     for out in outs:
-      outputs_fake = nn.functional.sigmoid(out)
-      all_half = 0.5*torch.ones((outputs_fake.size(0))).cuda(self.gpu)
-      ad_loss = nn.functional.binary_cross_entropy(outputs_fake, all_half)
+      ad_loss = self._bce_logits(out, 0.5)
     return ad_loss
 
   def backward_G_GAN(self, fake, netD=None):
     outs_fake = netD.forward(fake)
     loss_G = 0
     for out_a in outs_fake:
-      outputs_fake = nn.functional.sigmoid(out_a)
-      all_ones = torch.ones_like(outputs_fake).cuda(self.gpu)
-      loss_G += nn.functional.binary_cross_entropy(outputs_fake, all_ones)
+      loss_G += self._bce_logits(out_a, 1)
     return loss_G
 
-  def backward_G_alone(self):
+  def loss_G_alone(self):
     # Ladv for generator
     loss_G_GAN2_A = self.backward_G_GAN(self.fake_A_random, self.disA2)
     loss_G_GAN2_B = self.backward_G_GAN(self.fake_B_random, self.disB2)
@@ -381,8 +540,8 @@ class DRIT(nn.Module):
 
     # mode seeking loss for A-->B and B-->A
     if not self.no_ms:
-      lz_AB = torch.mean(torch.abs(self.fake_B_random2 - self.fake_B_random)) / torch.mean(torch.abs(self.z_random2 - self.z_random))
-      lz_BA = torch.mean(torch.abs(self.fake_A_random2 - self.fake_A_random)) / torch.mean(torch.abs(self.z_random2 - self.z_random))
+      lz_AB = torch.mean(torch.abs(self.fake_B_random2.float() - self.fake_B_random.float())) / torch.mean(torch.abs(self.z_random2 - self.z_random))
+      lz_BA = torch.mean(torch.abs(self.fake_A_random2.float() - self.fake_A_random.float())) / torch.mean(torch.abs(self.z_random2 - self.z_random))
       eps = 1 * 1e-5
       loss_lz_AB = 1 / (lz_AB + eps)
       loss_lz_BA = 1 / (lz_BA + eps)
@@ -398,7 +557,6 @@ class DRIT(nn.Module):
     if not self.no_ms:
       loss_z_L1 += (loss_G_GAN2_A2 + loss_G_GAN2_B2)
       loss_z_L1 += (loss_lz_AB + loss_lz_BA)
-    loss_z_L1.backward()
     self.l1_recon_z_loss_a = loss_z_L1_a.item()
     self.l1_recon_z_loss_b = loss_z_L1_b.item()
     if not self.no_ms:
@@ -409,23 +567,24 @@ class DRIT(nn.Module):
     else:
       self.gan2_loss_a = loss_G_GAN2_A.item()
       self.gan2_loss_b = loss_G_GAN2_B.item()
+    return loss_z_L1
   def update_lr(self):
-    self.disA_sch.step()
-    self.disB_sch.step()
-    self.disA2_sch.step()
-    self.disB2_sch.step()
-    self.disContent_sch.step()
-    self.enc_c_sch.step()
-    self.enc_a_sch.step()
-    self.gen_sch.step()
+    self.sch.step()
+
+  def _bce_logits(self, logits, target):
+    # binary cross entropy of sigmoid(logits) against a constant target, without materializing the target
+    logits = logits.float()
+    if target == 1:
+      return nn.functional.softplus(-logits).mean()
+    return (nn.functional.softplus(logits) - target * logits).mean()
 
   def _l2_regularize(self, mu):
-    mu_2 = torch.pow(mu, 2)
+    mu_2 = torch.pow(mu.float(), 2)
     encoding_loss = torch.mean(mu_2)
     return encoding_loss
 
   def resume(self, model_dir, train=True):
-    checkpoint = torch.load(model_dir)
+    checkpoint = torch.load(model_dir, map_location=self.device)
     # weight
     if train:
       self.disA.load_state_dict(checkpoint['disA'])
@@ -438,38 +597,52 @@ class DRIT(nn.Module):
     self.gen.load_state_dict(checkpoint['gen'])
     # optimizer
     if train:
-      self.disA_opt.load_state_dict(checkpoint['disA_opt'])
-      self.disA2_opt.load_state_dict(checkpoint['disA2_opt'])
-      self.disB_opt.load_state_dict(checkpoint['disB_opt'])
-      self.disB2_opt.load_state_dict(checkpoint['disB2_opt'])
-      self.disContent_opt.load_state_dict(checkpoint['disContent_opt'])
-      self.enc_c_opt.load_state_dict(checkpoint['enc_c_opt'])
-      self.enc_a_opt.load_state_dict(checkpoint['enc_a_opt'])
-      self.gen_opt.load_state_dict(checkpoint['gen_opt'])
+      for name in self.opt.groups:
+        self.opt.load_group_state_dict(name, checkpoint[name + '_opt'])
     return checkpoint['ep'], checkpoint['total_it']
 
+  def checkpoint_state(self, ep, total_it, full=True):
+    # checkpoint copied to host memory, so that it can be written while the training goes on.
+    # Lightweight snapshots (full=False) hold the encoders and the generator only
+    if full:
+      state = {
+               'disA': self.disA.state_dict(),
+               'disA2': self.disA2.state_dict(),
+               'disB': self.disB.state_dict(),
+               'disB2': self.disB2.state_dict(),
+               'disContent': self.disContent.state_dict(),
+               'enc_c': self.enc_c.state_dict(),
+               'enc_a': self.enc_a.state_dict(),
+               'gen': self.gen.state_dict(),
+               'ep': ep,
+               'total_it': total_it
+                }
+      for name in self.opt.groups:
+        state[name + '_opt'] = self.opt.group_state_dict(name)
+    else:
+      state = {
+               'enc_c': self.enc_c.state_dict(),
+               'enc_a': self.enc_a.state_dict(),
+               'gen': self.gen.state_dict(),
+               'ep': ep,
+               'total_it': total_it
+                }
+    return self._to_host(state)
+
+  def _to_host(self, state):
+    if torch.is_tensor(state):
+      return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+      host = state.__class__((key, self._to_host(value)) for key, value in state.items())
+      if hasattr(state, '_metadata'):
+        host._metadata = state._metadata
+      return host
+    if isinstance(state, (list, tuple)):
+      return state.__class__(self._to_host(value) for value in state)
+    return state
+
   def save(self, filename, ep, total_it):
-    state = {
-             'disA': self.disA.state_dict(),
-             'disA2': self.disA2.state_dict(),
-             'disB': self.disB.state_dict(),
-             'disB2': self.disB2.state_dict(),
-             'disContent': self.disContent.state_dict(),
-             'enc_c': self.enc_c.state_dict(),
-             'enc_a': self.enc_a.state_dict(),
-             'gen': self.gen.state_dict(),
-             'disA_opt': self.disA_opt.state_dict(),
-             'disA2_opt': self.disA2_opt.state_dict(),
-             'disB_opt': self.disB_opt.state_dict(),
-             'disB2_opt': self.disB2_opt.state_dict(),
-             'disContent_opt': self.disContent_opt.state_dict(),
-             'enc_c_opt': self.enc_c_opt.state_dict(),
-             'enc_a_opt': self.enc_a_opt.state_dict(),
-             'gen_opt': self.gen_opt.state_dict(),
-             'ep': ep,
-             'total_it': total_it
-              }
-    torch.save(state, filename)
+    torch.save(self.checkpoint_state(ep, total_it), filename)
     return
 
   def assemble_outputs(self):
@@ -488,4 +661,4 @@ class DRIT(nn.Module):
     return torch.cat((row1,row2),2)
 
   def normalize_image(self, x):
-    return x[:,0:3,:,:]
+    return x[:,0:3,:,:].float()
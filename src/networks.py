@@ -1,8 +1,9 @@
 import  torch
 import torch.nn as nn
-from torch.autograd import Variable
 import functools
 from torch.optim import lr_scheduler
+from torch.utils.checkpoint import checkpoint
+import torch.distributed as dist
 import torch.nn.functional as F
 
 ####################################################################
@@ -77,9 +78,6 @@ class Dis(nn.Module):
       model += [nn.Conv2d(tch, 1, kernel_size=1, stride=1, padding=0)]  # 1
     return nn.Sequential(*model)
 
-  def cuda(self,gpu):
-    self.model.cuda(gpu)
-
   def forward(self, x_A):
     out_A = self.model(x_A)
     out_A = out_A.view(-1)
@@ -87,6 +85,56 @@ class Dis(nn.Module):
     outs_A.append(out_A)
     return outs_A
 
+class StackedDis():
+  # runs discriminators of the same architecture as one network: inputs are stacked along channels
+  # and every convolution becomes a grouped convolution over the concatenated member weights
+  def __init__(self, nets):
+    self.nets = nets
+    if isinstance(nets[0], MultiScaleDis):
+      self.downsample = nets[0].downsample
+      self.scales = [self._layers([net.Diss[i] for net in nets]) for i in range(len(nets[0].Diss))]
+    else:
+      self.downsample = None
+      self.scales = [self._layers([net.model for net in nets])]
+
+  def _layers(self, modules):
+    # matching leaf modules of every member, in execution order
+    children = [list(m.children()) for m in modules]
+    if not children[0]:
+      return [tuple(modules)]
+    layers = []
+    for group in zip(*children):
+      layers += self._layers(group)
+    return layers
+
+  def _weight(self, conv):
+    # spectral norm updates the weight in a forward pre-hook, which a functional call skips
+    for hook in conv._forward_pre_hooks.values():
+      hook(conv, None)
+    return conv.weight
+
+  def _run(self, layers, x):
+    for group in layers:
+      if isinstance(group[0], nn.Conv2d):
+        weight = torch.cat([self._weight(conv) for conv in group], 0)
+        bias = torch.cat([conv.bias for conv in group], 0)
+        x = F.conv2d(x, weight, bias, group[0].stride, group[0].padding, group[0].dilation, len(group))
+      else:
+        # padding, activations and pooling act per channel and carry no parameters
+        x = group[0](x)
+    return x
+
+  def forward(self, xs):
+    # xs holds one equally sized batch per member, returns the per-member discriminator outputs
+    x = torch.cat(xs, 1)
+    outs = [[] for _ in self.nets]
+    for layers in self.scales:
+      for out, out_net in zip(torch.chunk(self._run(layers, x), len(self.nets), dim=1), outs):
+        out_net.append(out if self.downsample is not None else out.reshape(-1))
+      if self.downsample is not None:
+        x = self.downsample(x)
+    return outs
+
 ####################################################################
 #---------------------------- Encoders -----------------------------
 ####################################################################
@@ -123,8 +171,7 @@ class E_content(nn.Module):
   def forward(self, xa, xb):
     outputA = self.convA(xa)
     outputB = self.convB(xb)
-    outputA = self.conv_share(outputA)
-    outputB = self.conv_share(outputB)
+    outputA, outputB = forward_shared(self.conv_share, outputA, outputB)
     return outputA, outputB
 
   def forward_a(self, xa):
@@ -255,17 +302,17 @@ class E_attr_concat(nn.Module):
 #--------------------------- Generators ----------------------------
 ####################################################################
 class G(nn.Module):
-  def __init__(self, output_dim_a, output_dim_b, nz):
+  def __init__(self, output_dim_a, output_dim_b, nz, fold_z=False):
     super(G, self).__init__()
     self.nz = nz
     ini_tch = 256
     tch_add = ini_tch
     tch = ini_tch
     self.tch_add = tch_add
-    self.decA1 = MisINSResBlock(tch, tch_add)
-    self.decA2 = MisINSResBlock(tch, tch_add)
-    self.decA3 = MisINSResBlock(tch, tch_add)
-    self.decA4 = MisINSResBlock(tch, tch_add)
+    self.decA1 = MisINSResBlock(tch, tch_add, fold_z=fold_z)
+    self.decA2 = MisINSResBlock(tch, tch_add, fold_z=fold_z)
+    self.decA3 = MisINSResBlock(tch, tch_add, fold_z=fold_z)
+    self.decA4 = MisINSResBlock(tch, tch_add, fold_z=fold_z)
 
     decA5 = []
     decA5 += [ReLUINSConvTranspose2d(tch, tch//2, kernel_size=3, stride=2, padding=1, output_padding=1)]
@@ -277,10 +324,10 @@ class G(nn.Module):
     self.decA5 = nn.Sequential(*decA5)
 
     tch = ini_tch
-    self.decB1 = MisINSResBlock(tch, tch_add)
-    self.decB2 = MisINSResBlock(tch, tch_add)
-    self.decB3 = MisINSResBlock(tch, tch_add)
-    self.decB4 = MisINSResBlock(tch, tch_add)
+    self.decB1 = MisINSResBlock(tch, tch_add, fold_z=fold_z)
+    self.decB2 = MisINSResBlock(tch, tch_add, fold_z=fold_z)
+    self.decB3 = MisINSResBlock(tch, tch_add, fold_z=fold_z)
+    self.decB4 = MisINSResBlock(tch, tch_add, fold_z=fold_z)
     decB5 = []
     decB5 += [ReLUINSConvTranspose2d(tch, tch//2, kernel_size=3, stride=2, padding=1, output_padding=1)]
     tch = tch//2
@@ -304,6 +351,10 @@ class G(nn.Module):
         nn.Linear(256, tch_add*4))
     return
 
+  def forward(self, xa, za, xb, zb):
+    # the decoders share no layers, so the domains run one after another
+    return self.forward_a(xa, za), self.forward_b(xb, zb)
+
   def forward_a(self, x, z):
     z = self.mlpA(z)
     z1, z2, z3, z4 = torch.split(z, self.tch_add, dim=1)
@@ -327,9 +378,10 @@ class G(nn.Module):
     return out
 
 class G_concat(nn.Module):
-  def __init__(self, output_dim_a, output_dim_b, nz):
+  def __init__(self, output_dim_a, output_dim_b, nz, fold_z=False):
     super(G_concat, self).__init__()
     self.nz = nz
+    self.fold_z = fold_z
     tch = 256
     dec_share = []
     dec_share += [INSResBlock(tch, tch)]
@@ -368,9 +420,21 @@ class G_concat(nn.Module):
     self.decB3 = nn.Sequential(*[decB3])
     self.decB4 = nn.Sequential(*decB4)
 
+  def forward(self, xa, za, xb, zb):
+    # both domains go through dec_share in one call
+    out0_a, out0_b = forward_shared(self.dec_share, xa, xb)
+    return self._decode_a(out0_a, za), self._decode_b(out0_b, zb)
+
   def forward_a(self, x, z):
-    out0 = self.dec_share(x)
-    z_img = z.view(z.size(0), z.size(1), 1, 1).expand(z.size(0), z.size(1), x.size(2), x.size(3))
+    return self._decode_a(self.dec_share(x), z)
+
+  def forward_b(self, x, z):
+    return self._decode_b(self.dec_share(x), z)
+
+  def _decode_a(self, out0, z):
+    if self.fold_z:
+      return self._decode_fold(out0, z, self.decA1, self.decA2, self.decA3, self.decA4)
+    z_img = z.view(z.size(0), z.size(1), 1, 1).expand(z.size(0), z.size(1), out0.size(2), out0.size(3))
     x_and_z = torch.cat([out0, z_img], 1)
     out1 = self.decA1(x_and_z)
     z_img2 = z.view(z.size(0), z.size(1), 1, 1).expand(z.size(0), z.size(1), out1.size(2), out1.size(3))
@@ -384,9 +448,10 @@ class G_concat(nn.Module):
     out4 = self.decA4(x_and_z4)
     return out4
 
-  def forward_b(self, x, z):
-    out0 = self.dec_share(x)
-    z_img = z.view(z.size(0), z.size(1), 1, 1).expand(z.size(0), z.size(1), x.size(2), x.size(3))
+  def _decode_b(self, out0, z):
+    if self.fold_z:
+      return self._decode_fold(out0, z, self.decB1, self.decB2, self.decB3, self.decB4)
+    z_img = z.view(z.size(0), z.size(1), 1, 1).expand(z.size(0), z.size(1), out0.size(2), out0.size(3))
     x_and_z = torch.cat([out0,  z_img], 1)
     out1 = self.decB1(x_and_z)
     z_img2 = z.view(z.size(0), z.size(1), 1, 1).expand(z.size(0), z.size(1), out1.size(2), out1.size(3))
@@ -400,6 +465,164 @@ class G_concat(nn.Module):
     out4 = self.decB4(x_and_z4)
     return out4
 
+  def _decode_fold(self, out0, z, dec1, dec2, dec3, dec4):
+    # same as concatenating z before every stage, with the z channels of the first layer of each stage
+    # folded into a per-sample bias. Only the first residual block of dec1 sees z directly
+    out1 = dec1[1:](dec1[0](out0, z))
+    out2 = dec2[0](out1, z)
+    out3 = dec3[0](out2, z)
+    out4 = dec4[1:](conv_transpose_z(dec4[0], out3, z))
+    return out4
+
+####################################################################
+#---------------------------- Optimizer ----------------------------
+####################################################################
+class FlatAdam(torch.optim.Optimizer):
+  # Adam over named parameter groups (one per network). The parameters, gradients and moments of
+  # a group live in contiguous flat buffers, so a step runs a few kernels per network instead of a
+  # few per parameter tensor. zero_grad and step act on all networks unless given their names
+  def __init__(self, groups, lr=0.001, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, max_grad_norm=None):
+    defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, max_grad_norm=max_grad_norm)
+    super(FlatAdam, self).__init__(groups, defaults)
+    self.groups = dict((group['name'], group) for group in self.param_groups)
+    self.flat = {}
+    # the parameters are moved into the flat buffers here: every parameter swaps its storage for a view
+    # into its buffer, so tensors taken from p.data before the optimizer is built no longer alias the model
+    for name in self.groups:
+      self._flatten(name)
+
+  def __getstate__(self):
+    state = super(FlatAdam, self).__getstate__()
+    state['flat'] = self.flat
+    return state
+
+  def __setstate__(self, state):
+    # copies rebuild their flat buffers around the copied parameters on first use
+    super(FlatAdam, self).__setstate__(state)
+    self.groups = dict((group['name'], group) for group in self.param_groups)
+    self.flat = state.get('flat', {})
+
+  def _flatten(self, name):
+    # parameters become views into the flat buffer; rebuilt on the next use after they are moved or replaced
+    params = self.groups[name]['params']
+    flat = self.flat.get(name)
+    if flat is not None and all(p.data_ptr() == ptr for p, ptr in zip(params, flat['ptrs'])):
+      return flat
+    param = torch.cat([p.data.reshape(-1) for p in params])
+    grad = torch.zeros_like(param)
+    numels = [p.numel() for p in params]
+    grads = [g.view_as(p) for g, p in zip(torch.split(grad, numels), params)]
+    for p, data, g in zip(params, torch.split(param, numels), grads):
+      p.data = data.view_as(p)
+      if p.grad is not None:
+        g.copy_(p.grad)
+      p.grad = g
+    self.flat[name] = {
+        'param': param, 'grad': grad, 'grads': grads, 'numels': numels,
+        'exp_avg': flat['exp_avg'].to(param.device) if flat is not None else torch.zeros_like(param),
+        'exp_avg_sq': flat['exp_avg_sq'].to(param.device) if flat is not None else torch.zeros_like(param),
+        'denom': torch.empty_like(param),
+        'step': flat['step'] if flat is not None else 0,
+        'ptrs': [p.data_ptr() for p in params]}
+    return self.flat[name]
+
+  def _sync_grads(self, name, flat, zero=False):
+    # gradients reset to None or replaced elsewhere are moved back into the flat buffer
+    for p, g in zip(self.groups[name]['params'], flat['grads']):
+      if p.grad is None:
+        g.zero_()
+        p.grad = g
+      elif p.grad.data_ptr() != g.data_ptr():
+        if not zero:
+          g.copy_(p.grad)
+        p.grad = g
+
+  def _average_grads(self, grads):
+    # in distributed training the flat gradients are averaged over the ranks, one all-reduce per network
+    if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+      return
+    works = [dist.all_reduce(grad, async_op=True) for grad in grads]
+    for work, grad in zip(works, grads):
+      work.wait()
+      grad.div_(dist.get_world_size())
+
+  def zero_grad(self, set_to_none=False, *, names=None):
+    # gradients are zeroed in place by default, so that backward keeps writing into the flat buffers
+    names = list(self.groups) if names is None else names
+    for name in names:
+      flat = self._flatten(name)
+      self._sync_grads(name, flat, zero=True)
+      flat['grad'].zero_()
+      if set_to_none:
+        for p in self.groups[name]['params']:
+          p.grad = None
+
+  @torch.no_grad()
+  def step(self, closure=None, *, names=None):
+    loss = None
+    if closure is not None:
+      with torch.enable_grad():
+        loss = closure()
+    names = list(self.groups) if names is None else names
+    flats = {}
+    for name in names:
+      flats[name] = self._flatten(name)
+      self._sync_grads(name, flats[name])
+    self._average_grads([flats[name]['grad'] for name in names])
+    for name in names:
+      group = self.groups[name]
+      flat = flats[name]
+      flat['step'] += 1
+      if group['max_grad_norm'] is not None:
+        nn.utils.clip_grad_norm_(group['params'], group['max_grad_norm'])
+
+      # the update of torch.optim.Adam, applied to the whole network at once
+      beta1, beta2 = group['betas']
+      param, grad, exp_avg, exp_avg_sq, denom = flat['param'], flat['grad'], flat['exp_avg'], flat['exp_avg_sq'], flat['denom']
+      if group['weight_decay'] != 0:
+        # the decayed gradient goes to the denominator buffer, p.grad is left as backward wrote it
+        grad = torch.add(grad, param, alpha=group['weight_decay'], out=denom)
+      exp_avg.lerp_(grad, 1 - beta1)
+      exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+      torch.sqrt(exp_avg_sq, out=denom)
+      denom.div_((1 - beta2 ** flat['step']) ** 0.5).add_(group['eps'])
+      param.addcdiv_(exp_avg, denom, value=-group['lr'] / (1 - beta1 ** flat['step']))
+    return loss
+
+  def group_state_dict(self, name):
+    # state of one network in the layout of torch.optim.Adam, as stored in checkpoints
+    group = self.groups[name]
+    flat = self._flatten(name)
+    state = {}
+    if flat['step'] > 0:
+      exp_avgs = torch.split(flat['exp_avg'], flat['numels'])
+      exp_avg_sqs = torch.split(flat['exp_avg_sq'], flat['numels'])
+      for i, (p, exp_avg, exp_avg_sq) in enumerate(zip(group['params'], exp_avgs, exp_avg_sqs)):
+        state[i] = {'step': torch.tensor(float(flat['step'])), 'exp_avg': exp_avg.view_as(p).clone(), 'exp_avg_sq': exp_avg_sq.view_as(p).clone()}
+    param_group = dict((key, value) for key, value in group.items() if key not in ('params', 'name', 'max_grad_norm'))
+    param_group['amsgrad'] = False
+    param_group['params'] = list(range(len(group['params'])))
+    return {'state': state, 'param_groups': [param_group]}
+
+  def load_group_state_dict(self, name, state_dict):
+    group = self.groups[name]
+    flat = self._flatten(name)
+    saved_group = state_dict['param_groups'][0]
+    for key in ('lr', 'initial_lr'):
+      if key in saved_group:
+        group[key] = saved_group[key]
+    state = state_dict['state']
+    exp_avgs = torch.split(flat['exp_avg'], flat['numels'])
+    exp_avg_sqs = torch.split(flat['exp_avg_sq'], flat['numels'])
+    for i, (exp_avg, exp_avg_sq) in enumerate(zip(exp_avgs, exp_avg_sqs)):
+      if i in state:
+        exp_avg.copy_(state[i]['exp_avg'].reshape(-1))
+        exp_avg_sq.copy_(state[i]['exp_avg_sq'].reshape(-1))
+      else:
+        exp_avg.zero_()
+        exp_avg_sq.zero_()
+    flat['step'] = int(max([float(s['step']) for s in state.values()] + [0]))
+
 ####################################################################
 #------------------------- Basic Functions -------------------------
 ####################################################################
@@ -415,6 +638,63 @@ def get_scheduler(optimizer, opts, cur_ep=-1):
     return NotImplementedError('no such learn rate policy')
   return scheduler
 
+def forward_shared(net, xa, xb):
+  # runs both domains through a network with per-sample layers in one call when their shapes match
+  if xa.size()[1:] != xb.size()[1:]:
+    return net(xa), net(xb)
+  out = net(torch.cat((xa, xb), 0))
+  return torch.split(out, [xa.size(0), xb.size(0)], dim=0)
+
+def conv_z(conv, x, z):
+  # conv over [x, z expanded to the size of x] without building the concatenation. x is padded
+  # beforehand (reflection) and z is constant over space, so its part of the output is a per-sample bias
+  n_x = x.size(1)
+  out = F.conv2d(x, conv.weight[:, :n_x], conv.bias, conv.stride, 0, conv.dilation, conv.groups)
+  bias_z = torch.matmul(z, conv.weight[:, n_x:].sum((2, 3)).t())
+  return out + bias_z.view(bias_z.size(0), bias_z.size(1), 1, 1)
+
+def conv_transpose_z(conv, x, z):
+  # the same for a transposed convolution, whose response to a constant input depends on which kernel
+  # taps reach each output row and column (stride phase and borders). These tap masks are separable,
+  # so the z part is a per-sample (out, kh, kw) weight spread over the output by two small products
+  n_x = x.size(1)
+  out = F.conv_transpose2d(x, conv.weight[:n_x], conv.bias, conv.stride, conv.padding, conv.output_padding, conv.groups, conv.dilation)
+  weight_z = torch.einsum('bc,cokl->bokl', z, conv.weight[n_x:])
+  masks = []
+  for dim in range(2):
+    k = conv.kernel_size[dim]
+    taps = torch.eye(k, dtype=x.dtype, device=x.device).view(1, k, k)
+    ones = x.new_ones(1, 1, x.size(2 + dim))
+    mask = F.conv_transpose1d(ones, taps, None, conv.stride[dim], conv.padding[dim], conv.output_padding[dim], 1, conv.dilation[dim])
+    masks.append(mask[0])
+  bias_z = torch.einsum('bokl,lw->bokw', weight_z, masks[1])
+  bias_z = torch.einsum('bokw,kh->bohw', bias_z, masks[0])
+  return out + bias_z
+
+def set_fold_z(net, fold_z):
+  # switches the generator between concatenating z before its layers and folding z into per-sample biases
+  for m in net.modules():
+    if isinstance(m, (G_concat, MisINSResBlock)):
+      m.fold_z = fold_z
+
+def run_checkpointed(module, fn, *inputs):
+  # with checkpointing enabled on the module, the activations of fn are recomputed in backward instead of stored
+  if module.checkpoint and torch.is_grad_enabled():
+    return checkpoint(fn, *inputs, use_reentrant=False)
+  return fn(*inputs)
+
+def set_checkpoint(net, kinds):
+  # enables activation checkpointing for the listed kinds of blocks, e.g. 'ins,mis,dec'
+  modules = {'ins': INSResBlock, 'mis': MisINSResBlock, 'dec': ReLUINSConvTranspose2d}
+  kinds = [kind for kind in kinds.split(',') if kind] if kinds else []
+  for kind in kinds:
+    if kind not in modules:
+      raise NotImplementedError('checkpointing of [%s] is not found' % kind)
+  for m in net.modules():
+    for kind, module in modules.items():
+      if isinstance(m, module):
+        m.checkpoint = kind in kinds
+
 def meanpoolConv(inplanes, outplanes):
   sequence = []
   sequence += [nn.AvgPool2d(kernel_size=2, stride=2)]
@@ -431,7 +711,7 @@ def get_norm_layer(layer_type='instance'):
   if layer_type == 'batch':
     norm_layer = functools.partial(nn.BatchNorm2d, affine=True)
   elif layer_type == 'instance':
-    norm_layer = functools.partial(nn.InstanceNorm2d, affine=False)
+    norm_layer = functools.partial(InstanceNorm2d, affine=False)
   elif layer_type == 'none':
     norm_layer = None
   else:
@@ -465,6 +745,7 @@ class LayerNorm(nn.Module):
   def __init__(self, n_out, eps=1e-5, affine=True):
     super(LayerNorm, self).__init__()
     self.n_out = n_out
+    self.eps = eps
     self.affine = affine
     if self.affine:
       self.weight = nn.Parameter(torch.ones(n_out, 1, 1))
@@ -472,10 +753,24 @@ class LayerNorm(nn.Module):
     return
   def forward(self, x):
     normalized_shape = x.size()[1:]
-    if self.affine:
-      return F.layer_norm(x, normalized_shape, self.weight.expand(normalized_shape), self.bias.expand(normalized_shape))
-    else:
-      return F.layer_norm(x, normalized_shape)
+    with torch.autocast(x.device.type, enabled=False):
+      x = x.float()
+      if torch.onnx.is_in_onnx_export():
+        # the ONNX exporter needs a constant normalized_shape, which it is not with dynamic image sizes
+        mean = x.mean((1, 2, 3), keepdim=True)
+        var = (x - mean).pow(2).mean((1, 2, 3), keepdim=True)
+        x = (x - mean) / torch.sqrt(var + self.eps)
+        return x * self.weight + self.bias if self.affine else x
+      if self.affine:
+        return F.layer_norm(x, normalized_shape, self.weight.expand(normalized_shape), self.bias.expand(normalized_shape), self.eps)
+      else:
+        return F.layer_norm(x, normalized_shape, eps=self.eps)
+
+class InstanceNorm2d(nn.InstanceNorm2d):
+  # instance normalization in float32, also under bf16 autocast
+  def forward(self, x):
+    with torch.autocast(x.device.type, enabled=False):
+      return super(InstanceNorm2d, self).forward(x.float())
 
 class BasicBlock(nn.Module):
   def __init__(self, inplanes, outplanes, norm_layer=None, nl_layer=None):
@@ -505,7 +800,7 @@ class LeakyReLUConv2d(nn.Module):
     else:
       model += [nn.Conv2d(n_in, n_out, kernel_size=kernel_size, stride=stride, padding=0, bias=True)]
     if 'norm' == 'Instance':
-      model += [nn.InstanceNorm2d(n_out, affine=False)]
+      model += [InstanceNorm2d(n_out, affine=False)]
     model += [nn.LeakyReLU(inplace=True)]
     self.model = nn.Sequential(*model)
     self.model.apply(gaussian_weights_init)
@@ -519,7 +814,7 @@ class ReLUINSConv2d(nn.Module):
     model = []
     model += [nn.ReflectionPad2d(padding)]
     model += [nn.Conv2d(n_in, n_out, kernel_size=kernel_size, stride=stride, padding=0, bias=True)]
-    model += [nn.InstanceNorm2d(n_out, affine=False)]
+    model += [InstanceNorm2d(n_out, affine=False)]
     model += [nn.ReLU(inplace=True)]
     self.model = nn.Sequential(*model)
     self.model.apply(gaussian_weights_init)
@@ -533,15 +828,24 @@ class INSResBlock(nn.Module):
     super(INSResBlock, self).__init__()
     model = []
     model += self.conv3x3(inplanes, planes, stride)
-    model += [nn.InstanceNorm2d(planes)]
+    model += [InstanceNorm2d(planes)]
     model += [nn.ReLU(inplace=True)]
     model += self.conv3x3(planes, planes)
-    model += [nn.InstanceNorm2d(planes)]
+    model += [InstanceNorm2d(planes)]
     if dropout > 0:
       model += [nn.Dropout(p=dropout)]
     self.model = nn.Sequential(*model)
     self.model.apply(gaussian_weights_init)
-  def forward(self, x):
+    self.checkpoint = False
+  def forward(self, x, z=None):
+    return run_checkpointed(self, self._forward, x, z)
+  def _forward(self, x, z=None):
+    if z is not None:
+      # input [x, z] with z folded into a per-sample bias, the residual adds z back to the trailing channels
+      out = self.model[2:](conv_z(self.model[1], self.model[0](x), z))
+      out[:, :x.size(1)] += x
+      out[:, x.size(1):] += z.view(z.size(0), z.size(1), 1, 1)
+      return out
     residual = x
     out = self.model(x)
     out += residual
@@ -552,14 +856,15 @@ class MisINSResBlock(nn.Module):
     return nn.Sequential(nn.ReflectionPad2d(1), nn.Conv2d(dim_in, dim_out, kernel_size=3, stride=stride))
   def conv1x1(self, dim_in, dim_out):
     return nn.Conv2d(dim_in, dim_out, kernel_size=1, stride=1, padding=0)
-  def __init__(self, dim, dim_extra, stride=1, dropout=0.0):
+  def __init__(self, dim, dim_extra, stride=1, dropout=0.0, fold_z=False):
     super(MisINSResBlock, self).__init__()
+    self.fold_z = fold_z
     self.conv1 = nn.Sequential(
         self.conv3x3(dim, dim, stride),
-        nn.InstanceNorm2d(dim))
+        InstanceNorm2d(dim))
     self.conv2 = nn.Sequential(
         self.conv3x3(dim, dim, stride),
-        nn.InstanceNorm2d(dim))
+        InstanceNorm2d(dim))
     self.blk1 = nn.Sequential(
         self.conv1x1(dim + dim_extra, dim + dim_extra),
         nn.ReLU(inplace=False),
@@ -579,14 +884,23 @@ class MisINSResBlock(nn.Module):
     self.conv2.apply(gaussian_weights_init)
     self.blk1.apply(gaussian_weights_init)
     self.blk2.apply(gaussian_weights_init)
+    self.checkpoint = False
   def forward(self, x, z):
+    return run_checkpointed(self, self._forward, x, z)
+  def _forward(self, x, z):
     residual = x
+    if self.fold_z:
+      o1 = self.conv1(x)
+      o2 = self.blk1[1:](conv_z(self.blk1[0], o1, z))
+      o3 = self.conv2(o2)
+      out = self.blk2[1:](conv_z(self.blk2[0], o3, z))
+      return out + residual
     z_expand = z.view(z.size(0), z.size(1), 1, 1).expand(z.size(0), z.size(1), x.size(2), x.size(3))
     o1 = self.conv1(x)
     o2 = self.blk1(torch.cat([o1, z_expand], dim=1))
     o3 = self.conv2(o2)
     out = self.blk2(torch.cat([o3, z_expand], dim=1))
-    out += residual
+    out = out + residual
     return out
 
 class GaussianNoiseLayer(nn.Module):
@@ -595,7 +909,7 @@ class GaussianNoiseLayer(nn.Module):
   def forward(self, x):
     if self.training == False:
       return x
-    noise = Variable(torch.randn(x.size()).cuda(x.get_device()))
+    noise = torch.randn(x.size(), device=x.device)
     return x + noise
 
 class ReLUINSConvTranspose2d(nn.Module):
@@ -607,7 +921,13 @@ class ReLUINSConvTranspose2d(nn.Module):
     model += [nn.ReLU(inplace=True)]
     self.model = nn.Sequential(*model)
     self.model.apply(gaussian_weights_init)
-  def forward(self, x):
+    self.checkpoint = False
+  def forward(self, x, z=None):
+    return run_checkpointed(self, self._forward, x, z)
+  def _forward(self, x, z=None):
+    if z is not None:
+      # input [x, z] with z folded into the transposed convolution
+      return self.model[1:](conv_transpose_z(self.model[0], x, z))
     return self.model(x)
 
 
@@ -649,7 +969,9 @@ class SpectralNorm(object):
     module.register_parameter(self.name, torch.nn.Parameter(weight))
   def __call__(self, module, inputs):
     if module.training:
-      weight, u = self.compute_weight(module)
+      # the power iteration stays in float32 under bf16 autocast
+      with torch.autocast(getattr(module, self.name + '_orig').device.type, enabled=False):
+        weight, u = self.compute_weight(module)
       setattr(module, self.name, weight)
       setattr(module, self.name + '_u', u)
     else:
@@ -0,0 +1,120 @@
+import os
+import copy
+import json
+import torch
+import torch.nn as nn
+import networks
+from model import AttrSampling
+
+# graph name -> (network, method), a and b name the domain of the input of the encoders and of the
+# output of the generator
+GRAPHS = [('enc_c_a', 'enc_c', 'forward_a'), ('enc_c_b', 'enc_c', 'forward_b'),
+          ('enc_a_a', 'enc_a', 'forward_a'), ('enc_a_b', 'enc_a', 'forward_b'),
+          ('gen_a', 'gen', 'forward_a'), ('gen_b', 'gen', 'forward_b')]
+
+class Forward(nn.Module):
+  # a forward_a/forward_b method of a network as a module, for tracing
+  def __init__(self, net, method):
+    super(Forward, self).__init__()
+    self.net = net
+    self.method = method
+
+  def forward(self, x, z=None):
+    if z is None:
+      return getattr(self.net, self.method)(x)
+    return getattr(self.net, self.method)(x, z)
+
+def strip_noise(net):
+  # GaussianNoiseLayer is the identity in eval mode, replace it so that no random op is traced
+  for module in list(net.modules()):
+    for name, child in list(module.named_children()):
+      if isinstance(child, networks.GaussianNoiseLayer):
+        setattr(module, name, nn.Identity())
+  return net
+
+def export_onnx(model, output_dir, input_dim_a, input_dim_b, crop_size=216, opset=17):
+  # traces the encoders and the generator of a DRITInference model (fp32, without --fold_z) into one
+  # ONNX graph per domain, with dynamic batch and spatial axes
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+  nets = dict((name, strip_noise(copy.deepcopy(getattr(model, name))).cpu().float().eval()) for name in ['enc_c', 'enc_a', 'gen'])
+  images = {'a': torch.randn(1, input_dim_a, crop_size, crop_size), 'b': torch.randn(1, input_dim_b, crop_size, crop_size)}
+  image_axes = {0: 'batch', 2: 'height', 3: 'width'}
+  content_axes = {0: 'batch', 2: 'content_height', 3: 'content_width'}
+  with torch.no_grad():
+    content = nets['enc_c'].forward_a(images['a'])
+    z = torch.randn(1, model.nz)
+    for graph, name, method in GRAPHS:
+      domain = graph[-1]
+      if name == 'enc_c':
+        inputs, input_names, output_names = (images[domain],), ['image'], ['content']
+        dynamic_axes = {'image': image_axes, 'content': content_axes}
+      elif name == 'enc_a':
+        inputs, input_names = (images[domain],), ['image']
+        output_names = ['mu', 'logvar'] if model.concat else ['z']
+        dynamic_axes = dict([('image', image_axes)] + [(output, {0: 'batch'}) for output in output_names])
+      else:
+        inputs, input_names, output_names = (content, z), ['content', 'z'], ['image']
+        dynamic_axes = {'content': content_axes, 'z': {0: 'batch'}, 'image': image_axes}
+      torch.onnx.export(Forward(nets[name], method), inputs, os.path.join(output_dir, graph + '.onnx'), input_names=input_names,
+                        output_names=output_names, dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+  with open(os.path.join(output_dir, 'model.json'), 'w') as f:
+    json.dump({'concat': bool(model.concat), 'nz': model.nz, 'input_dim_a': input_dim_a, 'input_dim_b': input_dim_b, 'opset': opset}, f)
+
+class DRITOnnx(AttrSampling):
+  # the test API of DRITInference on ONNX Runtime's CPU provider, for graphs written by export_onnx.
+  # Inputs and outputs are CPU tensors, sessions can be shared by threads
+  def __init__(self, onnx_dir, num_threads=0):
+    import onnxruntime
+    with open(os.path.join(onnx_dir, 'model.json')) as f:
+      meta = json.load(f)
+    self.concat = meta['concat']
+    self.nz = meta['nz']
+    self.device = torch.device('cpu')
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads > 0:
+      options.intra_op_num_threads = num_threads
+    self.sessions = dict((graph, onnxruntime.InferenceSession(os.path.join(onnx_dir, graph + '.onnx'), options, providers=['CPUExecutionProvider'])) for graph, _, _ in GRAPHS)
+
+  def run(self, graph, *inputs):
+    session = self.sessions[graph]
+    feeds = dict((arg.name, x.detach().cpu().float().numpy()) for arg, x in zip(session.get_inputs(), inputs))
+    return [torch.from_numpy(output) for output in session.run(None, feeds)]
+
+  def get_z_random(self, batchSize, nz, random_type='gauss'):
+    return torch.randn(batchSize, nz)
+
+  def test_forward(self, image, a2b=True):
+    z_random = self.get_z_random(image.size(0), self.nz, 'gauss')
+    if a2b:
+      z_content, = self.run('enc_c_a', image)
+      output, = self.run('gen_b', z_content, z_random)
+    else:
+      z_content, = self.run('enc_c_b', image)
+      output, = self.run('gen_a', z_content, z_random)
+    return output
+
+  def test_forward_attr(self, image, z_attr, a2b=True):
+    z_content, = self.run('enc_c_a' if a2b else 'enc_c_b', image)
+    output, = self.run('gen_b' if a2b else 'gen_a', *self.tile_attr(z_content, z_attr))
+    return output.view(*z_attr.size()[:2], *output.size()[1:])
+
+  def encode_attr(self, image, a2b=True):
+    # attribute code statistics of reference images from the target domain
+    outputs = self.run('enc_a_b' if a2b else 'enc_a_a', image)
+    if self.concat:
+      return outputs[0], outputs[1]
+    return outputs[0], None
+
+  def test_forward_transfer(self, image_a, image_b, a2b=True):
+    # only the content of the source and the attribute code of the reference image are encoded
+    if a2b:
+      mu, logvar = self.encode_attr(image_b, a2b=True)
+      z_content, = self.run('enc_c_a', image_a)
+      output, = self.run('gen_b', z_content, self.sample_attr(mu, logvar))
+    else:
+      mu, logvar = self.encode_attr(image_a, a2b=False)
+      z_content, = self.run('enc_c_b', image_b)
+      output, = self.run('gen_a', z_content, self.sample_attr(mu, logvar))
+    return output
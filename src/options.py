@@ -7,13 +7,20 @@ class TrainOptions():
     # data loader related
     self.parser.add_argument('--dataroot', type=str, required=True, help='path of data')
     self.parser.add_argument('--phase', type=str, default='train', help='phase for dataloading')
-    self.parser.add_argument('--batch_size', type=int, default=2, help='batch size')
+    self.parser.add_argument('--batch_size', type=int, default=2, help='batch size, an even number as every batch is split into an encoded and a random half')
     self.parser.add_argument('--resize_size', type=int, default=256, help='resized image size for training')
     self.parser.add_argument('--crop_size', type=int, default=216, help='cropped image size for training')
     self.parser.add_argument('--input_dim_a', type=int, default=3, help='# of input channels for domain A')
     self.parser.add_argument('--input_dim_b', type=int, default=3, help='# of input channels for domain B')
     self.parser.add_argument('--nThreads', type=int, default=8, help='# of threads for data loader')
     self.parser.add_argument('--no_flip', action='store_true', help='specified if no flipping')
+    self.parser.add_argument('--cache_dir', type=str, default=None, help='path of the decoded image cache built by prepare_dataset.py')
+    self.parser.add_argument('--index_dir', type=str, default=None, help='path of the persisted dataset index, read instead of listing the image folders (built on first use)')
+    self.parser.add_argument('--rebuild_index', action='store_true', help='rescan the image folders into the --index_dir index, e.g. after images were replaced in place')
+    self.parser.add_argument('--no_draft', action='store_true', help='decode JPEGs at full resolution instead of the smallest DCT scale >= resize_size')
+    self.parser.add_argument('--batch_transform', action='store_true', help='ship uint8 images from the loader workers and crop/flip/normalize whole batches on the training device')
+    self.parser.add_argument('--shard_dir', type=str, default=None, help='path of the tar shards built by prepare_dataset.py, streamed instead of listing the image folders')
+    self.parser.add_argument('--shuffle_buffer', type=int, default=1000, help='# of samples in the shuffle buffer of each shard reader')
 
     # ouptput related
     self.parser.add_argument('--name', type=str, default='trial', help='folder name to save outputs')
@@ -22,6 +29,9 @@ class TrainOptions():
     self.parser.add_argument('--display_freq', type=int, default=1, help='freq (iteration) of display')
     self.parser.add_argument('--img_save_freq', type=int, default=5, help='freq (epoch) of saving images')
     self.parser.add_argument('--model_save_freq', type=int, default=10, help='freq (epoch) of saving models')
+    self.parser.add_argument('--keep_models', type=int, default=0, help='# of most recent saved models to keep, 0 keeps all')
+    self.parser.add_argument('--snapshot_freq', type=int, default=0, help='freq (iteration) of saving encoder/generator-only snapshots, 0 for none')
+    self.parser.add_argument('--keep_snapshots', type=int, default=3, help='# of most recent snapshots to keep, 0 keeps all')
     self.parser.add_argument('--no_display_img', action='store_true', help='specified if no dispaly')
 
     # training related
@@ -30,6 +40,10 @@ class TrainOptions():
     self.parser.add_argument('--dis_scale', type=int, default=3, help='scale of discriminator')
     self.parser.add_argument('--dis_norm', type=str, default='None', help='normalization layer in discriminator [None, Instance]')
     self.parser.add_argument('--dis_spectral_norm', action='store_true', help='use spectral normalization in discriminator')
+    self.parser.add_argument('--stack_dis', action='store_true', help='run the image discriminators stacked as grouped convolutions')
+    self.parser.add_argument('--fold_z', action='store_true', help='fold the attribute code into per-sample biases instead of concatenating it to the generator features')
+    self.parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='precision of the forward passes [fp32, bf16]')
+    self.parser.add_argument('--checkpoint', type=str, default='', help='blocks whose activations are recomputed in backward, comma separated [ins, mis, dec]')
     self.parser.add_argument('--lr_policy', type=str, default='lambda', help='type of learn rate decay')
     self.parser.add_argument('--n_ep', type=int, default=1200, help='number of epochs') # 400 * d_iter
     self.parser.add_argument('--n_ep_decay', type=int, default=600, help='epoch start decay learning rate, set -1 if no decay') # 200 * d_iter
@@ -37,12 +51,21 @@ class TrainOptions():
     self.parser.add_argument('--d_iter', type=int, default=3, help='# of iterations for updating content discriminator')
     self.parser.add_argument('--gpu', type=int, default=0, help='gpu')
 
+    # execution related
+    self.parser.add_argument('--device', type=str, default=None, help='device to run on, e.g. cpu, cuda, cuda:1 (default: cuda:<gpu> if available, else cpu)')
+    self.parser.add_argument('--num_threads', type=int, default=0, help='# of intra-op threads, 0 for the torch default')
+    self.parser.add_argument('--num_interop_threads', type=int, default=0, help='# of inter-op threads, 0 for the torch default')
+    self.parser.add_argument('--cpu_cores', type=str, default=None, help='cores to pin the process to, e.g. 0-15 or 0,2,4 (shared equally by the local ranks of a distributed run)')
+    self.parser.add_argument('--dist_backend', type=str, default='gloo', help='backend of distributed training launched with torchrun [gloo, nccl]')
+
   def parse(self):
     self.opt = self.parser.parse_args()
     args = vars(self.opt)
     print('\n--- load options ---')
     for name, value in sorted(args.items()):
       print('%s: %s' % (str(name), str(value)))
+    if self.opt.batch_size < 2 or self.opt.batch_size % 2 != 0:
+      raise ValueError('batch_size must be an even number, got %d' % self.opt.batch_size)
     return self.opt
 
 class TestOptions():
@@ -52,12 +75,18 @@ class TestOptions():
     # data loader related
     self.parser.add_argument('--dataroot', type=str, required=True, help='path of data')
     self.parser.add_argument('--phase', type=str, default='test', help='phase for dataloading')
+    self.parser.add_argument('--batch_size', type=int, default=1, help='# of input images translated per forward pass')
     self.parser.add_argument('--resize_size', type=int, default=256, help='resized image size for training')
     self.parser.add_argument('--crop_size', type=int, default=216, help='cropped image size for training')
     self.parser.add_argument('--nThreads', type=int, default=4, help='for data loader')
+    self.parser.add_argument('--cache_dir', type=str, default=None, help='path of the decoded image cache built by prepare_dataset.py')
+    self.parser.add_argument('--index_dir', type=str, default=None, help='path of the persisted dataset index, read instead of listing the image folders (built on first use)')
+    self.parser.add_argument('--rebuild_index', action='store_true', help='rescan the image folders into the --index_dir index, e.g. after images were replaced in place')
+    self.parser.add_argument('--no_draft', action='store_true', help='decode JPEGs at full resolution instead of the smallest DCT scale >= resize_size')
     self.parser.add_argument('--input_dim_a', type=int, default=3, help='# of input channels for domain A')
     self.parser.add_argument('--input_dim_b', type=int, default=3, help='# of input channels for domain B')
     self.parser.add_argument('--a2b', type=int, default=1, help='translation direction, 1 for a2b, 0 for b2a')
+    self.parser.add_argument('--attr_bank', type=str, default=None, help='attribute code bank built by build_attr_bank.py, used by test_transfer.py instead of encoding reference images')
 
     # ouptput related
     self.parser.add_argument('--num', type=int, default=5, help='number of outputs per image')
@@ -67,17 +96,177 @@ class TestOptions():
     # model related
     self.parser.add_argument('--concat', type=int, default=1, help='concatenate attribute features for translation, set 0 for using feature-wise transform')
     self.parser.add_argument('--no_ms', action='store_true', help='disable mode seeking regularization')
+    self.parser.add_argument('--fold_z', action='store_true', help='fold the attribute code into per-sample biases instead of concatenating it to the generator features')
+    self.parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='precision of the forward passes [fp32, bf16]')
     self.parser.add_argument('--resume', type=str, required=True, help='specified the dir of saved models for resume the training')
     self.parser.add_argument('--gpu', type=int, default=0, help='gpu')
 
+    # execution related
+    self.parser.add_argument('--device', type=str, default=None, help='device to run on, e.g. cpu, cuda, cuda:1 (default: cuda:<gpu> if available, else cpu)')
+    self.parser.add_argument('--num_threads', type=int, default=0, help='# of intra-op threads, 0 for the torch default')
+    self.parser.add_argument('--num_interop_threads', type=int, default=0, help='# of inter-op threads, 0 for the torch default')
+    self.parser.add_argument('--cpu_cores', type=str, default=None, help='cores to pin the process to, e.g. 0-15 or 0,2,4')
+
+  def parse(self):
+    self.opt = self.parser.parse_args()
+    args = vars(self.opt)
+    print('\n--- load options ---')
+    for name, value in sorted(args.items()):
+      print('%s: %s' % (str(name), str(value)))
+    return self.opt
+
+class ServerOptions():
+  def __init__(self):
+    self.parser = argparse.ArgumentParser()
+
+    # server related
+    self.parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    self.parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    self.parser.add_argument('--max_batch', type=int, default=8, help='max # of requests translated per forward pass')
+    self.parser.add_argument('--max_latency_ms', type=float, default=10, help='max time the oldest request waits for a batch to fill')
+    self.parser.add_argument('--max_queue', type=int, default=64, help='max # of waiting requests, more are rejected with 503')
+
+    # data related
+    self.parser.add_argument('--resize_size', type=int, default=256, help='size request images are resized to')
+    self.parser.add_argument('--crop_size', type=int, default=216, help='size of the center crop of the resized request images that is translated')
+    self.parser.add_argument('--input_dim_a', type=int, default=3, help='# of input channels for domain A')
+    self.parser.add_argument('--input_dim_b', type=int, default=3, help='# of input channels for domain B')
+
+    # model related
+    self.parser.add_argument('--concat', type=int, default=1, help='concatenate attribute features for translation, set 0 for using feature-wise transform')
+    self.parser.add_argument('--fold_z', action='store_true', help='fold the attribute code into per-sample biases instead of concatenating it to the generator features')
+    self.parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='precision of the forward passes [fp32, bf16]')
+    self.parser.add_argument('--resume', type=str, default=None, help='training checkpoint, snapshot or inference export to serve as model "default"')
+    self.parser.add_argument('--models', type=str, default=None, help='JSON file of the models to serve, {"<name>": {"resume": <checkpoint>, <model option>: <value>, ...}}')
+    self.parser.add_argument('--memory_budget_mb', type=float, default=0, help='memory of the resident models, least recently used ones are evicted beyond it (0 for no limit)')
+    self.parser.add_argument('--gpu', type=int, default=0, help='gpu')
+
+    # execution related
+    self.parser.add_argument('--device', type=str, default=None, help='device to run on, e.g. cpu, cuda, cuda:1 (default: cuda:<gpu> if available, else cpu)')
+    self.parser.add_argument('--num_threads', type=int, default=0, help='# of intra-op threads, 0 for the torch default')
+    self.parser.add_argument('--num_interop_threads', type=int, default=0, help='# of inter-op threads, 0 for the torch default')
+    self.parser.add_argument('--cpu_cores', type=str, default=None, help='cores to pin the process to, e.g. 0-15 or 0,2,4')
+
+  def parse(self):
+    self.opt = self.parser.parse_args()
+    args = vars(self.opt)
+    print('\n--- load options ---')
+    for name, value in sorted(args.items()):
+      print('%s: %s' % (str(name), str(value)))
+    if (self.opt.resume is None) == (self.opt.models is None):
+      raise ValueError('specify either --resume or --models')
+    return self.opt
+
+class LoadgenOptions():
+  def __init__(self):
+    self.parser = argparse.ArgumentParser()
+    self.parser.add_argument('--url', type=str, default='http://127.0.0.1:8000', help='address of the translation server')
+    self.parser.add_argument('--endpoint', type=str, default='translate', choices=['translate', 'transfer'], help='endpoint to load [translate, transfer]')
+    self.parser.add_argument('--a2b', type=int, default=1, help='translation direction, 1 for a2b, 0 for b2a')
+    self.parser.add_argument('--model', type=str, default=None, help='comma separated models to send requests to, in turn (default: the server default)')
+    self.parser.add_argument('--concurrency', type=int, default=8, help='# of concurrent clients')
+    self.parser.add_argument('--requests', type=int, default=200, help='total # of requests')
+    self.parser.add_argument('--images', type=str, default=None, help='folder of images to send (default: synthetic JPEGs)')
+    self.parser.add_argument('--image_size', type=int, default=256, help='size of the synthetic images')
+    self.parser.add_argument('--timeout', type=float, default=60, help='request timeout in seconds')
+
+  def parse(self):
+    self.opt = self.parser.parse_args()
+    args = vars(self.opt)
+    print('\n--- load options ---')
+    for name, value in sorted(args.items()):
+      print('%s: %s' % (str(name), str(value)))
+    return self.opt
+
+class ExportOptions():
+  def __init__(self):
+    self.parser = argparse.ArgumentParser()
+    self.parser.add_argument('--resume', type=str, required=True, help='training checkpoint or snapshot to export')
+    self.parser.add_argument('--output', type=str, required=True, help='path of the exported inference checkpoint, or folder of the ONNX graphs')
+    self.parser.add_argument('--format', type=str, default='pth', choices=['pth', 'onnx'], help='export format [pth, onnx]')
+    self.parser.add_argument('--dtype', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='storage precision of the exported weights [fp32, bf16, fp16], fp32 only for onnx')
+    self.parser.add_argument('--input_dim_a', type=int, default=3, help='# of input channels for domain A')
+    self.parser.add_argument('--input_dim_b', type=int, default=3, help='# of input channels for domain B')
+    self.parser.add_argument('--crop_size', type=int, default=216, help='image size traced into the ONNX graphs, height and width stay dynamic')
+    self.parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+
+  def parse(self):
+    self.opt = self.parser.parse_args()
+    args = vars(self.opt)
+    print('\n--- load options ---')
+    for name, value in sorted(args.items()):
+      print('%s: %s' % (str(name), str(value)))
+    if self.opt.format == 'onnx' and self.opt.dtype != 'fp32':
+      raise ValueError('ONNX graphs are exported in fp32 only')
+    return self.opt
+
+class PrepareOptions():
+  def __init__(self):
+    self.parser = argparse.ArgumentParser()
+
+    # data related
+    self.parser.add_argument('--dataroot', type=str, required=True, help='path of the data to prepare')
+    self.parser.add_argument('--phase', type=str, default='train', help='phase to prepare, e.g. train or test')
+    self.parser.add_argument('--domains', type=str, default='AB', help='domains to prepare')
+    self.parser.add_argument('--resize_size', type=int, default=256, help='size the cached images are resized to, the --resize_size of training')
+    self.parser.add_argument('--nThreads', type=int, default=8, help='# of worker processes')
+    self.parser.add_argument('--no_draft', action='store_true', help='decode JPEGs at full resolution instead of the smallest DCT scale >= resize_size')
+
+    # output related
+    self.parser.add_argument('--cache_dir', type=str, default=None, help='path for saving the decoded image cache')
+    self.parser.add_argument('--shard_dir', type=str, default=None, help='path for saving the tar shards')
+    self.parser.add_argument('--shard_size', type=int, default=1000, help='# of images per tar shard')
+    self.parser.add_argument('--index_dir', type=str, default=None, help='path for saving the dataset index')
+
+  def parse(self):
+    self.opt = self.parser.parse_args()
+    args = vars(self.opt)
+    print('\n--- load options ---')
+    for name, value in sorted(args.items()):
+      print('%s: %s' % (str(name), str(value)))
+    return self.opt
+
+class BenchmarkOptions():
+  def __init__(self):
+    self.parser = argparse.ArgumentParser()
+
+    # benchmark related
+    self.parser.add_argument('--mode', type=str, default='decode', choices=['decode', 'dloss', 'dstack', 'optim', 'eg', 'coalesce', 'fold', 'checkpoint', 'precision', 'load', 'imports', 'registry', 'onnx'], help='benchmark to run [decode, dloss, dstack, optim, eg, coalesce, fold, checkpoint, precision, load, imports, registry, onnx]')
+    self.parser.add_argument('--repeat', type=int, default=3, help='# of timed repetitions, the best one is reported')
+    self.parser.add_argument('--bench_dir', type=str, default=None, help='path for the synthetic benchmark data (default: a temporary folder)')
+
+    # data related
+    self.parser.add_argument('--num_images', type=int, default=32, help='# of synthetic images')
+    self.parser.add_argument('--source_width', type=int, default=4000, help='width of the synthetic source images')
+    self.parser.add_argument('--source_height', type=int, default=3000, help='height of the synthetic source images')
+    self.parser.add_argument('--resize_size', type=int, default=256, help='size the decode benchmark resizes the synthetic images to')
+    self.parser.add_argument('--crop_size', type=int, default=216, help='size of the synthetic images fed to the model benchmarks')
+    self.parser.add_argument('--batch_size', type=int, default=2, help='batch size of the model benchmarks')
+    self.parser.add_argument('--input_dim_a', type=int, default=3, help='# of input channels for domain A')
+    self.parser.add_argument('--input_dim_b', type=int, default=3, help='# of input channels for domain B')
+
+    # model related
+    self.parser.add_argument('--no_ms', action='store_true', help='disable mode seeking regularization')
+    self.parser.add_argument('--concat', type=int, default=1, help='concatenate attribute features for translation, set 0 for using feature-wise transform')
+    self.parser.add_argument('--dis_scale', type=int, default=3, help='scale of discriminator')
+    self.parser.add_argument('--dis_norm', type=str, default='None', help='normalization layer in discriminator [None, Instance]')
+    self.parser.add_argument('--dis_spectral_norm', action='store_true', help='use spectral normalization in discriminator')
+    self.parser.add_argument('--stack_dis', action='store_true', help='run the image discriminators stacked as grouped convolutions')
+    self.parser.add_argument('--fold_z', action='store_true', help='fold the attribute code into per-sample biases instead of concatenating it to the generator features')
+    self.parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help='precision of the forward passes [fp32, bf16]')
+    self.parser.add_argument('--checkpoint', type=str, default='', help='blocks whose activations are recomputed in backward, comma separated [ins, mis, dec]')
+
+    # execution related
+    self.parser.add_argument('--gpu', type=int, default=0, help='gpu')
+    self.parser.add_argument('--device', type=str, default=None, help='device to run on, e.g. cpu, cuda, cuda:1 (default: cuda:<gpu> if available, else cpu)')
+    self.parser.add_argument('--num_threads', type=int, default=0, help='# of intra-op threads, 0 for the torch default')
+    self.parser.add_argument('--num_interop_threads', type=int, default=0, help='# of inter-op threads, 0 for the torch default')
+    self.parser.add_argument('--cpu_cores', type=str, default=None, help='cores to pin the process to, e.g. 0-15 or 0,2,4')
+
   def parse(self):
     self.opt = self.parser.parse_args()
     args = vars(self.opt)
     print('\n--- load options ---')
     for name, value in sorted(args.items()):
       print('%s: %s' % (str(name), str(value)))
-    # set irrelevant options
-    self.opt.dis_scale = 3
-    self.opt.dis_norm = 'None'
-    self.opt.dis_spectral_norm = False
     return self.opt
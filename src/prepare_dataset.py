@@ -0,0 +1,34 @@
+from options import PrepareOptions
+
+def main():
+  # parse options
+  parser = PrepareOptions()
+  opts = parser.parse()
+
+  from dataset import build_cache, build_shards, build_index
+
+  if opts.cache_dir is None and opts.shard_dir is None and opts.index_dir is None:
+    raise ValueError('specify --cache_dir, --shard_dir and/or --index_dir')
+
+  # validate every image once and persist the listing
+  if opts.index_dir is not None:
+    print('\n--- build dataset index ---')
+    for domain in opts.domains:
+      build_index(opts.dataroot, opts.phase + domain, opts.index_dir, opts.nThreads)
+
+  # decode and resize every image once
+  if opts.cache_dir is not None:
+    print('\n--- build image cache ---')
+    for domain in opts.domains:
+      build_cache(opts.dataroot, opts.phase + domain, opts.resize_size, opts.cache_dir, opts.nThreads, not opts.no_draft)
+
+  # pack the encoded images into sequential shards
+  if opts.shard_dir is not None:
+    print('\n--- build tar shards ---')
+    for domain in opts.domains:
+      build_shards(opts.dataroot, opts.phase + domain, opts.shard_dir, opts.shard_size)
+
+  return
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,94 @@
+import json
+import time
+import argparse
+import threading
+import collections
+from model import DRITInference
+
+# model options by name from a JSON file {"<name>": {"resume": <checkpoint>, <option>: <value>, ...}},
+# options missing from an entry are taken from defaults
+def load_model_configs(filename, defaults):
+  with open(filename) as f:
+    entries = json.load(f)
+  configs = collections.OrderedDict()
+  for name, entry in sorted(entries.items()):
+    if 'resume' not in entry:
+      raise ValueError('model %s in %s has no resume checkpoint' % (name, filename))
+    options = dict(vars(defaults))
+    options.update(entry)
+    configs[name] = argparse.Namespace(**options)
+  return configs
+
+# bytes of the parameters and buffers of a model
+def model_bytes(model):
+  tensors = list(model.parameters()) + list(model.buffers())
+  return sum(t.numel() * t.element_size() for t in tensors)
+
+class ModelRegistry():
+  # lazily loaded inference models by name. Once the resident models exceed budget bytes (0 for no
+  # limit), the least recently used ones are evicted, the model just loaded is always kept. The models
+  # are in eval mode without gradients and shared read-only by all threads, an evicted model stays
+  # valid for the threads still holding it
+  def __init__(self, configs, device, budget=0):
+    self.configs = configs
+    self.device = device
+    self.budget = budget
+    self.models = collections.OrderedDict()
+    self.loading = {}
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.loads = 0
+    self.evictions = 0
+    self.load_time = 0.0
+
+  def load(self, name):
+    model = DRITInference(self.configs[name])
+    model.resume(self.configs[name].resume)
+    model.setdevice(self.device)
+    model.eval()
+    for param in model.parameters():
+      param.requires_grad_(False)
+    return model
+
+  def get(self, name):
+    if name not in self.configs:
+      raise KeyError('no such model [%s]' % name)
+    while True:
+      with self.lock:
+        if name in self.models:
+          self.models.move_to_end(name)
+          self.hits += 1
+          return self.models[name][0]
+        loading = self.loading.get(name)
+        if loading is None:
+          # this thread loads the model, concurrent requests for it wait instead of loading it again
+          loading = self.loading[name] = threading.Event()
+          break
+      loading.wait()
+
+    start = time.perf_counter()
+    try:
+      model = self.load(name)
+    except Exception:
+      with self.lock:
+        del self.loading[name]
+      loading.set()
+      raise
+    with self.lock:
+      del self.loading[name]
+      self.loads += 1
+      self.load_time += time.perf_counter() - start
+      self.models[name] = (model, model_bytes(model))
+      while self.budget > 0 and len(self.models) > 1 and self.resident_bytes() > self.budget:
+        self.models.popitem(last=False)
+        self.evictions += 1
+    loading.set()
+    return model
+
+  def resident_bytes(self):
+    return sum(nbytes for _, nbytes in self.models.values())
+
+  def stats(self):
+    with self.lock:
+      return {'models': len(self.configs), 'resident': list(self.models), 'resident_mb': self.resident_bytes() / 2.0**20,
+              'hits': self.hits, 'loads': self.loads, 'evictions': self.evictions, 'load_time_s': self.load_time}
@@ -0,0 +1,73 @@
+import os
+import torch
+import torch.distributed as dist
+
+# parse a core list such as '0-7,16,18-19'
+def parse_cores(cores):
+  cpus = set()
+  for part in cores.split(','):
+    part = part.strip()
+    if not part:
+      continue
+    if '-' in part:
+      start, end = part.split('-')
+      cpus.update(range(int(start), int(end) + 1))
+    else:
+      cpus.add(int(part))
+  return sorted(cpus)
+
+# pin the process, set the thread pools and return the execution device
+def setup_runtime(opts):
+  num_threads = opts.num_threads
+  if opts.cpu_cores is not None:
+    cpus = parse_cores(opts.cpu_cores)
+    os.sched_setaffinity(0, cpus)
+    # one intra-op thread per pinned core unless told otherwise
+    if num_threads <= 0:
+      num_threads = len(cpus)
+  if num_threads > 0:
+    torch.set_num_threads(num_threads)
+  if opts.num_interop_threads > 0:
+    torch.set_num_interop_threads(opts.num_interop_threads)
+
+  if opts.device is None:
+    opts.device = 'cuda:%d' % opts.gpu if torch.cuda.is_available() else 'cpu'
+  device = torch.device(opts.device)
+  print('device: %s, intra-op threads: %d, inter-op threads: %d' % (device, torch.get_num_threads(), torch.get_num_interop_threads()))
+  return device
+
+# join the process group of a torchrun launch (WORLD_SIZE, RANK and LOCAL_RANK in the environment),
+# returns the rank and the world size, (0, 1) when not launched distributed
+def setup_distributed(opts):
+  world_size = int(os.environ.get('WORLD_SIZE', '1'))
+  if world_size <= 1:
+    return 0, 1
+  if opts.device is not None and opts.device.startswith('cuda:'):
+    raise ValueError('--device %s would put every rank on the same GPU, pass --device cuda to use cuda:<local rank>' % opts.device)
+  dist.init_process_group(backend=opts.dist_backend)
+  local_rank = int(os.environ.get('LOCAL_RANK', '0'))
+  local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', '1'))
+
+  # one GPU per local rank, or an equal share of --cpu_cores per local rank
+  opts.gpu = local_rank
+  if opts.device == 'cuda':
+    opts.device = 'cuda:%d' % local_rank
+  if opts.cpu_cores is not None:
+    cpus = parse_cores(opts.cpu_cores)
+    n_cpus = len(cpus) // local_world_size
+    if n_cpus == 0:
+      raise ValueError('%d cores cannot be shared by %d local ranks' % (len(cpus), local_world_size))
+    opts.cpu_cores = ','.join(str(cpu) for cpu in cpus[local_rank * n_cpus:(local_rank + 1) * n_cpus])
+  return dist.get_rank(), dist.get_world_size()
+
+# copy the parameters and buffers of rank 0 to every rank
+def broadcast_state(module):
+  for tensor in module.state_dict().values():
+    dist.broadcast(tensor, 0)
+
+# smallest of the batch sizes of all ranks (-1 for a rank out of data), so that every rank makes the
+# same decision to train on, skip or stop at a batch and the collectives stay in lockstep
+def min_batch_size(batch_size, device):
+  size = torch.tensor([batch_size], device=device)
+  dist.all_reduce(size, op=dist.ReduceOp.MIN)
+  return int(size.item())
@@ -1,6 +1,8 @@
 import os
-import torchvision
-from tensorboardX import SummaryWriter
+import glob
+import queue
+import threading
+import torch
 import numpy as np
 from PIL import Image
 
@@ -21,6 +23,67 @@ def save_imgs(imgs, names, path):
     img = Image.fromarray(img)
     img.save(os.path.join(path, name + '.png'))
 
+# write a checkpoint to a temporary file, fsync it and rename it over filename, so that a crash
+# never leaves a partially written checkpoint behind
+def save_atomic(state, filename):
+  tmp_filename = filename + '.tmp'
+  try:
+    with open(tmp_filename, 'wb') as f:
+      torch.save(state, f)
+      f.flush()
+      os.fsync(f.fileno())
+  except BaseException:
+    if os.path.exists(tmp_filename):
+      os.remove(tmp_filename)
+    raise
+  os.replace(tmp_filename, filename)
+  dir_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+  try:
+    os.fsync(dir_fd)
+  finally:
+    os.close(dir_fd)
+
+class CheckpointWriter():
+  # writes host memory checkpoints on a background thread. At most max_pending checkpoints wait to
+  # be written, beyond that submit blocks. After every write only the newest keep files matching the
+  # pattern of the checkpoint are kept (0 keeps all)
+  def __init__(self, max_pending=2):
+    self.queue = queue.Queue(max_pending)
+    self.error = None
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while True:
+      job = self.queue.get()
+      if job is None:
+        return
+      state, filename, pattern, keep = job
+      try:
+        save_atomic(state, filename)
+        if keep > 0:
+          for old_filename in sorted(glob.glob(pattern))[:-keep]:
+            os.remove(old_filename)
+      except Exception as e:
+        self.error = e
+      finally:
+        self.queue.task_done()
+
+  def check(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise RuntimeError('writing a checkpoint failed: %s' % error)
+
+  def submit(self, state, filename, pattern=None, keep=0):
+    self.check()
+    self.queue.put((state, filename, pattern, keep))
+
+  # wait for the pending checkpoints and stop the thread
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    self.check()
+
 class Saver():
   def __init__(self, opts):
     self.display_dir = os.path.join(opts.display_dir, opts.name)
@@ -29,6 +92,10 @@ class Saver():
     self.display_freq = opts.display_freq
     self.img_save_freq = opts.img_save_freq
     self.model_save_freq = opts.model_save_freq
+    self.snapshot_freq = opts.snapshot_freq
+    self.keep_models = opts.keep_models
+    self.keep_snapshots = opts.keep_snapshots
+    self.checkpoint_writer = CheckpointWriter()
 
     # make directory
     if not os.path.exists(self.display_dir):
@@ -38,12 +105,14 @@ class Saver():
     if not os.path.exists(self.image_dir):
       os.makedirs(self.image_dir)
 
-    # create tensorboard writer
+    # create tensorboard writer, tensorboardX (and the TensorFlow it may pull in) is only imported here
+    from tensorboardX import SummaryWriter
     self.writer = SummaryWriter(logdir=self.display_dir)
 
   # write losses and images to tensorboard
   def write_display(self, total_it, model):
     if (total_it + 1) % self.display_freq == 0:
+      import torchvision
       # write loss
       members = [attr for attr in dir(model) if not callable(getattr(model, attr)) and not attr.startswith("__") and 'loss' in attr]
       for m in members:
@@ -54,20 +123,32 @@ class Saver():
 
   # save result images
   def write_img(self, ep, model):
+    import torchvision
     if (ep + 1) % self.img_save_freq == 0:
       assembled_images = model.assemble_outputs()
       img_filename = '%s/gen_%05d.jpg' % (self.image_dir, ep)
       torchvision.utils.save_image(assembled_images / 2 + 0.5, img_filename, nrow=1)
     elif ep == -1:
       assembled_images = model.assemble_outputs()
-      img_filename = '%s/gen_last.jpg' % (self.image_dir, ep)
+      img_filename = '%s/gen_last.jpg' % self.image_dir
       torchvision.utils.save_image(assembled_images / 2 + 0.5, img_filename, nrow=1)
 
-  # save model
+  # save model, the full checkpoint is written in the background
   def write_model(self, ep, total_it, model):
     if (ep + 1) % self.model_save_freq == 0:
       print('--- save the model @ ep %d ---' % (ep))
-      model.save('%s/%05d.pth' % (self.model_dir, ep), ep, total_it)
+      self.checkpoint_writer.submit(model.checkpoint_state(ep, total_it), '%s/%05d.pth' % (self.model_dir, ep), \
+                                    '%s/[0-9][0-9][0-9][0-9][0-9].pth' % self.model_dir, self.keep_models)
     elif ep == -1:
-      model.save('%s/last.pth' % self.model_dir, ep, total_it)
+      self.checkpoint_writer.submit(model.checkpoint_state(ep, total_it), '%s/last.pth' % self.model_dir)
+
+  # save a lightweight snapshot of the encoders and the generator every snapshot_freq iterations
+  def write_snapshot(self, ep, total_it, model):
+    if self.snapshot_freq > 0 and (total_it + 1) % self.snapshot_freq == 0:
+      self.checkpoint_writer.submit(model.checkpoint_state(ep, total_it, full=False), '%s/snapshot_%08d.pth' % (self.model_dir, total_it), \
+                                    '%s/snapshot_[0-9]*.pth' % self.model_dir, self.keep_snapshots)
+
+  # wait for the checkpoints still being written
+  def close(self):
+    self.checkpoint_writer.close()
 
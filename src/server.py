@@ -0,0 +1,270 @@
+import io
+import json
+import time
+import base64
+import queue
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import torch
+from PIL import Image
+from options import ServerOptions
+from dataset import image_transform, load_image
+from saver import tensor2img
+from latency import summarize
+
+class Request():
+  # a request waiting in the batcher, done is set once output or error is filled in
+  def __init__(self, key, images):
+    self.key = key
+    self.images = images
+    self.arrival = time.perf_counter()
+    self.start = None
+    self.batch_size = 0
+    self.output = None
+    self.error = None
+    self.done = threading.Event()
+
+class DynamicBatcher():
+  # runs requests with the same key together, a batch is closed once it holds max_batch requests or
+  # its oldest request waited max_latency seconds. At most max_queue requests wait, submit raises
+  # queue.Full beyond that
+  def __init__(self, run_batch, max_batch, max_latency, max_queue):
+    self.run_batch = run_batch
+    self.max_batch = max_batch
+    self.max_latency = max_latency
+    self.max_queue = max_queue
+    self.queue = queue.Queue()
+    # requests pulled while gathering a batch of another key
+    self.held = collections.deque()
+    self.pending = 0
+    self.lock = threading.Lock()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def submit(self, key, images):
+    with self.lock:
+      if self.pending >= self.max_queue:
+        raise queue.Full
+      self.pending += 1
+    request = Request(key, images)
+    self.queue.put(request)
+    return request
+
+  def gather(self):
+    first = self.held.popleft() if self.held else self.queue.get()
+    if first is None:
+      return None
+    batch = [first]
+    for request in list(self.held):
+      if len(batch) == self.max_batch:
+        break
+      if request.key == first.key:
+        self.held.remove(request)
+        batch.append(request)
+    deadline = first.arrival + self.max_latency
+    while len(batch) < self.max_batch:
+      timeout = deadline - time.perf_counter()
+      if timeout <= 0:
+        break
+      try:
+        request = self.queue.get(timeout=timeout)
+      except queue.Empty:
+        break
+      if request is None:
+        # run the batch, stop on the next gather
+        self.queue.put(None)
+        break
+      if request.key == first.key:
+        batch.append(request)
+      else:
+        self.held.append(request)
+    return batch
+
+  def run(self):
+    while True:
+      batch = self.gather()
+      if batch is None:
+        return
+      start = time.perf_counter()
+      try:
+        outputs, error = self.run_batch(batch[0].key, [request.images for request in batch]), None
+      except Exception as e:
+        outputs, error = [None] * len(batch), e
+      with self.lock:
+        self.pending -= len(batch)
+      for request, output in zip(batch, outputs):
+        request.start = start
+        request.batch_size = len(batch)
+        request.output = output
+        request.error = error
+        request.done.set()
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+
+class TranslationService():
+  # preprocessing, batched translation and latency statistics of the server
+  def __init__(self, opts, registry):
+    self.opts = opts
+    self.registry = registry
+    self.transform = image_transform(opts.resize_size, opts.crop_size, False, False)
+    self.batcher = DynamicBatcher(self.run_batch, opts.max_batch, opts.max_latency_ms / 1000.0, opts.max_queue)
+    self.lock = threading.Lock()
+    self.latency = collections.deque(maxlen=10000)
+    self.queue_wait = collections.deque(maxlen=10000)
+    self.batch_sizes = collections.deque(maxlen=10000)
+    self.served = 0
+    self.rejected = 0
+
+  # base64 encoded image to a normalized C x H x W tensor, like dataset_single
+  def load_image(self, data, input_dim):
+    return load_image(io.BytesIO(base64.b64decode(data)), self.transform, self.opts.resize_size, input_dim)
+
+  def save_image(self, img):
+    buf = io.BytesIO()
+    Image.fromarray(tensor2img(img.unsqueeze(0))).save(buf, format='PNG')
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+  def run_batch(self, key, images):
+    name, endpoint, a2b = key
+    model = self.registry.get(name)
+    with torch.no_grad():
+      content = torch.stack([x[0] for x in images]).to(model.device)
+      if endpoint == 'translate':
+        output = model.test_forward(content, a2b=a2b)
+      else:
+        # the content of one domain decoded with an attribute code sampled from the reference image
+        reference = torch.stack([x[1] for x in images]).to(model.device)
+        mu, logvar = model.encode_attr(reference, a2b=a2b)
+        z_attr = model.sample_attr(mu, logvar)
+        output = model.test_forward_attr(content, z_attr.unsqueeze(1), a2b=a2b)[:, 0]
+    return list(output.cpu())
+
+  def record(self, latency, queue_wait, batch_size):
+    with self.lock:
+      self.served += 1
+      self.latency.append(latency)
+      self.queue_wait.append(queue_wait)
+      self.batch_sizes.append(batch_size)
+
+  def reject(self):
+    with self.lock:
+      self.rejected += 1
+
+  def stats(self):
+    with self.lock:
+      return {'served': self.served, 'rejected': self.rejected, 'pending': self.batcher.pending,
+              'mean_batch_size': sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0,
+              'latency_ms': summarize(list(self.latency)), 'queue_ms': summarize(list(self.queue_wait)),
+              'registry': self.registry.stats()}
+
+class TranslationServer(ThreadingHTTPServer):
+  # one thread per connection, with a listen backlog for bursts of concurrent clients
+  daemon_threads = True
+  request_queue_size = 128
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def send_json(self, code, body, headers=None):
+    headers = headers or {}
+    data = json.dumps(body).encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):
+    if urlparse(self.path).path == '/stats':
+      self.send_json(200, self.server.service.stats())
+    else:
+      self.send_json(404, {'error': 'no such endpoint'})
+
+  def do_POST(self):
+    # {"image": <base64>, "reference": <base64, /transfer only>, "a2b": 1, "model": <name>} -> {"image": <base64 PNG>, ...}
+    arrival = time.perf_counter()
+    service = self.server.service
+    endpoint = urlparse(self.path).path.strip('/')
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if endpoint not in ['translate', 'transfer']:
+      self.send_json(404, {'error': 'no such endpoint'})
+      return
+    try:
+      body = json.loads(body)
+      a2b = int(body.get('a2b', 1))
+      if a2b not in [0, 1]:
+        raise ValueError('a2b must be 0 or 1')
+      name = body.get('model', 'default')
+      if name not in service.registry.configs:
+        raise ValueError('no such model [%s]' % name)
+      dims = [service.registry.configs[name].input_dim_a, service.registry.configs[name].input_dim_b]
+      images = (service.load_image(body['image'], dims[1 - a2b]),)
+      if endpoint == 'transfer':
+        images += (service.load_image(body['reference'], dims[a2b]),)
+    except (KeyError, ValueError, TypeError, OSError) as e:
+      self.send_json(400, {'error': 'bad request: %s' % e})
+      return
+
+    try:
+      request = service.batcher.submit((name, endpoint, a2b), images)
+    except queue.Full:
+      service.reject()
+      self.send_json(503, {'error': 'too many pending requests'}, {'Retry-After': '1'})
+      return
+    request.done.wait()
+    if request.error is not None:
+      self.send_json(500, {'error': str(request.error)})
+      return
+    image = service.save_image(request.output)
+    latency, queue_wait = time.perf_counter() - arrival, request.start - request.arrival
+    service.record(latency, queue_wait, request.batch_size)
+    self.send_json(200, {'image': image, 'latency_ms': 1000 * latency, 'queue_ms': 1000 * queue_wait, 'batch_size': request.batch_size})
+
+  def log_message(self, format, *args):
+    return
+
+def main():
+  # parse options
+  parser = ServerOptions()
+  opts = parser.parse()
+
+  from registry import ModelRegistry, load_model_configs
+  from runtime import setup_runtime
+
+  device = setup_runtime(opts)
+
+  # models, each loaded once on its first request and kept while it fits the memory budget
+  print('\n--- load models ---')
+  if opts.models is not None:
+    configs = load_model_configs(opts.models, opts)
+  else:
+    configs = {'default': opts}
+  registry = ModelRegistry(configs, device, int(opts.memory_budget_mb * 2**20))
+  if opts.resume is not None:
+    registry.get('default')
+  print('%d models: %s' % (len(configs), ', '.join(configs)))
+
+  # serve
+  service = TranslationService(opts, registry)
+  httpd = TranslationServer((opts.host, opts.port), Handler)
+  httpd.service = service
+  print('\n--- serving on http://%s:%d ---' % (opts.host, opts.port))
+  try:
+    httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    httpd.server_close()
+    service.batcher.close()
+    print(json.dumps(service.stats(), indent=2))
+
+  return
+
+if __name__ == '__main__':
+  main()
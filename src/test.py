@@ -1,8 +1,5 @@
 import torch
 from options import TestOptions
-from dataset import dataset_single
-from model import DRIT
-from saver import save_imgs
 import os
 
 def main():
@@ -10,19 +7,26 @@ def main():
   parser = TestOptions()
   opts = parser.parse()
 
+  from dataset import dataset_single
+  from model import DRITInference
+  from saver import save_imgs
+  from runtime import setup_runtime
+
+  device = setup_runtime(opts)
+
   # data loader
   print('\n--- load dataset ---')
   if opts.a2b:
     dataset = dataset_single(opts, 'A', opts.input_dim_a)
   else:
     dataset = dataset_single(opts, 'B', opts.input_dim_b)
-  loader = torch.utils.data.DataLoader(dataset, batch_size=1, num_workers=opts.nThreads)
+  loader = torch.utils.data.DataLoader(dataset, batch_size=opts.batch_size, num_workers=opts.nThreads)
 
   # model
   print('\n--- load model ---')
-  model = DRIT(opts)
-  model.setgpu(opts.gpu)
-  model.resume(opts.resume, train=False)
+  model = DRITInference(opts)
+  model.resume(opts.resume)
+  model.setdevice(device)
   model.eval()
 
   # directory
@@ -32,17 +36,20 @@ def main():
 
   # test
   print('\n--- testing ---')
-  for idx1, img1 in enumerate(loader):
-    print('{}/{}'.format(idx1, len(loader)))
-    img1 = img1.cuda()
-    imgs = [img1]
-    names = ['input']
-    for idx2 in range(opts.num):
-      with torch.no_grad():
-        img = model.test_forward(img1, a2b=opts.a2b)
-      imgs.append(img)
-      names.append('output_{}'.format(idx2))
-    save_imgs(imgs, names, os.path.join(result_dir, '{}'.format(idx1)))
+  idx1 = 0
+  for imgs1 in loader:
+    print('{}/{}'.format(idx1, len(dataset)))
+    imgs1 = imgs1.to(device)
+    with torch.no_grad():
+      outputs = model.test_forward_multi(imgs1, opts.num, a2b=opts.a2b)
+    for img1, output in zip(torch.split(imgs1, 1, dim=0), outputs):
+      imgs = [img1]
+      names = ['input']
+      for idx2, img in enumerate(torch.split(output, 1, dim=0)):
+        imgs.append(img)
+        names.append('output_{}'.format(idx2))
+      save_imgs(imgs, names, os.path.join(result_dir, '{}'.format(idx1)))
+      idx1 += 1
 
   return
 
@@ -1,31 +1,56 @@
 import torch
+import numpy as np
 from options import TestOptions
-from dataset import dataset_single
-from model import DRIT
-from saver import save_imgs
 import os
 
+# endless stream of shuffled reference images
+def reference_stream(loader):
+  while True:
+    for imgs in loader:
+      for img in torch.split(imgs, 1, dim=0):
+        yield img
+
 def main():
   # parse options
   parser = TestOptions()
   opts = parser.parse()
 
+  from dataset import dataset_single
+  from model import DRITInference
+  from saver import save_imgs
+  from runtime import setup_runtime
+
+  device = setup_runtime(opts)
+
   # data loader
   print('\n--- load dataset ---')
-  datasetA = dataset_single(opts, 'A', opts.input_dim_a)
-  datasetB = dataset_single(opts, 'B', opts.input_dim_b)
   if opts.a2b:
-    loader = torch.utils.data.DataLoader(datasetA, batch_size=1, num_workers=opts.nThreads)
-    loader_attr = torch.utils.data.DataLoader(datasetB, batch_size=1, num_workers=opts.nThreads, shuffle=True)
+    loader = torch.utils.data.DataLoader(dataset_single(opts, 'A', opts.input_dim_a), batch_size=opts.batch_size, num_workers=opts.nThreads)
+    if opts.attr_bank is None:
+      loader_attr = torch.utils.data.DataLoader(dataset_single(opts, 'B', opts.input_dim_b), batch_size=opts.batch_size, num_workers=opts.nThreads, shuffle=True)
   else:
-    loader = torch.utils.data.DataLoader(datasetB, batch_size=1, num_workers=opts.nThreads)
-    loader_attr = torch.utils.data.DataLoader(datasetA, batch_size=1, num_workers=opts.nThreads, shuffle=True)
+    loader = torch.utils.data.DataLoader(dataset_single(opts, 'B', opts.input_dim_b), batch_size=opts.batch_size, num_workers=opts.nThreads)
+    if opts.attr_bank is None:
+      loader_attr = torch.utils.data.DataLoader(dataset_single(opts, 'A', opts.input_dim_a), batch_size=opts.batch_size, num_workers=opts.nThreads, shuffle=True)
+
+  # precomputed attribute codes of the reference domain
+  if opts.attr_bank is not None:
+    bank = np.load(opts.attr_bank)
+    if int(bank['a2b']) != opts.a2b:
+      raise ValueError('attribute bank %s was built for the other translation direction' % opts.attr_bank)
+    if 'mu' in bank:
+      bank_mu = torch.from_numpy(bank['mu']).to(device)
+      bank_logvar = torch.from_numpy(bank['logvar']).to(device)
+    else:
+      bank_mu = torch.from_numpy(bank['z']).to(device)
+      bank_logvar = None
+    print('attribute bank: %d codes' % bank_mu.size(0))
 
   # model
   print('\n--- load model ---')
-  model = DRIT(opts)
-  model.setgpu(opts.gpu)
-  model.resume(opts.resume, train=False)
+  model = DRITInference(opts)
+  model.resume(opts.resume)
+  model.setdevice(device)
   model.eval()
 
   # directory
@@ -35,23 +60,34 @@ def main():
 
   # test
   print('\n--- testing ---')
-  for idx1, img1 in enumerate(loader):
-    print('{}/{}'.format(idx1, len(loader)))
-    img1 = img1.cuda()
-    imgs = [img1]
-    names = ['input']
-    for idx2, img2 in enumerate(loader_attr):
-      if idx2 == opts.num:
-        break
-      img2 = img2.cuda()
-      with torch.no_grad():
-        if opts.a2b:
-          img = model.test_forward_transfer(img1, img2, a2b=True)
-        else:
-          img = model.test_forward_transfer(img2, img1, a2b=False)
-      imgs.append(img)
-      names.append('output_{}'.format(idx2))
-    save_imgs(imgs, names, os.path.join(result_dir, '{}'.format(idx1)))
+  if opts.attr_bank is None:
+    references = reference_stream(loader_attr)
+  idx1 = 0
+  for imgs1 in loader:
+    print('{}/{}'.format(idx1, len(loader.dataset)))
+    imgs1 = imgs1.to(device)
+    batch_size = imgs1.size(0)
+    with torch.no_grad():
+      if opts.attr_bank is not None:
+        idx_attr = torch.stack([torch.randperm(bank_mu.size(0))[:opts.num] for _ in range(batch_size)]).view(-1).to(device)
+        z_attr = model.sample_attr(bank_mu[idx_attr], None if bank_logvar is None else bank_logvar[idx_attr])
+        z_attr = z_attr.view(batch_size, -1, z_attr.size(1))
+      else:
+        z_attr = []
+        for _ in range(opts.num):
+          imgs2 = torch.cat([next(references) for _ in range(batch_size)], 0).to(device)
+          mu, logvar = model.encode_attr(imgs2, a2b=opts.a2b)
+          z_attr.append(model.sample_attr(mu, logvar))
+        z_attr = torch.stack(z_attr, 1)
+      outputs = model.test_forward_attr(imgs1, z_attr, a2b=opts.a2b)
+    for img1, output in zip(torch.split(imgs1, 1, dim=0), outputs):
+      imgs = [img1]
+      names = ['input']
+      for idx2, img in enumerate(torch.split(output, 1, dim=0)):
+        imgs.append(img)
+        names.append('output_{}'.format(idx2))
+      save_imgs(imgs, names, os.path.join(result_dir, '{}'.format(idx1)))
+      idx1 += 1
 
   return
 
@@ -1,47 +1,89 @@
 import torch
+import torch.distributed as dist
 from options import TrainOptions
-from dataset import dataset_unpair
-from model import DRIT
-from saver import Saver
 
 def main():
   # parse options
   parser = TrainOptions()
   opts = parser.parse()
 
+  from dataset import dataset_unpair, dataset_unpair_shards
+  from model import DRIT
+  from saver import Saver
+  from runtime import setup_runtime, setup_distributed, broadcast_state, min_batch_size
+
+  rank, world_size = setup_distributed(opts)
+  device = setup_runtime(opts)
+
   # daita loader
   print('\n--- load dataset ---')
-  dataset = dataset_unpair(opts)
-  train_loader = torch.utils.data.DataLoader(dataset, batch_size=opts.batch_size, shuffle=True, num_workers=opts.nThreads)
+  sampler = None
+  if opts.shard_dir is not None:
+    dataset = dataset_unpair_shards(opts)
+    train_loader = torch.utils.data.DataLoader(dataset, batch_size=opts.batch_size, num_workers=opts.nThreads)
+  elif world_size > 1:
+    # every rank reads its own, equally sized part of the dataset
+    dataset = dataset_unpair(opts)
+    sampler = torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True)
+    train_loader = torch.utils.data.DataLoader(dataset, batch_size=opts.batch_size, sampler=sampler, num_workers=opts.nThreads)
+  else:
+    dataset = dataset_unpair(opts)
+    train_loader = torch.utils.data.DataLoader(dataset, batch_size=opts.batch_size, shuffle=True, num_workers=opts.nThreads)
 
   # model
   print('\n--- load model ---')
   model = DRIT(opts)
-  model.setgpu(opts.gpu)
+  model.setdevice(device)
   if opts.resume is None:
     model.initialize()
     ep0 = -1
     total_it = 0
   else:
     ep0, total_it = model.resume(opts.resume)
+  if world_size > 1:
+    broadcast_state(model)
   model.set_scheduler(opts, last_ep=ep0)
   ep0 += 1
   print('start the training at epoch %d'%(ep0))
 
-  # saver for display and output
-  saver = Saver(opts)
+  # saver for display and output, on rank 0 only
+  saver = Saver(opts) if rank == 0 else None
 
   # train
   print('\n--- train ---')
   max_it = 500000
   for ep in range(ep0, opts.n_ep):
-    for it, (images_a, images_b) in enumerate(train_loader):
-      if images_a.size(0) != opts.batch_size or images_b.size(0) != opts.batch_size:
+    if opts.shard_dir is not None:
+      dataset.set_epoch(ep)
+    if sampler is not None:
+      sampler.set_epoch(ep)
+    batches = iter(train_loader)
+    it = -1
+    while True:
+      batch = next(batches, None)
+
+      # each batch is split into an encoded and a random half
+      batch_size = -1 if batch is None else min(batch[0].size(0), batch[1].size(0)) // 2 * 2
+      # streams may end, and last batches be odd, at different iterations on different ranks
+      if world_size > 1:
+        smallest = min_batch_size(batch_size, device)
+        if smallest < 0:
+          break
+        if smallest == 0:
+          batch_size = 0
+      if batch is None:
+        break
+      images_a, images_b = batch
+      it += 1
+      if batch_size == 0:
         continue
+      images_a, images_b = images_a[:batch_size], images_b[:batch_size]
 
       # input data
-      images_a = images_a.cuda(opts.gpu).detach()
-      images_b = images_b.cuda(opts.gpu).detach()
+      images_a = images_a.to(device).detach()
+      images_b = images_b.to(device).detach()
+      if opts.batch_transform:
+        images_a, images_b = dataset.transform_batch(images_a, images_b)
 
       # update model
       if (it + 1) % opts.d_iter != 0 and it < len(train_loader) - 2:
@@ -52,26 +94,35 @@ def main():
         model.update_EG()
 
       # save to display file
-      if not opts.no_display_img:
+      if saver is not None and not opts.no_display_img:
         saver.write_display(total_it, model)
 
-      print('total_it: %d (ep %d, it %d), lr %08f' % (total_it, ep, it, model.gen_opt.param_groups[0]['lr']))
+      if saver is not None:
+        saver.write_snapshot(ep, total_it, model)
+      if rank == 0:
+        print('total_it: %d (ep %d, it %d), lr %08f' % (total_it, ep, it, model.opt.groups['gen']['lr']))
       total_it += 1
       if total_it >= max_it:
-        saver.write_img(-1, model)
-        saver.write_model(-1, model)
+        if saver is not None:
+          saver.write_img(-1, model)
+          saver.write_model(-1, total_it, model)
         break
 
     # decay learning rate
     if opts.n_ep_decay > -1:
       model.update_lr()
 
-    # save result image
-    saver.write_img(ep, model)
+    if saver is not None:
+      # save result image
+      saver.write_img(ep, model)
 
-    # Save network weights
-    saver.write_model(ep, total_it, model)
+      # Save network weights
+      saver.write_model(ep, total_it, model)
 
+  if saver is not None:
+    saver.close()
+  if world_size > 1:
+    dist.destroy_process_group()
   return
 
 if __name__ == '__main__':
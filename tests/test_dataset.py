@@ -0,0 +1,162 @@
+# CPU checks of the dataset pipelines on a few generated images
+import argparse
+import itertools
+import os
+import random
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+torch = pytest.importorskip('torch')
+import numpy as np
+from PIL import Image
+import dataset
+
+RESIZE_SIZE, CROP_SIZE = 64, 48
+
+# noise images of a few sizes, as lossless PNGs so that both pipelines decode the same pixels
+def write_images(folder, num, seed=0):
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+  rng = np.random.RandomState(seed)
+  for idx in range(num):
+    img = rng.randint(0, 256, (60 + 4 * idx, 80, 3)).astype(np.uint8)
+    Image.fromarray(img).save(os.path.join(folder, '%d_%d.png' % (seed, idx)))
+  return sorted(os.listdir(folder))
+
+@pytest.mark.parametrize('input_dim', [1, 3])
+def test_cache_matches_pil(tmp_path, input_dim):
+  names = write_images(str(tmp_path / 'trainA'), 4)
+  dataset.build_cache(str(tmp_path), 'trainA', RESIZE_SIZE, str(tmp_path / 'cache'), n_threads=1)
+  array_file, images = dataset.load_cache_index(str(tmp_path), 'trainA', RESIZE_SIZE, str(tmp_path / 'cache'), 1)
+  assert images == names
+  cache = np.load(array_file, mmap_mode='r')
+  transforms = dataset.image_transform(RESIZE_SIZE, CROP_SIZE, False, False)
+  for idx, name in enumerate(images):
+    ref = dataset.load_image(str(tmp_path / 'trainA' / name), transforms, None, input_dim)
+    output = dataset.cached_to_tensor(cache[idx], CROP_SIZE, False, False, input_dim)
+    assert output.size() == ref.size()
+    assert (output - ref).abs().max().item() < 1e-5
+
+@pytest.mark.parametrize('input_dim', [1, 3])
+def test_batch_transform_matches_per_sample(tmp_path, input_dim):
+  folder = str(tmp_path / 'trainA')
+  names = write_images(folder, 4)
+  transforms = dataset.image_transform(RESIZE_SIZE, CROP_SIZE, False, False)
+  refs = [dataset.load_image(os.path.join(folder, name), transforms, None, input_dim) for name in names]
+  batch = torch.stack([torch.from_numpy(dataset.load_resized(os.path.join(folder, name), RESIZE_SIZE, False).copy()) for name in names])
+  output = dataset.batch_to_tensor(batch, CROP_SIZE, False, False, input_dim)
+  assert (output - torch.stack(refs)).abs().max().item() < 1e-5
+  # a flipped sample is the mirrored per-sample output
+  output = dataset.batch_to_tensor(batch, CROP_SIZE, False, True, input_dim)
+  for x, ref in zip(output, refs):
+    assert min((x - ref).abs().max().item(), (x - ref.flip(2)).abs().max().item()) < 1e-5
+
+# move the mtime of path past the one of other, as the file system may not tick in between
+def touch_after(path, other):
+  mtime = os.stat(other).st_mtime_ns + 10**9
+  os.utime(path, ns=(mtime, mtime))
+
+def test_index_follows_folder(tmp_path):
+  dataroot, index_dir = str(tmp_path / 'data'), str(tmp_path / 'index')
+  names = write_images(os.path.join(dataroot, 'trainA'), 3)
+  with open(os.path.join(dataroot, 'trainA', 'broken.png'), 'wb') as f:
+    f.write(b'not an image')
+  assert dataset.load_index(dataroot, 'trainA', index_dir, 1) == names
+  index = dataset.index_file(index_dir, dataroot, 'trainA')
+
+  # added and removed images are picked up once the folder is newer than the index
+  added = write_images(os.path.join(dataroot, 'trainA'), 1, seed=1)
+  os.remove(os.path.join(dataroot, 'trainA', names[0]))
+  touch_after(os.path.join(dataroot, 'trainA'), index)
+  expected = sorted(name for name in added if name != 'broken.png' and name != names[0])
+  assert dataset.load_index(dataroot, 'trainA', index_dir, 1) == expected
+
+  # an unchanged folder reads the index as it is
+  with open(index, 'a') as f:
+    f.write('stale.png\t1\t1\t1\t1\tRGB\t\n')
+  touch_after(index, os.path.join(dataroot, 'trainA'))
+  assert dataset.load_index(dataroot, 'trainA', index_dir, 1) == expected + ['stale.png']
+  assert dataset.load_index(dataroot, 'trainA', index_dir, 1, rebuild=True) == expected
+
+  # another dataroot with the same set name keeps its own index
+  other = str(tmp_path / 'other')
+  other_names = write_images(os.path.join(other, 'trainA'), 2, seed=2)
+  assert dataset.load_index(other, 'trainA', index_dir, 1) == other_names
+  assert dataset.load_index(dataroot, 'trainA', index_dir, 1) == expected
+
+def test_cache_follows_folder(tmp_path):
+  dataroot, cache_dir = str(tmp_path / 'data'), str(tmp_path / 'cache')
+  names = write_images(os.path.join(dataroot, 'trainA'), 3)
+  with pytest.raises(IOError):
+    dataset.load_cache_index(dataroot, 'trainA', RESIZE_SIZE, cache_dir, 1)
+  dataset.build_cache(dataroot, 'trainA', RESIZE_SIZE, cache_dir, n_threads=1)
+  array_file, images = dataset.load_cache_index(dataroot, 'trainA', RESIZE_SIZE, cache_dir, 1)
+  assert images == names
+
+  # added and removed images are picked up once the folder is newer than the cache
+  added = write_images(os.path.join(dataroot, 'trainA'), 1, seed=1)
+  os.remove(os.path.join(dataroot, 'trainA', names[0]))
+  touch_after(os.path.join(dataroot, 'trainA'), dataset.cache_files(cache_dir, dataroot, 'trainA', RESIZE_SIZE)[1])
+  array_file, images = dataset.load_cache_index(dataroot, 'trainA', RESIZE_SIZE, cache_dir, 1)
+  assert images == [name for name in added if name != names[0]]
+  assert np.load(array_file, mmap_mode='r').shape[0] == len(images)
+
+  # another dataroot or decode mode with the same set name keeps its own cache
+  other = str(tmp_path / 'other')
+  other_names = write_images(os.path.join(other, 'trainA'), 2, seed=2)
+  dataset.build_cache(other, 'trainA', RESIZE_SIZE, cache_dir, n_threads=1)
+  assert dataset.load_cache_index(other, 'trainA', RESIZE_SIZE, cache_dir, 1)[1] == other_names
+  assert dataset.load_cache_index(dataroot, 'trainA', RESIZE_SIZE, cache_dir, 1)[1] == images
+  with pytest.raises(IOError):
+    dataset.load_cache_index(dataroot, 'trainA', RESIZE_SIZE, cache_dir, 1, draft=False)
+
+# shard datasets over 5 images of A in shards of 2 and 3 images of B in one shard, yielding the raw
+# bytes of every sample so that the samples of the readers can be told apart
+def shard_dataset(tmp_path):
+  for domain, num, shard_size in [('A', 5, 2), ('B', 3, 3)]:
+    write_images(str(tmp_path / 'data' / ('train' + domain)), num, seed=ord(domain))
+    dataset.build_shards(str(tmp_path / 'data'), 'train' + domain, str(tmp_path / 'shards'), shard_size)
+  opts = argparse.Namespace(shard_dir=str(tmp_path / 'shards'), phase='train', input_dim_a=3, input_dim_b=3, crop_size=CROP_SIZE,
+                            no_flip=True, batch_transform=True, resize_size=RESIZE_SIZE, no_draft=False, shuffle_buffer=2)
+  ds = dataset.dataset_unpair_shards(opts)
+  ds.load_img = lambda sample, input_dim: sample
+  return ds
+
+def test_shards_split_between_readers(tmp_path):
+  ds = shard_dataset(tmp_path)
+  for shards, size in [(ds.shards_A, ds.A_size), (ds.shards_B, ds.B_size)]:
+    everything = [sample for shard in shards for sample in dataset.read_shard(shard)]
+    for epoch in range(2):
+      ds.set_epoch(epoch)
+      # 2 readers get every other sample of both domains, 3 readers one shard of A and every third
+      # sample of B. Together they read every sample once per pass
+      for n_streams in [1, 2, 3]:
+        samples = []
+        for stream_id in range(n_streams):
+          stream = ds.stream(shards, size, stream_id, n_streams, 3, random.Random(stream_id))
+          samples += [sample for n_pass, sample in itertools.takewhile(lambda x: x[0] == 0, stream)]
+        assert sorted(samples) == sorted(everything)
+
+# images of a domain read by one of n readers when whole shards do not divide evenly between them
+def sample_share(size, stream_id, n_streams):
+  return size if size < n_streams else len(range(stream_id, size, n_streams))
+
+def test_shards_epoch_ends(tmp_path):
+  ds = shard_dataset(tmp_path)
+  # a rank yields pairs until both domains have been read once. With 2 and 4 ranks the 3 shards of A
+  # are split by sample, and with 4 ranks every rank reads all of B
+  for world_size in [1, 2, 4]:
+    ds.world_size = world_size
+    for rank in range(world_size):
+      ds.rank = rank
+      pairs = list(ds)
+      assert len(pairs) == max(sample_share(ds.A_size, rank, world_size), sample_share(ds.B_size, rank, world_size))
+      assert len(pairs) <= len(ds)
+  # with 3 ranks every rank gets one whole shard of A
+  ds.world_size = 3
+  lengths = []
+  for rank in range(3):
+    ds.rank = rank
+    lengths.append(len(list(ds)))
+  assert sorted(lengths) == [1, 2, 2]
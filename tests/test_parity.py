@@ -0,0 +1,33 @@
+# parity checks of the benchmark modes at a small size, each mode raises once a difference
+# exceeds its tolerance in benchmark.TOLERANCES. Run with python -m pytest tests from the repository root
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+torch = pytest.importorskip('torch')
+import benchmark
+from options import BenchmarkOptions
+
+def bench_opts(mode, *args):
+  return BenchmarkOptions().parser.parse_args(['--mode', mode, '--device', 'cpu', '--repeat', '1', '--crop_size', '128', '--batch_size', '2'] + list(args))
+
+@pytest.mark.parametrize('mode', ['dloss', 'dstack', 'optim', 'coalesce', 'fold', 'load'])
+def test_parity(mode, tmp_path):
+  benchmark.benchmarks[mode](bench_opts(mode), str(tmp_path))
+
+# a training forward needs the default crop, smaller content codes do not fit the content discriminator
+@pytest.mark.parametrize('mode', ['eg', 'checkpoint', 'precision'])
+def test_train_parity(mode, tmp_path):
+  benchmark.benchmarks[mode](bench_opts(mode, '--crop_size', '216'), str(tmp_path))
+
+def test_fold_parity_concat0(tmp_path):
+  benchmark.bench_fold(bench_opts('fold', '--concat', '0'), str(tmp_path))
+
+def test_parity_onnx(tmp_path):
+  pytest.importorskip('onnxruntime')
+  benchmark.bench_onnx(bench_opts('onnx'), str(tmp_path))
+
+# the entry points and library modules do not import the heavy modules they defer
+def test_imports(tmp_path):
+  benchmark.bench_imports(bench_opts('imports'), str(tmp_path))
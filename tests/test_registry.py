@@ -0,0 +1,65 @@
+# CPU checks of the LRU model registry on small inference exports
+import os
+import sys
+import argparse
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+torch = pytest.importorskip('torch')
+from model import DRITInference, export_checkpoint
+from registry import ModelRegistry, model_bytes
+
+# fp16 exports of randomly initialized single channel models, one per name
+def write_exports(folder, names):
+  configs = {}
+  for seed, name in enumerate(names):
+    torch.manual_seed(seed)
+    opts = argparse.Namespace(input_dim_a=1, input_dim_b=1, concat=1, fold_z=False, precision='fp32')
+    model = DRITInference(opts, meta=False)
+    checkpoint = dict((key, getattr(model, key).state_dict()) for key in ['enc_c', 'enc_a', 'gen'])
+    filename = os.path.join(folder, '%s.pth' % name)
+    torch.save(export_checkpoint(checkpoint, torch.float16), filename)
+    configs[name] = argparse.Namespace(resume=filename, **vars(opts))
+  return configs
+
+def test_registry_evicts_least_recently_used(tmp_path):
+  configs = write_exports(str(tmp_path), ['a', 'b', 'c'])
+  registry = ModelRegistry(configs, 'cpu')
+  model_a = registry.get('a')
+  # room for two of the models
+  registry.budget = 2 * model_bytes(model_a) + 1
+  registry.get('b')
+  assert registry.get('a') is model_a
+  assert registry.stats()['resident'] == ['b', 'a']
+
+  # b is the least recently used one
+  registry.get('c')
+  assert registry.stats()['resident'] == ['a', 'c']
+  assert registry.get('a') is model_a
+
+  # an evicted model is loaded again with the same weights, the threads still holding the old one can keep using it
+  model_b = registry.get('b')
+  assert registry.stats()['resident'] == ['a', 'b']
+  reference = DRITInference(configs['b'])
+  reference.resume(configs['b'].resume)
+  reference.eval()
+  for param, expected in zip(model_b.parameters(), reference.parameters()):
+    assert torch.equal(param, expected)
+    assert not param.requires_grad
+  image = torch.randn(1, 1, 216, 216)
+  z_attr = torch.randn(1, 2, model_b.nz)
+  with torch.no_grad():
+    assert torch.equal(model_b.test_forward_attr(image, z_attr), reference.test_forward_attr(image, z_attr))
+
+  stats = registry.stats()
+  assert (stats['hits'], stats['loads'], stats['evictions']) == (2, 4, 2)
+  assert stats['resident_mb'] * 2.0**20 <= registry.budget
+
+def test_registry_without_budget_keeps_all(tmp_path):
+  configs = write_exports(str(tmp_path), ['a', 'b'])
+  registry = ModelRegistry(configs, 'cpu')
+  models = [registry.get(name) for name in ['a', 'b', 'a', 'b']]
+  assert models[0] is models[2] and models[1] is models[3]
+  assert registry.stats()['evictions'] == 0
+  with pytest.raises(KeyError):
+    registry.get('missing')
@@ -0,0 +1,66 @@
+# CPU checks of distributed training with two gloo ranks on one machine
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+torch = pytest.importorskip('torch')
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from networks import FlatAdam
+from runtime import broadcast_state, min_batch_size
+
+WORLD_SIZE = 2
+
+def make_nets(seed):
+  torch.manual_seed(seed)
+  return nn.ModuleDict({'a': nn.Linear(8, 4), 'b': nn.Sequential(nn.Linear(4, 4), nn.Linear(4, 2))})
+
+def make_opt(nets):
+  return FlatAdam([{'name': 'a', 'params': nets['a'].parameters()}, {'name': 'b', 'params': nets['b'].parameters(), 'max_grad_norm': 0.5}],
+                  lr=0.01, betas=(0.5, 0.999), weight_decay=0.0001)
+
+# different gradients on every rank, the same ones for the single-process reference
+def fill_grads(nets, rank, step):
+  gen = torch.Generator().manual_seed(100 * step + rank)
+  for p in nets.parameters():
+    p.grad = torch.randn(p.size(), generator=gen)
+
+def worker(rank, init_file, out_dir):
+  dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=WORLD_SIZE)
+  # ranks start from different weights until rank 0 broadcasts its own
+  nets = make_nets(rank)
+  broadcast_state(nets)
+  opt = make_opt(nets)
+  for step in range(3):
+    opt.zero_grad()
+    fill_grads(nets, rank, step)
+    opt.step()
+  sizes = [min_batch_size(4 - rank, torch.device('cpu')), min_batch_size(-1 if rank == 1 else 4, torch.device('cpu'))]
+  torch.save({'state': nets.state_dict(), 'sizes': sizes}, os.path.join(out_dir, '%d.pth' % rank))
+  dist.destroy_process_group()
+
+def test_ranks_step_on_averaged_grads(tmp_path):
+  mp.spawn(worker, args=(str(tmp_path / 'init'), str(tmp_path)), nprocs=WORLD_SIZE)
+  results = [torch.load(str(tmp_path / ('%d.pth' % rank))) for rank in range(WORLD_SIZE)]
+
+  # a single process stepping on the gradients averaged over the ranks, from the weights of rank 0
+  nets = make_nets(0)
+  opt = make_opt(nets)
+  ranks = [make_nets(0) for _ in range(WORLD_SIZE)]
+  for step in range(3):
+    opt.zero_grad()
+    for rank, rank_nets in enumerate(ranks):
+      fill_grads(rank_nets, rank, step)
+    for p, rank_params in zip(nets.parameters(), zip(*[rank_nets.parameters() for rank_nets in ranks])):
+      p.grad.copy_(sum(q.grad for q in rank_params) / WORLD_SIZE)
+    opt.step()
+
+  for name, ref in nets.state_dict().items():
+    for result in results:
+      assert torch.equal(result['state'][name], results[0]['state'][name])
+      assert (result['state'][name] - ref).abs().max().item() < 1e-6
+  # the smallest batch of the ranks, -1 once a rank is out of data
+  for result in results:
+    assert result['sizes'] == [3, -1]
@@ -0,0 +1,41 @@
+# CPU checks of the background checkpoint writer
+import os
+import sys
+import glob
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+torch = pytest.importorskip('torch')
+from saver import CheckpointWriter, save_atomic
+
+def test_writer_keeps_newest(tmp_path):
+  writer = CheckpointWriter(max_pending=1)
+  pattern = str(tmp_path / 'snapshot_[0-9]*.pth')
+  for it in range(5):
+    writer.submit({'it': it, 'weight': torch.full((256, 256), float(it))}, str(tmp_path / ('snapshot_%08d.pth' % it)), pattern, 2)
+  # close returns once every submitted checkpoint is on disk
+  writer.close()
+  assert sorted(os.listdir(str(tmp_path))) == ['snapshot_00000003.pth', 'snapshot_00000004.pth']
+  for it in [3, 4]:
+    state = torch.load(str(tmp_path / ('snapshot_%08d.pth' % it)))
+    assert state['it'] == it and torch.equal(state['weight'], torch.full((256, 256), float(it)))
+
+def test_writer_keeps_all(tmp_path):
+  writer = CheckpointWriter()
+  for ep in range(3):
+    writer.submit({'ep': ep}, str(tmp_path / ('%05d.pth' % ep)), str(tmp_path / '[0-9][0-9][0-9][0-9][0-9].pth'), 0)
+  writer.submit({'ep': -1}, str(tmp_path / 'last.pth'))
+  writer.close()
+  assert sorted(os.listdir(str(tmp_path))) == ['00000.pth', '00001.pth', '00002.pth', 'last.pth']
+  assert [torch.load(str(tmp_path / name))['ep'] for name in sorted(os.listdir(str(tmp_path)))] == [0, 1, 2, -1]
+
+def test_failed_write_keeps_previous(tmp_path):
+  filename = str(tmp_path / 'last.pth')
+  save_atomic({'ep': 0}, filename)
+  writer = CheckpointWriter()
+  # a lambda cannot be pickled, the write fails halfway through
+  writer.submit({'ep': 1, 'fn': lambda x: x}, filename)
+  with pytest.raises(RuntimeError):
+    writer.close()
+  assert torch.load(filename)['ep'] == 0
+  assert not glob.glob(str(tmp_path / '*.tmp'))